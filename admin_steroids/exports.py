@@ -0,0 +1,306 @@
+"""
+Runs exports outside of the admin request that requested them.
+"""
+import math
+import os
+import shutil
+import sys
+import traceback
+import multiprocessing
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from six.moves import cPickle as pickle
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.contrib.admin.sites import all_sites
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db import connections, models, transaction
+from django.http import HttpRequest
+from django.utils import timezone
+
+_executor = None
+
+
+def get_model_admin(model, admin_site='admin'):
+    """
+    Returns the ModelAdmin instance registered for the given model in the named admin site.
+    """
+    for site in all_sites:
+        if site.name == admin_site and model in site._registry:
+            return site._registry[model]
+    raise KeyError('No ModelAdmin registered for %s in admin site %s.' % (model.__name__, admin_site))
+
+
+def get_csv_model_admin(model, admin_site='admin'):
+    """
+    Returns the ModelAdmin used to render CSV exports for the given model.
+
+    If the registered ModelAdmin doesn't support CSV exports, a default one exporting all fields is used.
+    """
+    from .options import CSVModelAdminMixin # pylint: disable=import-outside-toplevel
+    try:
+        model_admin = get_model_admin(model, admin_site=admin_site)
+    except KeyError:
+        model_admin = None
+    if not isinstance(model_admin, CSVModelAdminMixin):
+        model_admin = type('DefaultCSVModelAdmin', (CSVModelAdminMixin,), dict(model=model, list_display=(), csv_headers_all=True))()
+    return model_admin
+
+
+def get_export_request(user=None):
+    """
+    Returns a request made by the given user, for the ModelAdmin methods that read the request
+    when an export is rendered outside of the admin request that requested it.
+    """
+    request = HttpRequest()
+    request.method = 'GET'
+    request.user = user if user is not None else AnonymousUser()
+    return request
+
+
+def get_spool_dir():
+    spool_dir = settings.DAS_EXPORT_SPOOL_DIR
+    if not os.path.isdir(spool_dir):
+        os.makedirs(spool_dir, exist_ok=True)
+    return spool_dir
+
+
+def run_export_job(job_id, close_connections=False, resume=False):
+    """
+    Writes the file for the given ExportJob to the spool directory.
+
+    The file is written under a temporary name and renamed once complete,
+    so a partially written file is never served.
+
+    After each chunk of records, the job records the last primary key written and the size of the file.
+    If resume is true, a failed or interrupted job continues from that checkpoint instead of starting over.
+    A job is considered interrupted once it's been running for DAS_EXPORT_JOB_TIMEOUT_SECONDS without a checkpoint.
+
+    Returns false if the job couldn't be claimed, because it was already processed or is still running.
+    """
+    from .models import ExportJob # pylint: disable=import-outside-toplevel
+
+    try:
+        # Claim the job, so it's only processed once, even with multiple workers.
+        if resume:
+            stale = timezone.now() - timedelta(seconds=settings.DAS_EXPORT_JOB_TIMEOUT_SECONDS)
+            claimable = models.Q(status=ExportJob.FAILED) \
+                | models.Q(status=ExportJob.RUNNING, heartbeat__lt=stale) \
+                | models.Q(status=ExportJob.RUNNING, heartbeat__isnull=True, started__lt=stale)
+        else:
+            claimable = models.Q(status=ExportJob.PENDING)
+        now = timezone.now()
+        claimed = ExportJob.objects.filter(claimable, id=job_id)\
+            .update(status=ExportJob.RUNNING, started=now, heartbeat=now, error='')
+        if not claimed:
+            return False
+        job = ExportJob.objects.get(id=job_id)
+        try:
+            model = job.content_type.model_class()
+            model_admin = get_csv_model_admin(model, admin_site=job.admin_site)
+            request = get_export_request(job.user)
+            qs = model_admin.get_csv_queryset(request, job.get_queryset())
+            raw_headers = job.get_raw_headers()
+            if raw_headers is None:
+                raw_headers = model_admin.get_csv_raw_headers(request)
+            job.filename = job.get_filename()
+            path = os.path.join(get_spool_dir(), job.filename)
+            tmp_path = path + '.part'
+
+            after = None
+            if resume and job.last_pk and job.file_offset and os.path.isfile(tmp_path):
+                after = model._meta.pk.to_python(job.last_pk)
+                fout = open(tmp_path, 'r+b')
+                # Discard anything written after the checkpoint.
+                fout.truncate(job.file_offset)
+                fout.seek(job.file_offset)
+            else:
+                job.written = 0
+                fout = open(tmp_path, 'wb')
+            written = resumed_written = job.written
+
+            def checkpoint(last_pk, count):
+                fout.flush()
+                ExportJob.objects.filter(id=job.id).update(
+                    last_pk=str(last_pk), file_offset=fout.tell(), written=resumed_written + count, heartbeat=timezone.now()
+                )
+
+            with fout:
+                lines = model_admin.iter_csv_lines(request, qs, raw_headers, chunk_size=model_admin.csv_chunk_size, after=after, checkpoint=checkpoint)
+                for i, line in enumerate(lines):
+                    if i:
+                        fout.write(line.encode('utf-8'))
+                        written += 1
+                    elif after is None:
+                        # The header was already written before the checkpoint.
+                        fout.write(line.encode('utf-8'))
+            os.rename(tmp_path, path)
+            job.status = ExportJob.DONE
+            job.written = written
+        except Exception: # pylint: disable=broad-except
+            traceback.print_exc(file=sys.stderr)
+            job.refresh_from_db(fields=['last_pk', 'file_offset', 'written'])
+            job.status = ExportJob.FAILED
+            job.error = traceback.format_exc()
+        job.finished = timezone.now()
+        job.save()
+        return True
+    finally:
+        if close_connections:
+            connections.close_all()
+
+
+def _run_export_job_in_pool(job_id):
+    run_export_job(job_id, close_connections=True)
+
+
+def get_executor():
+    """
+    Returns the pool used to run export jobs in the web process, as configured by DAS_EXPORT_EXECUTOR.
+    """
+    global _executor # pylint: disable=global-statement
+    if _executor is None:
+        if settings.DAS_EXPORT_EXECUTOR == 'thread':
+            _executor = ThreadPoolExecutor(max_workers=settings.DAS_EXPORT_MAX_WORKERS)
+        elif settings.DAS_EXPORT_EXECUTOR == 'process':
+            # Spawn instead of fork, so workers don't share the parent's database connections.
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.DAS_EXPORT_MAX_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            )
+        else:
+            raise ImproperlyConfigured('DAS_EXPORT_EXECUTOR must be "thread", "process" or None, not %r.' % (settings.DAS_EXPORT_EXECUTOR,))
+    return _executor
+
+
+def submit_export_job(job):
+    """
+    Queues the given ExportJob for processing.
+
+    If no executor is configured, the job is left pending for the run_export_jobs management command.
+    """
+    if not settings.DAS_EXPORT_EXECUTOR:
+        return
+    # Get the executor now, so a misconfiguration fails the request instead of the commit callback.
+    executor = get_executor()
+    # Wait until the job is committed, otherwise the worker may not see it.
+    transaction.on_commit(lambda: executor.submit(_run_export_job_in_pool, job.id))
+
+
+def get_pk_ranges(qs, shards):
+    """
+    Splits the queryset into the given number of contiguous primary key ranges.
+
+    Returns a list of (lower, upper) tuples, where lower is inclusive and upper is exclusive,
+    except for the last range, whose upper bound is None.
+    Only integer primary keys can be split. Otherwise a single unbounded range is returned.
+    """
+    if qs.model._meta.pk.get_internal_type() not in ('AutoField', 'BigAutoField', 'SmallAutoField', 'IntegerField', 'BigIntegerField'):
+        return [(None, None)]
+    bounds = qs.aggregate(lower=models.Min('pk'), upper=models.Max('pk'))
+    lower, upper = bounds['lower'], bounds['upper']
+    if lower is None:
+        return [(None, None)]
+    step = max(1, int(math.ceil((upper - lower + 1) / float(shards))))
+    ranges = []
+    while lower <= upper:
+        ranges.append((lower, lower + step))
+        lower += step
+    ranges[-1] = (ranges[-1][0], None)
+    return ranges
+
+
+def render_csv_shard(model_label, admin_site, query, raw_headers, pk_range, path, user_id=None):
+    """
+    Renders the records in the given primary key range to a CSV file, without a header.
+
+    Runs in a worker process, so all arguments must be picklable.
+    The records are rendered as requested by the user with the given ID, or an anonymous user.
+
+    Returns a tuple of the form (header_line, written), where header_line is None if the range was empty.
+    """
+    model = apps.get_model(model_label)
+    model_admin = get_csv_model_admin(model, admin_site=admin_site)
+    request = get_export_request(get_user_model()._default_manager.get(pk=user_id) if user_id is not None else None)
+    qs = model._default_manager.all()
+    if query is not None:
+        qs.query = pickle.loads(query)
+    qs = model_admin.get_csv_queryset(request, qs)
+    lower, upper = pk_range
+    if lower is not None:
+        qs = qs.filter(pk__gte=lower)
+    if upper is not None:
+        qs = qs.filter(pk__lt=upper)
+    qs = qs.order_by('pk')
+    if raw_headers is None:
+        raw_headers = model_admin.get_csv_raw_headers(request)
+    header_line = None
+    written = 0
+    with open(path, 'w', encoding='utf-8', newline='') as fout:
+        for i, line in enumerate(model_admin.iter_csv_lines(request, qs, raw_headers, chunk_size=model_admin.csv_chunk_size)):
+            if i:
+                fout.write(line)
+                written += 1
+            else:
+                header_line = line
+    return header_line, written
+
+
+def _render_csv_shard_in_pool(*args):
+    try:
+        return render_csv_shard(*args)
+    finally:
+        connections.close_all()
+
+
+def export_csv_parallel(qs, path, raw_headers=None, workers=None, shards=None, admin_site='admin', user=None):
+    """
+    Exports the queryset to a CSV file by splitting it into primary key ranges,
+    rendering each range in a separate process, and concatenating the results in order.
+
+    If given, the records are rendered as requested by user.
+
+    Returns the number of records written.
+    """
+    workers = workers or os.cpu_count() or 1
+    shards = shards or workers
+    model_label = qs.model._meta.label
+    query = pickle.dumps(qs.query)
+    ranges = get_pk_ranges(qs, shards)
+    shard_paths = ['%s.%i.part' % (path, i) for i in range(len(ranges))]
+    user_id = user.pk if user is not None and user.is_authenticated else None
+    jobs = [(model_label, admin_site, query, raw_headers, pk_range, shard_path, user_id) for pk_range, shard_path in zip(ranges, shard_paths)]
+    try:
+        if workers == 1:
+            results = [render_csv_shard(*job) for job in jobs]
+        else:
+            # The connections can't be shared with the workers, which spawn their own.
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+            ) as executor:
+                results = list(executor.map(_render_csv_shard_in_pool, *zip(*jobs)))
+        written = 0
+        with open(path, 'w', encoding='utf-8', newline='') as fout:
+            header_written = False
+            for (header_line, shard_written), shard_path in zip(results, shard_paths):
+                if header_line is None:
+                    continue
+                if not header_written:
+                    fout.write(header_line)
+                    header_written = True
+                with open(shard_path, 'r', encoding='utf-8', newline='') as fin:
+                    shutil.copyfileobj(fin, fout)
+                written += shard_written
+        return written
+    finally:
+        for shard_path in shard_paths:
+            if os.path.exists(shard_path):
+                os.remove(shard_path)
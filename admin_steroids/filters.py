@@ -1,23 +1,115 @@
+import copy
+import hashlib
+import time
 import uuid
 
 from django.contrib.admin import FieldListFilter, SimpleListFilter, ListFilter
 from django.core.exceptions import ImproperlyConfigured, ValidationError
-from django.urls import reverse
+from django.urls import reverse, NoReverseMatch
 from django.core.cache import cache
-from django.db import models
+from django.db import models, DatabaseError
 from django.db.models import Q
 from django.utils.translation import gettext as _
 from django.utils.encoding import smart_str
 from django.contrib.admin.options import IncorrectLookupParameters
 from django.contrib.auth import get_user_model
 
+from . import utils
+
 
 def get_empty_value_display(cl):
     if hasattr(cl.model_admin, 'get_empty_value_display'):
         return cl.model_admin.get_empty_value_display()
 
 
-class NullListFilter(FieldListFilter):
+# The key of the count of all records in a filter's facet counts, since None is used for null values.
+ALL_COUNT = ('all',)
+
+
+class FacetCountMixin(object):
+    """
+    Adds the number of records matching each choice to a list filter's choices,
+    when enabled with show_counts on the filter or list_filter_counts on the ModelAdmin.
+
+    Counts are computed under the changelist's other filters and search with one query,
+    which is cancelled after count_timeout seconds. If it's cancelled, the last counts computed
+    for the same filters are shown instead, or an estimate if the filter has one, marked with a "~".
+    """
+
+    show_counts = False
+
+    # The most seconds the counting query may run.
+    count_timeout = 0.5
+
+    count_cache_seconds = 300 # 5-minutes
+
+    # How long counts are kept to show when counting is cancelled.
+    stale_count_cache_seconds = 86400 # 1-day
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        self.request = request
+        self.model_admin = model_admin
+        self.model = model
+        super().__init__(field, request, params, model, model_admin, field_path)
+
+    def counts_enabled(self):
+        return self.show_counts or getattr(self.model_admin, 'list_filter_counts', False)
+
+    def get_facet_queryset(self, cl):
+        """
+        Returns the changelist's queryset with every filter applied except this one.
+        """
+        own_params = set(self.expected_parameters())
+        facet_cl = copy.copy(cl)
+        facet_cl.params = {k: v for k, v in cl.params.items() if k not in own_params}
+        return facet_cl.get_queryset(self.request)
+
+    def get_facet_cache_key(self, cl):
+        own_params = set(self.expected_parameters())
+        params = sorted((k, v) for k, v in cl.get_filters_params().items() if k not in own_params)
+        state = (type(self).__name__, self.model._meta.label, self.field_path, params, cl.query)
+        return 'ffc_' + hashlib.sha1(repr(state).encode('utf-8')).hexdigest()
+
+    def compute_facet_counts(self, queryset):
+        """
+        Returns a dict mapping each choice's lookup value to the number of matching records in the queryset.
+        """
+        raise NotImplementedError
+
+    def estimate_facet_counts(self):
+        """
+        Returns a dict of approximate counts to show when counting is cancelled, or None if there's no estimate.
+        """
+
+    def get_facet_counts(self, cl):
+        """
+        Returns a tuple of the counts dict, or None if there are no counts, and whether the counts are approximate.
+        """
+        if not self.counts_enabled():
+            return None, False
+        cache_key = self.get_facet_cache_key(cl)
+        # The counts are kept past count_cache_seconds, to show if recounting is cancelled.
+        cached = cache.get(cache_key)
+        if cached is not None and time.time() - cached['time'] < self.count_cache_seconds:
+            return cached['counts'], False
+        try:
+            queryset = self.get_facet_queryset(cl)
+            with utils.statement_timeout(self.count_timeout, using=queryset.db):
+                counts = self.compute_facet_counts(queryset)
+        except DatabaseError:
+            if cached is not None:
+                return cached['counts'], True
+            return self.estimate_facet_counts(), True
+        cache.set(cache_key, {'counts': counts, 'time': time.time()}, self.stale_count_cache_seconds)
+        return counts, False
+
+    def get_count_display(self, display, counts, approximate, lookup):
+        if counts is None:
+            return display
+        return '%s (%s%s)' % (display, '~' if approximate else '', counts.get(lookup, 0))
+
+
+class NullListFilter(FacetCountMixin, FieldListFilter):
 
     def __init__(self, field, request, params, model, model_admin, field_path):
         self.lookup_kwarg = '%s__isnull' % field_path
@@ -38,19 +130,24 @@ class NullListFilter(FieldListFilter):
             self.lookup_kwarg,
         ]
 
+    def compute_facet_counts(self, queryset):
+        counts = queryset.aggregate(total=models.Count('pk'), omitted=models.Count('pk', filter=Q(**{self.lookup_kwarg: True})))
+        return {None: counts['total'], False: counts['total'] - counts['omitted'], True: counts['omitted']}
+
     def choices(self, cl):
+        counts, approximate = self.get_facet_counts(cl)
         for lookup, title in ((None, _('All')), (False, _('Has value')), (True, _('Omitted'))):
             d = {
                 'selected': self.lookup_val == lookup,
                 'query_string': cl.get_query_string({
                     self.lookup_kwarg: lookup,
                 }, [self.lookup_kwarg]),
-                'display': title,
+                'display': self.get_count_display(title, counts, approximate, lookup),
             }
             yield d
 
 
-class NullBlankListFilter(FieldListFilter):
+class NullBlankListFilter(FacetCountMixin, FieldListFilter):
     """
     Like NullListFilter, but treats None and '' values synonymously.
     """
@@ -89,25 +186,41 @@ class NullBlankListFilter(FieldListFilter):
         except ValidationError as exc:
             raise IncorrectLookupParameters(exc) from exc
 
+    def compute_facet_counts(self, queryset):
+        omitted = Q(**{self.field_path + '__isnull': True}) | Q(**{self.field_path: ''})
+        counts = queryset.aggregate(total=models.Count('pk'), omitted=models.Count('pk', filter=omitted))
+        return {None: counts['total'], False: counts['total'] - counts['omitted'], True: counts['omitted']}
+
     def choices(self, cl):
+        counts, approximate = self.get_facet_counts(cl)
         for lookup, title in ((None, _('All')), (False, _('Has value')), (True, _('Omitted'))):
             d = {
                 'selected': self.lookup_val == lookup,
                 'query_string': cl.get_query_string({
                     self.lookup_kwarg: lookup,
                 }, [self.lookup_kwarg]),
-                'display': title,
+                'display': self.get_count_display(title, counts, approximate, lookup),
             }
             yield d
 
 
-class NotInListFilter(FieldListFilter):
+class NotInListFilter(FacetCountMixin, FieldListFilter):
     """
     Allows the use of exclude(field=value) via the URL.
     The inverse of Django's default "__in=" URL syntax.
+
+    By default, every value of the field is listed. For fields with many values, set max_choices
+    to only list the most used values, and search for the rest with the same Ajax search as AjaxFieldFilter.
     """
 
+    # The most values to list, or None to list them all.
+    max_choices = None
+
+    choices_cache_seconds = 3600 # 1-hour
+
     def __init__(self, field, request, params, model, model_admin, field_path):
+        self.field = field
+        self.field_name = field.name
         self.field_path = field_path
         self.lookup_kwarg = '%s__notin' % field_path
         self.lookup_vals = None
@@ -118,11 +231,64 @@ class NotInListFilter(FieldListFilter):
         except Exception as e:
             pass
 
-        self.lookup_choices = field.get_choices(include_blank=False)
+        self.model = model
+        if self.max_choices is None:
+            self.lookup_choices = field.get_choices(include_blank=False)
+        else:
+            self.lookup_choices = self.get_top_choices()
+            try:
+                self.ajax_url = reverse('model_field_search', args=(model._meta.app_label, model.__name__.lower(), self.field_path))
+                self.uuid = '_' + str(uuid.uuid4())
+                self.template = 'admin_steroids/ajax_filter.html'
+            except NoReverseMatch:
+                # Without the search URL, only the most used values can be selected.
+                pass
         super().__init__(field, request, params, model, model_admin, field_path)
 
         self.title = getattr(field, 'verbose_name', field_path) + ' is not'
 
+    def get_choice_labels(self, values):
+        """
+        Returns a dict mapping each of the field's values to its display label.
+        """
+        if self.field.remote_field:
+            # The values are those of the field the relation targets, which is only the primary key without a to_field.
+            objects = self.field.remote_field.model._default_manager.in_bulk(values, field_name=self.field.target_field.name)
+            return {value: str(obj) for value, obj in objects.items()}
+        if self.field.choices:
+            return {value: label for value, label in self.field.flatchoices if value in values}
+        return {value: str(value) for value in values}
+
+    def get_top_choices(self):
+        """
+        Returns a list of (value, label) tuples for the max_choices most used values of the field, cached,
+        along with any selected values that aren't among them.
+        """
+        cache_key = 'nilf_%s_%s_%s_%s' % (self.model._meta.app_label, self.model._meta.model_name, self.field_path, self.max_choices)
+        choices = cache.get(cache_key)
+        if choices is None:
+            rows = self.model._default_manager.exclude(**{self.field_path + '__isnull': True})\
+                .values_list(self.field_path)\
+                .annotate(count=models.Count('pk'))\
+                .order_by('-count')[:self.max_choices]
+            values = [value for value, _count in rows]
+            labels = self.get_choice_labels(values)
+            choices = [(value, labels.get(value, value)) for value in values]
+            cache.set(cache_key, choices, self.choices_cache_seconds)
+        shown = set(smart_str(value) for value, _label in choices)
+        selected = []
+        for value in self.lookup_vals or ():
+            if value in shown:
+                continue
+            try:
+                selected.append(getattr(self.field, 'target_field', self.field).to_python(value))
+            except ValidationError:
+                pass
+        if selected:
+            labels = self.get_choice_labels(selected)
+            choices = choices + [(value, labels.get(value, value)) for value in selected]
+        return choices
+
     def expected_parameters(self):
         return [self.lookup_kwarg]
 
@@ -135,11 +301,26 @@ class NotInListFilter(FieldListFilter):
         except ValidationError as exc:
             raise IncorrectLookupParameters(exc) from exc
 
+    def compute_facet_counts(self, queryset):
+        # Each choice excludes one value, so its count is the total less the records with that value.
+        # Only the values shown are grouped, so a high-cardinality field isn't aggregated in full.
+        values = [pk_val for pk_val, _val in self.lookup_choices]
+        rows = queryset.filter(**{self.field_path + '__in': values})\
+            .values_list(self.field_path)\
+            .annotate(count=models.Count('pk'))\
+            .order_by()
+        groups = dict(rows)
+        total = queryset.count()
+        counts = {pk_val: total - groups.get(pk_val, 0) for pk_val, _val in self.lookup_choices}
+        counts[None] = total
+        return counts
+
     def choices(self, cl):
+        counts, approximate = self.get_facet_counts(cl)
         yield {
             'selected': self.lookup_vals is None, # and not self.lookup_val_isnull,
             'query_string': cl.get_query_string({}, [self.lookup_kwarg]),
-            'display': _('None'),
+            'display': self.get_count_display(_('None'), counts, approximate, None),
         }
         for pk_val, val in self.lookup_choices:
             yield {
@@ -147,14 +328,17 @@ class NotInListFilter(FieldListFilter):
                 'query_string': cl.get_query_string({
                     self.lookup_kwarg: pk_val,
                 }, []),
-                'display': val,
+                'display': self.get_count_display(val, counts, approximate, pk_val),
             }
 
 
-class CachedFieldFilter(FieldListFilter):
+class CachedFieldFilter(FacetCountMixin, FieldListFilter):
     """
     Caches the choices query from the model, ignoring any other filtering
     on the model.
+
+    If the field is registered with register_distinct_value_index(), the choices are read
+    from the FieldValueCount table instead of scanning the model's table.
     """
 
     cache_seconds = 3600 # 1-hour
@@ -173,38 +357,63 @@ class CachedFieldFilter(FieldListFilter):
     def expected_parameters(self):
         return [self.lookup_kwarg, self.lookup_kwarg2]
 
-    def choices(self, cl):
-        # Query cached choices.
+    def get_value_counts(self):
+        """
+        Returns a list of (value, count) tuples for every distinct value of the field, ordered by value.
+        """
+        from .models import FieldValueCount, get_distinct_value_cache_key, has_distinct_value_index # pylint: disable=import-outside-toplevel
+
         # Note, this purposefully gets a distinct set from the global
         # set of values, so that when we cache it, it's valid for all
         # admin queries. Yes, it may include some values that will return
         # no results on some pages, but that's an acceptable trade-off for
         # being able to shave off a lot of query time.
-        cache_key = 'cff_%s_%s' \
-            % (str(self.model).split("'")[1], self.field_name)
+        cache_key = get_distinct_value_cache_key(self.model, self.field_name)
         values = cache.get(cache_key)
         if values is None:
-            values = self.model.objects.all()\
-                .values_list(self.field_name, flat=True)\
-                .distinct().order_by(self.field_name)
+            if has_distinct_value_index(self.model, self.field_name):
+                values = FieldValueCount.objects.get_values(self.model, self.field_name)
+            else:
+                values = list(
+                    self.model.objects.all()\
+                    .values_list(self.field_name)\
+                    .annotate(count=models.Count('*'))\
+                    .order_by(self.field_name)
+                )
             cache.set(cache_key, values, self.cache_seconds)
+        return values
+
+    def compute_facet_counts(self, queryset):
+        counts = dict(queryset.values_list(self.field_path).annotate(count=models.Count('pk')).order_by())
+        counts[ALL_COUNT] = sum(counts.values())
+        return counts
+
+    def estimate_facet_counts(self):
+        # Fall back to the cached counts across all records.
+        counts = dict(self.get_value_counts())
+        counts[ALL_COUNT] = sum(counts.values())
+        return counts
+
+    def choices(self, cl):
+        values = self.get_value_counts()
+        counts, approximate = self.get_facet_counts(cl)
 
         yield {
             'selected': self.lookup_val is None and self.lookup_val2 is None,
             'query_string': cl.get_query_string({
                 self.lookup_kwarg2: '',
             }, [self.lookup_kwarg]),
-            'display': _('All'),
+            'display': self.get_count_display(_('All'), counts, approximate, ALL_COUNT),
         }
 
-        for value in values:
+        for value, _count in values:
             if value is None:
                 yield {
                     'selected': self.lookup_val2,
                     'query_string': cl.get_query_string({
                         self.lookup_kwarg: value,
                     }, [self.lookup_kwarg2]),
-                    'display': value,
+                    'display': self.get_count_display(value, counts, approximate, value),
                 }
             else:
                 yield {
@@ -212,7 +421,7 @@ class CachedFieldFilter(FieldListFilter):
                     'query_string': cl.get_query_string({
                         self.lookup_kwarg: value,
                     }, [self.lookup_kwarg2]),
-                    'display': value,
+                    'display': self.get_count_display(value, counts, approximate, value),
                 }
 
 
@@ -224,6 +433,8 @@ class AjaxFieldFilter(FieldListFilter):
 
     template = 'admin_steroids/ajax_filter.html'
 
+    label_cache_seconds = 60 # 1-minute
+
     #TODO:specify one-only or multiple
     def __init__(self, field, request, params, model, model_admin, field_path):
         self.field_name = field.name
@@ -245,7 +456,7 @@ class AjaxFieldFilter(FieldListFilter):
         #            self.base_url += '&'
         #        self.base_url += self.lookup_kwarg + '='
 
-        self.ajax_url = reverse('model_field_search', args=(model._meta.app_label, model.__name__.lower(), self.field_name))
+        self.ajax_url = reverse('model_field_search', args=(model._meta.app_label, model.__name__.lower(), self.field_path))
 
 
 #    def __call__(self, *args, **kwargs):
@@ -258,7 +469,54 @@ class AjaxFieldFilter(FieldListFilter):
     def values(self):
         return self.lookup_val
 
+    def get_value_labels(self, values):
+        """
+        Returns a dict mapping each of the given values to the "pretty" display value of the related record it refers to.
+
+        Labels are loaded with a single query and cached per record for label_cache_seconds.
+        Values that don't refer to a record are left out.
+        """
+        if not isinstance(self.field, (
+            models.ForeignKey,
+            models.ManyToManyField,
+            models.OneToOneField,
+        )):
+            return {}
+        rel_model = self.field.remote_field.model
+        target_field = getattr(self.field, 'target_field', rel_model._meta.pk)
+        # Keyed by the given value, since different values, such as '5' and 5, may refer to the same record.
+        keys = {}
+        for value in values:
+            try:
+                pk = target_field.to_python(value)
+            except ValidationError:
+                continue
+            if pk is not None:
+                keys[value] = ('afl_%s_%s' % (rel_model._meta.label_lower, hashlib.sha1(smart_str(pk).encode('utf-8')).hexdigest()), pk)
+        labels = {}
+        cached = cache.get_many(list(set(key for key, _pk in keys.values())))
+        missing = {}
+        for value, (key, pk) in keys.items():
+            if key not in cached:
+                missing[value] = (key, pk)
+            elif cached[key] is not None:
+                labels[value] = cached[key]
+        if missing:
+            try:
+                objects = rel_model._default_manager.in_bulk(list(set(pk for _key, pk in missing.values())), field_name=target_field.name)
+            except (ValueError, TypeError):
+                objects = {}
+            # Values without a record are cached as None, so they aren't looked up again.
+            new_labels = {}
+            for value, (key, pk) in missing.items():
+                new_labels[key] = None
+                if pk in objects:
+                    labels[value] = new_labels[key] = str(objects[pk])
+            cache.set_many(new_labels, self.label_cache_seconds)
+        return labels
+
     def choices(self, cl):
+        labels = self.get_value_labels(self.values)
         # Note, all these choices are for *deselecting* the value.
         # Additions will be handled dynamically via AJAX.
         yield {
@@ -286,24 +544,10 @@ class AjaxFieldFilter(FieldListFilter):
                     remove=[self.lookup_kwarg],
                 )
 
-            # Lookup the "pretty" display value for IDs of related models.
-            if isinstance(self.field, (
-                models.ForeignKey,
-                models.ManyToManyField,
-                models.OneToOneField,
-            )):
-                rel_model = self.field.remote_field.model
-                #TODO:handle non-numeric IDs?
-                # AvB edit here; some FK models do not have an (integer) or .id attribute!
-                #value = str(rel_model.objects.get(id=int(value)))
-                if value.isdigit():
-                    value = int(value)
-                value = str(rel_model.objects.get(pk=value))
-
             yield {
                 'selected': True,
                 'query_string': url,
-                'display': value,
+                'display': labels.get(value, value),
                 'remove_icon': True,
                 'alt': 'Remove',
             }
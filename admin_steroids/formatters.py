@@ -1,5 +1,7 @@
 import re
 
+from django.db import models
+from django.db.models import prefetch_related_objects
 from django.urls import reverse
 from django.utils.safestring import SafeString
 from django.conf import settings
@@ -9,6 +11,20 @@ from . import utils
 NONE_STR = '(None)'
 
 
+def prepare_formatters(formatters, objects):
+    """
+    Calls prepare() on each formatter in the list with the given objects.
+
+    Items that aren't formatters, like field names, are ignored.
+    """
+    objects = list(objects)
+    if not objects:
+        return
+    for formatter in formatters:
+        if isinstance(formatter, AdminFieldFormatter):
+            formatter.prepare(objects)
+
+
 class AdminFieldFormatter(object):
     """
     Base class for controlling the display formatting of field values
@@ -61,6 +77,22 @@ class AdminFieldFormatter(object):
     def format(self, v, plaintext=False):
         return v
 
+    def prepare(self, objects):
+        """
+        Called with all the objects about to be formatted, such as a changelist page
+        or a chunk of an export, before formatting any of them.
+
+        Override to bulk load whatever the formatter needs, instead of querying once per object.
+        """
+
+    def format_many(self, objects, plaintext=False):
+        """
+        Formats a batch of objects, returning a list of the formatted values.
+        """
+        objects = list(objects)
+        self.prepare(objects)
+        return [self(obj, plaintext=plaintext) for obj in objects]
+
     def plaintext(self, *args, **kwargs):
         """
         Called when no HTML is desired.
@@ -235,6 +267,15 @@ class ForeignKeyLink(AdminFieldFormatter):
 
     null = True
 
+    def prepare(self, objects):
+        # Load the related objects for the whole batch in one query.
+        if objects and all(isinstance(obj, models.Model) for obj in objects):
+            try:
+                prefetch_related_objects(objects, self.name)
+            except (AttributeError, ValueError):
+                # The name doesn't refer to a relation, so there's nothing to prefetch.
+                pass
+
     def format(self, v, plaintext=False):
         try:
             assert self.template_type in ('button', 'raw'), 'Invalid template type: %s' % (self.template_type)
@@ -266,6 +307,15 @@ class OneToManyLink(AdminFieldFormatter):
 
     target = '_blank'
 
+    def prepare(self, objects):
+        # Count the related records for the whole batch in one grouped query.
+        if objects and all(isinstance(obj, models.Model) for obj in objects):
+            try:
+                utils.prefetch_related_counts(objects, self.name)
+            except ValueError:
+                # The name doesn't refer to a related manager, so each value is formatted as is.
+                pass
+
     def format(self, obj):
         try:
             url = None
@@ -274,8 +324,18 @@ class OneToManyLink(AdminFieldFormatter):
                 url = '{0}?{1}={2}'.format(url, self.id_param, obj.id)
             except Exception:
                 pass
+            cached = utils.get_related_count(obj, self.name)
             q = count = getattr(obj, self.name)
-            if hasattr(q, 'count'):
+            if cached:
+                count, link_pk = cached
+                link_model = q.model
+                if count == 1:
+                    # Link directly to the record if only one result.
+                    url = utils.get_admin_change_url(link_model(pk=link_pk))
+                elif count > 1:
+                    url = utils.get_admin_changelist_url(link_model)
+                    url += '?{0}={1}'.format(self.id_param, obj.id)
+            elif hasattr(q, 'count'):
                 q = q.all()
                 count = q.count()
                 if count == 1:
@@ -283,8 +343,8 @@ class OneToManyLink(AdminFieldFormatter):
                     link_obj = q[0]
                     url = utils.get_admin_change_url(link_obj)
                 elif count > 1:
-                    url = utils.get_admin_changelist_url(q[0])
-                    url += '?{1}={2}'.format(self.id_param, obj.id)
+                    url = utils.get_admin_changelist_url(q.model)
+                    url += '?{0}={1}'.format(self.id_param, obj.id)
             if not count:
                 return count
             return ('<a href="%s" target="%s"><input type="button" ' + \
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from admin_steroids.search import get_search_backends
+
+
+class Command(BaseCommand):
+    help = 'Creates the database indexes used by search backends registered with register_search_backend().'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drop', action='store_true', default=False, help='Removes the indexes instead of creating them.')
+
+    def handle(self, *args, **options):
+        for backend in get_search_backends():
+            if not hasattr(backend, 'create_index'):
+                continue
+            label = '%s.%s' % (backend.model._meta.label, backend.field_name)
+            if not backend.is_supported():
+                print('Skipped %s, which is not on a %s database.' % (label, backend.vendor))
+            elif options['drop']:
+                backend.drop_index()
+                print('Dropped the search index for %s.' % label)
+            else:
+                backend.create_index()
+                print('Created the search index for %s.' % label)
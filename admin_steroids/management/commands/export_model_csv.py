@@ -0,0 +1,41 @@
+import time
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from admin_steroids.exports import export_csv_parallel
+
+
+class Command(BaseCommand):
+    help = 'Exports all records of a model to a CSV file, rendering primary key ranges in parallel worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The model to export, in the form app_label.ModelName.')
+        parser.add_argument('--output', default=None, help='The file to write. Defaults to <model>.csv in the current directory.')
+        parser.add_argument('--workers', type=int, default=None, help='The number of worker processes. Defaults to the number of CPUs.')
+        parser.add_argument('--shards', type=int, default=None, help='The number of primary key ranges. Defaults to the number of workers.')
+        parser.add_argument('--headers', default=None, help='Comma-delimited headers. Defaults to those of the registered ModelAdmin.')
+        parser.add_argument('--admin-site', default='admin', help='The name of the admin site whose ModelAdmin renders the records.')
+        parser.add_argument('--username', default=None, help='The user the records are rendered for. Defaults to an anonymous user.')
+
+    def handle(self, *args, **options):
+        model = apps.get_model(options['model'])
+        path = options['output'] or '%s.csv' % model._meta.model_name
+        raw_headers = None
+        if options['headers']:
+            raw_headers = [_.strip() for _ in options['headers'].split(',') if _.strip()]
+        user = None
+        if options['username']:
+            user = get_user_model()._default_manager.get_by_natural_key(options['username'])
+        t0 = time.time()
+        written = export_csv_parallel(
+            model._default_manager.all(),
+            path,
+            raw_headers=raw_headers,
+            workers=options['workers'],
+            shards=options['shards'],
+            admin_site=options['admin_site'],
+            user=user,
+        )
+        print('Wrote %i records to %s in %.1f seconds.' % (written, path, time.time() - t0))
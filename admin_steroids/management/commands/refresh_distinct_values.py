@@ -0,0 +1,49 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from admin_steroids.models import FieldValueCount, get_distinct_value_indexes, get_row_counters
+
+
+class Command(BaseCommand):
+    help = 'Recounts the distinct values of fields registered with register_distinct_value_index(), ' \
+        'and the rows of models registered with register_row_counter().'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'fields',
+            nargs='*',
+            help='Specific fields to recount, as app_label.Model.field, or models, as app_label.Model. '
+            'If none are given, all registered fields and models are recounted.'
+        )
+
+    def handle(self, *args, **options):
+        indexes = get_distinct_value_indexes()
+        row_counters = get_row_counters()
+        if options['fields']:
+            selected = []
+            selected_models = []
+            for name in options['fields']:
+                try:
+                    parts = name.split('.')
+                    if len(parts) not in (2, 3):
+                        raise ValueError('Expected app_label.Model or app_label.Model.field.')
+                    model = apps.get_model(parts[0], parts[1])
+                except (ValueError, LookupError) as exc:
+                    raise CommandError('Invalid field %r: %s' % (name, exc)) from exc
+                if len(parts) == 2:
+                    if model not in row_counters:
+                        raise CommandError('The model %s is not registered with register_row_counter().' % name)
+                    selected_models.append(model)
+                    continue
+                field_name = parts[2]
+                if (model, field_name) not in indexes:
+                    raise CommandError('The field %s is not registered with register_distinct_value_index().' % name)
+                selected.append((model, field_name))
+            indexes = selected
+            row_counters = selected_models
+        for model in row_counters:
+            FieldValueCount.objects.rebuild_rows(model)
+            print('Recounted %s.' % model._meta.label)
+        for model, field_name in indexes:
+            FieldValueCount.objects.rebuild(model, field_name)
+            print('Recounted %s.%s.' % (model._meta.label, field_name))
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from admin_steroids.exports import run_export_job
+from admin_steroids.models import ExportJob
+
+
+class Command(BaseCommand):
+    help = 'Writes the files for all pending export jobs to the spool directory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help='Specific export job IDs to run.')
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            default=False,
+            help='If given, resumes failed or interrupted jobs from their last checkpoint instead of running pending jobs.'
+        )
+        parser.add_argument(
+            '--poll', type=int, default=0, help='If given, runs forever, checking for new pending jobs after waiting this many seconds.'
+        )
+
+    def handle(self, *args, **options):
+        while 1:
+            if options['resume']:
+                qs = ExportJob.objects.filter(status__in=[ExportJob.RUNNING, ExportJob.FAILED]).order_by('created')
+            else:
+                qs = ExportJob.objects.filter(status=ExportJob.PENDING).order_by('created')
+            if options['ids']:
+                qs = qs.filter(id__in=options['ids'])
+            for job_id in qs.values_list('id', flat=True):
+                print('Running export job %i...' % job_id)
+                if not run_export_job(job_id, resume=options['resume']):
+                    print('Export job %i was skipped, since another worker is running it.' % job_id)
+                    continue
+                job = ExportJob.objects.get(id=job_id)
+                print('Export job %i %s with %i records written.' % (job.id, job.get_status_display().lower(), job.written))
+            if not options['poll']:
+                break
+            time.sleep(options['poll'])
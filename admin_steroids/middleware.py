@@ -0,0 +1,15 @@
+from . import utils
+
+
+class ObjectCacheMiddleware(object):
+    """
+    Shares one identity map of records across each request, so widgets linking to the same
+    related records, like the raw id fields in an inline formset, load each one at most once.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with utils.object_cache():
+            return self.get_response(request)
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 16:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin_steroids', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='file_offset',
+            field=models.BigIntegerField(default=0, help_text='The size of the partial file after the last record written.'),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='last_pk',
+            field=models.CharField(blank=True, help_text='The primary key of the last record written.', max_length=255),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-17 17:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('admin_steroids', '0002_export_job_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FieldValueCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field_name', models.CharField(max_length=100)),
+                ('value', models.CharField(blank=True, max_length=255, null=True)),
+                ('count', models.BigIntegerField(default=0)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='fieldvaluecount',
+            index=models.Index(fields=['content_type', 'field_name', 'value'], name='admin_stero_content_fe1839_idx'),
+        ),
+    ]
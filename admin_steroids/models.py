@@ -1,3 +1,14 @@
+import os
+
+from six.moves import cPickle as pickle
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connections, models, router, transaction
+from django.template.defaultfilters import slugify
+from django.urls import reverse
+
 # Just here so our default settings are inserted into django.conf.settings.
 from . import settings as _settings # pylint: disable=unused-import
 
@@ -11,3 +22,379 @@ def register_modelsearcher(app_label, model_name, field_name, cb):
 
 def get_modelsearcher(app_label, model_name, field_name):
     return _modelsearch_callbacks.get((app_label.lower(), model_name.lower(), field_name.lower()))
+
+
+# {(model, field_name)}
+_distinct_value_indexes = set()
+
+
+def get_distinct_value_cache_key(model, field_name):
+    return 'cff_%s_%s_%s' % (model._meta.app_label, model._meta.model_name, field_name)
+
+
+def register_distinct_value_index(model, field_name):
+    """
+    Maintains the count of each distinct value of the model's field in the FieldValueCount table,
+    so list filters can read the values without scanning the model's table.
+
+    Counts are updated as records are saved or deleted. Changes that bypass signals, like
+    update() or bulk_create(), are picked up by running the refresh_distinct_values command.
+
+    Values are stored in a CharField of FieldValueCount.value_max_length characters, so fields
+    whose values can be longer, like a TextField, can't be registered.
+    """
+    field = model._meta.get_field(field_name)
+    max_length = getattr(field, 'max_length', None)
+    if field.get_internal_type() in ('TextField', 'JSONField', 'BinaryField') \
+            or (isinstance(field, models.CharField) and (max_length is None or max_length > FieldValueCount.value_max_length)):
+        raise ValueError('%s.%s can have values longer than %i characters, so its distinct values can\'t be counted.' % (
+            model.__name__, field_name, FieldValueCount.value_max_length
+        ))
+    _distinct_value_indexes.add((model, field_name))
+    models.signals.post_init.connect(_remember_distinct_values, sender=model, dispatch_uid='distinct_values_post_init')
+    models.signals.post_save.connect(_count_saved_distinct_values, sender=model, dispatch_uid='distinct_values_post_save')
+    models.signals.post_delete.connect(_count_deleted_distinct_values, sender=model, dispatch_uid='distinct_values_post_delete')
+
+
+def has_distinct_value_index(model, field_name):
+    return (model, field_name) in _distinct_value_indexes
+
+
+def get_distinct_value_indexes():
+    return sorted(_distinct_value_indexes, key=lambda key: (key[0]._meta.label, key[1]))
+
+
+def _get_indexed_fields(model):
+    return [model._meta.get_field(field_name) for indexed_model, field_name in _distinct_value_indexes if indexed_model is model]
+
+
+def _remember_distinct_values(sender, instance, **kwargs):
+    # Remember the values loaded from the database, so a save can move a count from the old value to the new one.
+    instance.__dict__['_distinct_values'] = {
+        field.attname: instance.__dict__.get(field.attname) for field in _get_indexed_fields(sender) if field.attname in instance.__dict__
+    }
+
+
+def _count_saved_distinct_values(sender, instance, created, raw=False, **kwargs):
+    old_values = {} if created else instance.__dict__.get('_distinct_values', {})
+    for field in _get_indexed_fields(sender):
+        new_value = getattr(instance, field.attname)
+        if not created:
+            if field.attname not in old_values:
+                # The original value wasn't loaded, so the counts can't be moved until the next refresh.
+                continue
+            if old_values[field.attname] == new_value:
+                continue
+            FieldValueCount.objects.add(sender, field.name, old_values[field.attname], -1)
+        FieldValueCount.objects.add(sender, field.name, new_value, 1)
+    _remember_distinct_values(sender, instance)
+
+
+def _count_deleted_distinct_values(sender, instance, **kwargs):
+    old_values = instance.__dict__.get('_distinct_values', {})
+    for field in _get_indexed_fields(sender):
+        FieldValueCount.objects.add(sender, field.name, old_values.get(field.attname, getattr(instance, field.attname)), -1)
+
+
+# The FieldValueCount.field_name of a model's total row count.
+ROW_COUNT_FIELD_NAME = '*'
+
+# {model: whether the count is kept by database triggers instead of signals}
+_row_counters = {}
+
+
+def register_row_counter(model, field_names=(), triggers=False):
+    """
+    Maintains the model's total row count in the FieldValueCount table, so ApproxCountQuerySet
+    and CachedCountQuerySet can return it exactly without running COUNT(*).
+
+    Each of the field_names is also registered with register_distinct_value_index(), so querysets
+    filtered on the values of one of those fields are counted the same way. Use it for low-cardinality
+    fields, like a status.
+
+    The count is kept by signals, which miss bulk_create() and raw SQL, or if triggers is true, by database
+    triggers, which don't. Counts of field values are only kept by signals, which also miss QuerySet.update(),
+    so field_names can't be combined with triggers. The count isn't used until the refresh_distinct_values
+    command first counts the rows, which also creates the triggers.
+    """
+    if triggers and field_names:
+        raise ValueError('The counts of field values are kept by signals, so they can\'t be combined with triggers.')
+    _row_counters[model] = triggers
+    if not triggers:
+        models.signals.post_save.connect(_count_saved_row, sender=model, dispatch_uid='row_counter_post_save')
+        models.signals.post_delete.connect(_count_deleted_row, sender=model, dispatch_uid='row_counter_post_delete')
+    for field_name in field_names:
+        register_distinct_value_index(model, field_name)
+
+
+def has_row_counter(model):
+    return model in _row_counters
+
+
+def get_row_counters():
+    return sorted(_row_counters, key=lambda model: model._meta.label)
+
+
+def _count_saved_row(sender, instance, created, raw=False, **kwargs):
+    if created and _row_counters.get(sender) is False:
+        FieldValueCount.objects.add_rows(sender, 1)
+
+
+def _count_deleted_row(sender, instance, **kwargs):
+    if _row_counters.get(sender) is False:
+        FieldValueCount.objects.add_rows(sender, -1)
+
+
+class FieldValueCountManager(models.Manager):
+
+    def _get_value_str(self, value):
+        if value is None:
+            return None
+        return str(value)
+
+    def add(self, model, field_name, value, n):
+        """
+        Adds n to the count of records whose field has the given value.
+        """
+        manager = self.db_manager(router.db_for_write(self.model))
+        content_type = ContentType.objects.get_for_model(model)
+        value = self._get_value_str(value)
+        updated = manager.filter(content_type=content_type, field_name=field_name, value=value)\
+            .update(count=models.F('count') + n)
+        if not updated and n > 0:
+            manager.create(content_type=content_type, field_name=field_name, value=value, count=n)
+        cache.delete(get_distinct_value_cache_key(model, field_name))
+
+    def get_values(self, model, field_name):
+        """
+        Returns a list of (value, count) tuples for each distinct value of the model's field, ordered by value.
+        """
+        field = model._meta.get_field(field_name)
+        content_type = ContentType.objects.get_for_model(model)
+        rows = self.filter(content_type=content_type, field_name=field_name)\
+            .values_list('value')\
+            .annotate(total=models.Sum('count'))\
+            .filter(total__gt=0)\
+            .order_by()
+        values = [(None if value is None else field.to_python(value), count) for value, count in rows]
+        # Nulls are listed first, as they are by an ordered query.
+        return sorted(values, key=lambda row: (row[0] is not None, row[0]))
+
+    def add_rows(self, model, n):
+        """
+        Adds n to the model's row count, once it has been counted by rebuild_rows().
+        """
+        manager = self.db_manager(router.db_for_write(self.model))
+        content_type = ContentType.objects.get_for_model(model)
+        manager.filter(content_type=content_type, field_name=ROW_COUNT_FIELD_NAME).update(count=models.F('count') + n)
+
+    def get_count(self, model, field_name=ROW_COUNT_FIELD_NAME, values=None):
+        """
+        Returns the model's row count, or if a field is given, the number of rows whose field has one of the values.
+
+        Returns None if the rows haven't been counted by rebuild_rows().
+        """
+        content_type = ContentType.objects.get_for_model(model)
+        qs = self.filter(content_type=content_type, field_name=field_name)
+        if field_name == ROW_COUNT_FIELD_NAME:
+            return qs.values_list('count', flat=True).first()
+        if not has_distinct_value_index(model, field_name) or self.get_count(model) is None:
+            return None
+        values = [self._get_value_str(value) for value in values]
+        lookup = models.Q(value__in=[value for value in values if value is not None])
+        if None in values:
+            lookup |= models.Q(value__isnull=True)
+        return qs.filter(lookup).aggregate(total=models.Sum('count'))['total'] or 0
+
+    def get_row_count_trigger_sql(self, model, using):
+        """
+        Returns a list of SQL statements creating triggers that keep the model's row count.
+        """
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table = model._meta.db_table
+        params = dict(
+            name=qn('%s_row_count' % table),
+            table=qn(table),
+            counts=qn(self.model._meta.db_table),
+            count=qn('count'),
+            content_type_id=ContentType.objects.get_for_model(model).id,
+            field_name=ROW_COUNT_FIELD_NAME,
+        )
+        update = "UPDATE %(counts)s SET %(count)s = %(count)s %%s 1 WHERE content_type_id = %(content_type_id)i AND field_name = '%(field_name)s'" % params
+        params.update(increment=update % '+', decrement=update % '-')
+        if connection.vendor == 'postgresql':
+            return [
+                "CREATE OR REPLACE FUNCTION %(name)s() RETURNS trigger AS $$ BEGIN "
+                "IF TG_OP = 'INSERT' THEN %(increment)s; ELSE %(decrement)s; END IF; RETURN NULL; "
+                "END $$ LANGUAGE plpgsql" % params,
+                "DROP TRIGGER IF EXISTS %(name)s ON %(table)s" % params,
+                "CREATE TRIGGER %(name)s AFTER INSERT OR DELETE ON %(table)s FOR EACH ROW EXECUTE PROCEDURE %(name)s()" % params,
+            ]
+        params.update(insert_name=qn('%s_row_count_ai' % table), delete_name=qn('%s_row_count_ad' % table))
+        if connection.vendor == 'mysql':
+            return [
+                "DROP TRIGGER IF EXISTS %(insert_name)s" % params,
+                "CREATE TRIGGER %(insert_name)s AFTER INSERT ON %(table)s FOR EACH ROW %(increment)s" % params,
+                "DROP TRIGGER IF EXISTS %(delete_name)s" % params,
+                "CREATE TRIGGER %(delete_name)s AFTER DELETE ON %(table)s FOR EACH ROW %(decrement)s" % params,
+            ]
+        if connection.vendor == 'sqlite':
+            return [
+                "CREATE TRIGGER IF NOT EXISTS %(insert_name)s AFTER INSERT ON %(table)s BEGIN %(increment)s; END" % params,
+                "CREATE TRIGGER IF NOT EXISTS %(delete_name)s AFTER DELETE ON %(table)s BEGIN %(decrement)s; END" % params,
+            ]
+        raise NotImplementedError('Row count triggers are not supported on %s.' % connection.vendor)
+
+    def rebuild_rows(self, model):
+        """
+        Recounts the rows of the model's table, creating its triggers if the count is kept by them.
+        """
+        using = router.db_for_write(model)
+        content_type = ContentType.objects.get_for_model(model)
+        with transaction.atomic(using=using):
+            if _row_counters.get(model):
+                with connections[using].cursor() as cursor:
+                    for sql in self.get_row_count_trigger_sql(model, using):
+                        cursor.execute(sql)
+            self.filter(content_type=content_type, field_name=ROW_COUNT_FIELD_NAME).delete()
+            self.create(content_type=content_type, field_name=ROW_COUNT_FIELD_NAME, count=model._default_manager.using(using).count())
+
+    def rebuild(self, model, field_name):
+        """
+        Recounts every distinct value of the model's field from the model's table.
+        """
+        using = router.db_for_write(model)
+        field = model._meta.get_field(field_name)
+        content_type = ContentType.objects.get_for_model(model)
+        with transaction.atomic(using=using):
+            self.filter(content_type=content_type, field_name=field_name).delete()
+            rows = model._default_manager.using(using).values_list(field.attname).annotate(count=models.Count('*')).order_by()
+            self.bulk_create([
+                self.model(content_type=content_type, field_name=field_name, value=self._get_value_str(value), count=count) for value, count in rows
+            ])
+        cache.delete(get_distinct_value_cache_key(model, field_name))
+
+
+class FieldValueCount(models.Model):
+    """
+    The number of records having one distinct value of a field registered with register_distinct_value_index(),
+    or with a field_name of "*", the total number of records of a model registered with register_row_counter().
+    """
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+
+    field_name = models.CharField(max_length=100)
+
+    value_max_length = 255
+
+    # The value's string form, converted back with the field's to_python().
+    value = models.CharField(max_length=value_max_length, blank=True, null=True)
+
+    count = models.BigIntegerField(default=0)
+
+    objects = FieldValueCountManager()
+
+    class Meta:
+        indexes = [models.Index(fields=['content_type', 'field_name', 'value'])]
+
+    def __str__(self):
+        return '%s.%s=%s' % (self.content_type, self.field_name, self.value)
+
+
+class ExportJob(models.Model):
+    """
+    A request to export a queryset to a file in the spool directory,
+    processed outside of the admin request that created it.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+
+    # The name of the AdminSite whose ModelAdmin renders the export.
+    admin_site = models.CharField(max_length=100, default='admin')
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.SET_NULL)
+
+    # The pickled Query of the queryset to export.
+    query = models.BinaryField()
+
+    # The pickled list of raw headers. If null, the ModelAdmin's default headers are used.
+    headers = models.BinaryField(blank=True, null=True)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+
+    filename = models.CharField(max_length=255, blank=True)
+
+    written = models.PositiveIntegerField(default=0, help_text='The number of records written so far.')
+
+    # The checkpoint of the last completed chunk, so an interrupted job can be resumed.
+    last_pk = models.CharField(max_length=255, blank=True, help_text='The primary key of the last record written.')
+
+    file_offset = models.BigIntegerField(default=0, help_text='The size of the partial file after the last record written.')
+
+    error = models.TextField(blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    started = models.DateTimeField(blank=True, null=True)
+
+    # Updated with each checkpoint, so a job still running isn't taken over by a resume.
+    heartbeat = models.DateTimeField(blank=True, null=True)
+
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ('-created',)
+
+    def __str__(self):
+        return '%s export %s' % (self.content_type, self.id)
+
+    @classmethod
+    def create_for_queryset(cls, qs, raw_headers=None, user=None, admin_site='admin'):
+        headers = None
+        if raw_headers is not None:
+            try:
+                headers = pickle.dumps(list(raw_headers))
+            except (pickle.PicklingError, AttributeError, TypeError):
+                # Headers like formatters with lambdas can't be pickled,
+                # so fall back to the ModelAdmin's defaults.
+                headers = None
+        return cls.objects.create(
+            content_type=ContentType.objects.get_for_model(qs.model, for_concrete_model=False),
+            admin_site=admin_site,
+            user=user if user is not None and user.is_authenticated else None,
+            query=pickle.dumps(qs.query),
+            headers=headers,
+        )
+
+    def get_queryset(self):
+        model = self.content_type.model_class()
+        qs = model._default_manager.all()
+        qs.query = pickle.loads(bytes(self.query))
+        return qs
+
+    def get_raw_headers(self):
+        if self.headers is None:
+            return
+        return pickle.loads(bytes(self.headers))
+
+    def get_filename(self):
+        return '%s-%s.csv' % (slugify(self.content_type.model), self.id)
+
+    @property
+    def path(self):
+        return os.path.join(settings.DAS_EXPORT_SPOOL_DIR, self.filename or self.get_filename())
+
+    def get_download_url(self):
+        return reverse('export_job_download', args=(self.id,))
@@ -1,23 +1,54 @@
 import csv
+import functools
+import itertools
+import operator
+import tempfile
 from inspect import isclass
 
 from django.contrib import admin
 from django.contrib.admin.sites import site
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models.query import ModelIterable, QuerySet
 from django.forms.models import ModelForm
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.template.defaultfilters import slugify
+from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
 
 import six
 
+from .formatters import prepare_formatters
+from .serializers import get_serializer
 from .utils import get_admin_change_url
 from . import widgets as w
 from . import utils
 from . import filters
 
 
+class FormatterChangeList(ChangeList):
+    """
+    Lets the formatters in list_display bulk load their data for the whole page.
+    """
+
+    def get_results(self, request):
+        super().get_results(request)
+        # Set when the count came from ApproxCountQuerySet's estimate, so the paginator can show "about N".
+        self.result_count_is_estimate = getattr(self.paginator.object_list, 'count_is_estimate', False)
+        prepare_formatters(self.list_display, self.result_list)
+        for field_name in getattr(self.model_admin, 'list_prefetch_related_counts', ()):
+            utils.prefetch_related_counts(self.result_list, field_name)
+
+
 class BaseModelAdmin(admin.ModelAdmin):
 
+    # Reverse ForeignKey or ManyToMany accessor names whose related record counts are loaded
+    # for each changelist page in one query, for use by utils.view_related_link().
+    list_prefetch_related_counts = ()
+
+    def get_changelist(self, request, **kwargs):
+        return FormatterChangeList
+
     # Cleanup the breadcrumbs on the changelist page.
     def changelist_view(self, request, extra_context=None):
         extra_context = extra_context or {}
@@ -31,6 +62,17 @@ class BaseModelAdmin(admin.ModelAdmin):
         return super().delete_view(request, object_id, extra_context)
 
 
+class EstimatedPaginationMixin(object):
+    """
+    Shows the result counts estimated by ApproxCountQuerySet as "about N" on a BaseModelAdmin's changelist.
+
+    This replaces Django's per-app and per-model change_list.html lookup, so a custom template should
+    instead extend admin_steroids/change_list.html, or use the estimated_pagination tag.
+    """
+
+    change_list_template = 'admin_steroids/change_list.html'
+
+
 # Based on http://djangosnippets.org/snippets/2217/.
 class BetterRawIdFieldsModelAdmin(BaseModelAdmin):
     """
@@ -40,6 +82,9 @@ class BetterRawIdFieldsModelAdmin(BaseModelAdmin):
 
     raw_id_fields_new_tab = True
 
+    # The most records labelled in a ManyToMany raw id field before the rest are summarized.
+    raw_id_fields_max_labels = None
+
     def formfield_for_dbfield(self, db_field, **kwargs):
         if db_field.name in self.raw_id_fields:
             kwargs.pop("request", None)
@@ -47,7 +92,9 @@ class BetterRawIdFieldsModelAdmin(BaseModelAdmin):
             if typ in ("ManyToOneRel", "OneToOneRel"):
                 kwargs['widget'] = w.VerboseForeignKeyRawIdWidget(db_field.remote_field, site, raw_id_fields_new_tab=self.raw_id_fields_new_tab)
             elif typ == "ManyToManyRel":
-                kwargs['widget'] = w.VerboseManyToManyRawIdWidget(db_field.remote_field, site, raw_id_fields_new_tab=self.raw_id_fields_new_tab)
+                kwargs['widget'] = w.VerboseManyToManyRawIdWidget(
+                    db_field.remote_field, site, raw_id_fields_new_tab=self.raw_id_fields_new_tab, max_labels=self.raw_id_fields_max_labels
+                )
             return db_field.formfield(**kwargs)
         return super().formfield_for_dbfield(db_field, **kwargs)
 
@@ -63,6 +110,9 @@ class BetterRawIdFieldsTabularInline(admin.TabularInline):
 
     raw_id_fields_new_tab = True
 
+    # The most records labelled in a ManyToMany raw id field before the rest are summarized.
+    raw_id_fields_max_labels = None
+
     def formfield_for_dbfield(self, db_field, **kwargs):
         if db_field.name in self.raw_id_fields:
             kwargs.pop("request", None)
@@ -70,14 +120,33 @@ class BetterRawIdFieldsTabularInline(admin.TabularInline):
             if typ in ("ManyToOneRel", "OneToOneRel"):
                 kwargs['widget'] = w.VerboseForeignKeyRawIdWidget(db_field.remote_field, site, raw_id_fields_new_tab=self.raw_id_fields_new_tab)
             elif typ == "ManyToManyRel":
-                kwargs['widget'] = w.VerboseManyToManyRawIdWidget(db_field.remote_field, site, raw_id_fields_new_tab=self.raw_id_fields_new_tab)
+                kwargs['widget'] = w.VerboseManyToManyRawIdWidget(
+                    db_field.remote_field, site, raw_id_fields_new_tab=self.raw_id_fields_new_tab, max_labels=self.raw_id_fields_max_labels
+                )
             return db_field.formfield(**kwargs)
         return super().formfield_for_dbfield(db_field, **kwargs)
 
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        return type(formset.__name__, (ObjectCacheFormSetMixin, formset), {})
+
 
 ImproveRawIdFieldsFormTabularInline = BetterRawIdFieldsTabularInline
 
 
+class ObjectCacheFormSetMixin(object):
+    """
+    Loads the records selected in the raw id fields of all the formset's forms together,
+    when used with ObjectCacheMiddleware.
+    """
+
+    @cached_property
+    def forms(self):
+        forms = super().forms
+        w.defer_form_objects(forms)
+        return forms
+
+
 class FormatterModelAdmin(BaseModelAdmin):
     """
     Allows the use of per-field formatters.
@@ -213,7 +282,33 @@ class ReadonlyStackedInline(ReadonlyInlineModelAdminMixin, admin.StackedInline):
 def to_ascii(s):
     if not isinstance(s, six.string_types):
         return s
-    return s.encode('ascii', errors='replace')
+    return s.encode('ascii', errors='replace').decode('ascii')
+
+
+def is_pk_ordered(qs):
+    """
+    Returns true if the queryset has no ordering, or is only ordered by ascending primary key,
+    so reading it in primary key order doesn't change the order of its records.
+    """
+    if not qs.ordered:
+        return True
+    pk = qs.model._meta.pk
+    order_by = qs.query.order_by or (qs.query.default_ordering and qs.model._meta.ordering) or ()
+    return tuple(order_by) in (('pk',), (pk.name,), (pk.attname,))
+
+
+def _get_constant(value, record):
+    return value
+
+
+class Echo(object):
+    """
+    A file-like object that returns what is written to it instead of buffering it,
+    so a csv.writer can be used to generate lines for a streaming response.
+    """
+
+    def write(self, value):
+        return value
 
 
 class CSVModelAdminMixin(object):
@@ -224,9 +319,23 @@ class CSVModelAdminMixin(object):
     # This is the maximum number of records that will be written.
     # Be careful about increasing this.
     # Exporting massive numbers of records should be done asynchronously,
-    # not in an admin request.
+    # not in an admin request, unless csv_streaming is enabled.
+    # Set to None to disable the limit.
     csv_record_limit = 1000
 
+    # If true, the export is returned as a StreamingHttpResponse, reading records
+    # from the database in chunks of csv_chunk_size, so memory usage stays
+    # constant regardless of the number of records exported.
+    csv_streaming = False
+
+    csv_chunk_size = 2000
+
+    # If true, chunked exports page through querysets by primary key, with "pk > last_pk ORDER BY pk",
+    # instead of a cursor, even if that discards the queryset's ordering.
+    # Otherwise, this is only done for querysets that are unordered or already ordered by primary key,
+    # and for exports that are checkpointed so they can be resumed, like background export jobs.
+    csv_keyset_pagination = False
+
     # If true, all fields from the queryset will be added to the results.
     csv_headers_all = False
 
@@ -241,9 +350,28 @@ class CSVModelAdminMixin(object):
     # strip this out.
     csv_remove_html = True
 
+    # If true and every header is a concrete field, or a "__" lookup through foreign keys
+    # to a concrete field, records are exported from qs.values_list(), so the database does
+    # the joins and no model instances are created.
+    # Otherwise, select_related() and prefetch_related() are applied to the queryset based
+    # on any relations referenced by the headers.
+    csv_use_values = False
+
+    # If true, an action is added to export records in the background with an ExportJob,
+    # so large exports don't tie up a web worker and aren't subject to csv_record_limit.
+    csv_async = False
+
+    # Additional formats to add export actions for, from admin_steroids.serializers.EXPORT_SERIALIZERS,
+    # e.g. ('jsonl', 'xlsx', 'parquet').
+    export_formats = ()
+
     def get_actions(self, request):
         if hasattr(self, 'actions') and isinstance(self.actions, list):
             self.actions.append('csv_export')
+            if self.csv_async:
+                self.actions.append('csv_export_async')
+            for fmt in self.export_formats:
+                self.actions.append('%s_export' % fmt)
         if isinstance(self, type) or (isclass(self) and issubclass(self, type)):
             return super().get_actions(request)
 
@@ -262,141 +390,428 @@ class CSVModelAdminMixin(object):
     def get_csv_queryset(self, request, qs):
         return qs
 
-    def csv_export(self, request, qs=None, raw_headers=None):
-        try:
-            response = HttpResponse(mimetype='text/csv')
-        except TypeError:
-            response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename=%s.csv' % slugify(self.model.__name__)
+    def get_csv_record_limit(self, request):
+        return self.csv_record_limit
 
-        if raw_headers is None:
-            raw_headers = self.get_csv_raw_headers(request)
+    def get_csv_streaming(self, request):
+        return self.csv_streaming
 
-        def get_attr(obj, name, as_name=False):
-            """
-            Dereferences "__" delimited variable names.
-            """
-            parts = name.split('__')
-            cursor = obj
-            for part in parts:
-                name = part
-                cursor = getattr(cursor, part, None)
-                if callable(cursor):
-                    cursor = cursor()
-            if cursor == obj:
-                return
-            if as_name:
-                return name
-            return cursor
+    def get_csv_headers(self, request, raw_headers, record, qs=None):
+        """
+        Resolves the header labels from the raw headers, using the first record
+        to determine the headers if none were given.
 
-        # Write header.
+        Returns a tuple of the form (raw_headers, fieldnames, header_data).
+        """
         header_data = {}
         fieldnames = []
         header_names = self.get_csv_header_names(request)
+        if not raw_headers:
+            if self.csv_headers_all and isinstance(record, dict):
+                if isinstance(qs, utils.DictCursor):
+                    raw_headers = qs.field_order
+                else:
+                    raw_headers = record.keys()
+            else:
+                raise Exception('No headers specified.')
+        for name in raw_headers:
+            if name in header_names:
+                name_key = name
+                header_data[name] = header_names.get(name_key)
+            elif callable(name):
+                # This is likely a Formatter instance.
+                name_key = name.name
+                header_data[name_key] = name.short_description
+            elif isinstance(name, (tuple, list)) and len(name) == 2:
+                name_key, name_key_verbose = name
+                header_data[name_key] = name_key_verbose
+            elif isinstance(name, six.string_types) and hasattr(self, name):
+                # This is likely a ModelAdmin method name.
+                name_key = name
+                header_data[name_key] = getattr(self, name).short_description
+            elif hasattr(name, 'short_description'):
+                name_key = name
+                header_data[name_key] = getattr(name, 'short_description')
+            elif hasattr(self.model, name):
+                name_key = name
+                if hasattr(getattr(self.model, name), 'short_description'):
+                    header_data[name_key] = getattr(getattr(self.model, name), 'short_description')
+                else:
+                    header_data[name_key] = name
+            else:
+                name_key = name
+                header_data[name_key] = name_key
+            header_data[name_key] = header_data[name_key].title()
+            fieldnames.append(name_key)
+        return raw_headers, fieldnames, header_data
+
+    def get_csv_accessors(self, request, raw_headers, record):
+        """
+        Resolves each raw header into an accessor, so that rendering a record
+        only requires calling each accessor instead of re-inspecting every header.
 
-        # Write records.
-        first = True
-        qs = self.get_csv_queryset(request, qs)
-        for r in qs[:self.csv_record_limit]:
-
-            if first:
-                first = False
-                if not raw_headers:
-                    if self.csv_headers_all and isinstance(r, dict):
-                        if isinstance(qs, utils.DictCursor):
-                            raw_headers = qs.field_order
-                        else:
-                            raw_headers = r.keys()
-                    else:
-                        raise Exception('No headers specified.')
-                for name in raw_headers:
-                    if name in header_names:
-                        name_key = name
-                        header_data[name] = header_names.get(name_key)
-                    elif callable(name):
-                        # This is likely a Formatter instance.
-                        name_key = name.name
-                        header_data[name_key] = name.short_description
-                    elif isinstance(name, (tuple, list)) and len(name) == 2:
-                        name_key, name_key_verbose = name
-                        header_data[name_key] = name_key_verbose
-                    elif isinstance(name, six.string_types) and hasattr(self, name):
-                        # This is likely a ModelAdmin method name.
-                        name_key = name
-                        header_data[name_key] = getattr(self, name).short_description
-                    elif hasattr(name, 'short_description'):
-                        name_key = name
-                        header_data[name_key] = getattr(name, 'short_description')
-                    elif hasattr(self.model, name):
-                        name_key = name
-                        if hasattr(getattr(self.model, name), 'short_description'):
-                            header_data[name_key] = getattr(getattr(self.model, name), 'short_description')
-                        else:
-                            header_data[name_key] = name
-                    else:
-                        name_key = name
-                        header_data[name_key] = name_key #get_attr(r, name, as_name=True)
-#                        field = self.model._meta.get_field_by_name(name)
-#                        if field and field[0].verbose_name:
-#                            header_data[name_key] = field[0].verbose_name
-#                        else:
-#                            header_data[name_key] = name
-                    header_data[name_key] = header_data[name_key].title()
-                    fieldnames.append(name_key)
-
-                writer = csv.DictWriter(response, fieldnames=fieldnames, quoting=self.csv_quoting)
-                writer.writerow(header_data)
-            #print('fieldnames:',fieldnames
-            data = {}
-            for name in raw_headers:
-                obj = None
-                if isinstance(r, dict):
-                    if name in r:
-                        data[name] = r[name]
-                        #                    print('skipping:',name
-                        continue
-
-
-#                    elif 'id' in r:
-#                        obj = self.model.objects.get(id=r['id'])
+        The given record is used as a representative of all the records being exported.
 
-                if callable(name):
-                    # This is likely a Formatter instance.
-                    name_key = name.name
-                    if hasattr(name, 'plaintext'):
-                        data[name_key] = to_ascii(name(r, plaintext=True))
-                    else:
-                        data[name_key] = to_ascii(name(r))
-                elif isinstance(name, (tuple, list)) and len(name) == 2:
-                    name_key, name_key_verbose = name
-                    if hasattr(self, name_key):
-                        data[name_key] = to_ascii(getattr(self, name_key))
-                    else:
-                        data[name_key] = to_ascii(getattr(r, name_key))
-                elif isinstance(name, six.string_types) and hasattr(self, name):
-                    # This is likely a ModelAdmin method name.
-                    name_key = name
-                    data[name_key] = to_ascii(getattr(self, name)(r))
-                elif isinstance(name, six.string_types) and hasattr(r, name):
-                    name_key = name
-                    data[name_key] = to_ascii(getattr(r, name))
+        Returns a list of tuples of the form (name_key, accessor, clean),
+        where clean indicates the value should be converted to ASCII and stripped of HTML.
+        """
+        accessors = []
+        for name in raw_headers:
+            clean = True
+            if isinstance(record, dict) and not callable(name) and name in record:
+                name_key = name
+                accessor = operator.itemgetter(name)
+                clean = False
+            elif callable(name):
+                # This is likely a Formatter instance.
+                name_key = name.name
+                if hasattr(name, 'plaintext'):
+                    accessor = functools.partial(name, plaintext=True)
+                else:
+                    accessor = name
+            elif isinstance(name, (tuple, list)) and len(name) == 2:
+                name_key, name_key_verbose = name
+                if hasattr(self, name_key):
+                    accessor = functools.partial(_get_constant, getattr(self, name_key))
+                else:
+                    accessor = operator.attrgetter(name_key)
+            elif isinstance(name, six.string_types) and hasattr(self, name):
+                # This is likely a ModelAdmin method name.
+                name_key = name
+                accessor = getattr(self, name)
+            elif isinstance(name, six.string_types) and hasattr(record, name):
+                name_key = name
+                accessor = operator.attrgetter(name)
+            else:
+                name_key = name
+                accessor = utils.get_dereferencer(name)
+            accessors.append((name_key, accessor, clean))
+        return accessors
+
+    def get_csv_record_data(self, request, accessors, r, typed=False):
+        """
+        Returns a dictionary of the CSV values for a single record, keyed by field name.
+
+        If typed is true, only strings are cleaned, and all other values keep their
+        Python type, for export formats that preserve types.
+        """
+        remove_html = self.csv_remove_html
+        data = {}
+        for name_key, accessor, clean in accessors:
+            value = accessor(r)
+            if clean:
+                if callable(value):
+                    value = value()
+                if not typed:
+                    value = to_ascii(value)
+                if remove_html and (not typed or isinstance(value, six.string_types)):
+                    value = utils.remove_html(value)
+            data[name_key] = value
+        return data
+
+    def iter_csv_records(self, request, qs, limit=None, chunk_size=None, key=None, after=None, checkpoint=None):
+        """
+        Iterates over the records to export, up to the given limit.
+
+        If a chunk size is given, records are read from the database in chunks
+        instead of loading the entire result set into memory.
+        Querysets are paged by primary key, as described by iter_keyset_records(), if that doesn't change
+        their order, if csv_keyset_pagination is enabled, or if the export is resumable.
+        Otherwise, they're read with a cursor and keep their order.
+        """
+        if chunk_size and isinstance(qs, QuerySet) and qs.query.can_filter() \
+                and (self.csv_keyset_pagination or after is not None or checkpoint is not None or is_pk_ordered(qs)):
+            return self.iter_keyset_records(qs, chunk_size, limit=limit, key=key, after=after, checkpoint=checkpoint)
+        if limit is not None:
+            qs = qs[:limit]
+        if chunk_size and hasattr(qs, 'iterator'):
+            return qs.iterator(chunk_size=chunk_size)
+        return iter(qs)
+
+    def iter_keyset_records(self, qs, chunk_size, limit=None, key=None, after=None, checkpoint=None):
+        """
+        Iterates over the queryset in primary key order, reading each chunk with
+        "pk > last_pk ORDER BY pk LIMIT chunk_size", which unlike an offset, stays
+        an indexed range query no matter how deep into the table the export is.
+
+        Records are read starting after the given primary key, if any.
+        The key function returns the primary key of a record.
+        After all records in a chunk have been consumed, checkpoint(last_pk, count) is called,
+        where count is the number of records read so far, so an interrupted export can be
+        resumed by passing the last primary key as after.
+        """
+        key = key or operator.attrgetter('pk')
+        qs = qs.order_by('pk')
+        count = 0
+        while limit is None or count < limit:
+            chunk_qs = qs
+            if after is not None:
+                chunk_qs = chunk_qs.filter(pk__gt=after)
+            size = chunk_size if limit is None else min(chunk_size, limit - count)
+            chunk = list(chunk_qs[:size])
+            if not chunk:
+                break
+            yield from chunk
+            count += len(chunk)
+            after = key(chunk[-1])
+            if checkpoint is not None:
+                checkpoint(after, count)
+            if len(chunk) < size:
+                break
+
+    def get_csv_values_lookups(self, request, raw_headers, qs):
+        """
+        Returns the list of lookups to pass to qs.values_list() if every header
+        can be read directly from the database, otherwise returns None.
+        """
+        if not raw_headers or not isinstance(qs, QuerySet) or not issubclass(qs._iterable_class, ModelIterable):
+            return
+        lookups = []
+        for name in raw_headers:
+            if not isinstance(name, six.string_types) or hasattr(self, name):
+                return
+            if name in qs.query.annotations:
+                lookups.append(name)
+                continue
+            model = qs.model
+            parts = name.split('__')
+            for i, part in enumerate(parts):
+                if part == 'pk':
+                    field = model._meta.pk
                 else:
-                    name_key = name
-                    data[name_key] = to_ascii(get_attr(r, name))
+                    try:
+                        field = model._meta.get_field(part)
+                    except FieldDoesNotExist:
+                        return
+                if i + 1 < len(parts):
+                    # Only follow relations that resolve to a single record.
+                    if not (field.concrete and (field.many_to_one or field.one_to_one)):
+                        return
+                    model = field.related_model
+                elif not field.concrete or field.is_relation:
+                    return
+            lookups.append(name)
+        return lookups
+
+    def get_export_fields(self, request, raw_headers):
+        """
+        Returns a dictionary mapping the name of each header that reads a concrete model field,
+        following "__" delimited relations, to that field, so typed formats can store its type.
+        """
+        fields = {}
+        for name in raw_headers or ():
+            if isinstance(name, (tuple, list)) and len(name) == 2:
+                name = name[0]
+            if not isinstance(name, six.string_types) or hasattr(self, name):
+                continue
+            model = self.model
+            parts = name.split('__')
+            for i, part in enumerate(parts):
+                try:
+                    field = model._meta.pk if part == 'pk' else model._meta.get_field(part)
+                except FieldDoesNotExist:
+                    break
+                if i + 1 < len(parts):
+                    if not (field.concrete and (field.many_to_one or field.one_to_one)):
+                        break
+                    model = field.related_model
+                elif field.concrete and not field.is_relation:
+                    fields[name] = field
+        return fields
+
+    def get_csv_related_queryset(self, request, raw_headers, qs):
+        """
+        Adds select_related() and prefetch_related() calls to the queryset for
+        all relations referenced by "__" delimited headers.
+        """
+        if not raw_headers or not isinstance(qs, QuerySet) or not issubclass(qs._iterable_class, ModelIterable):
+            return qs
+        select_related = set()
+        prefetch_related = set()
+        for name in raw_headers:
+            if callable(name) and not getattr(name, 'object_level', False):
+                # This is likely a Formatter instance.
+                name = getattr(name, 'name', None)
+            if not isinstance(name, six.string_types) or hasattr(self, name):
+                continue
+            model = qs.model
+            path = []
+            prefetch = False
+            for part in name.split('__'):
+                try:
+                    field = model._meta.get_field(part)
+                except FieldDoesNotExist:
+                    break
+                if not field.is_relation or field.related_model is None:
+                    break
+                path.append(part)
+                if not ((field.many_to_one or field.one_to_one) and (field.concrete or field.auto_created)):
+                    prefetch = True
+                model = field.related_model
+            if path:
+                if prefetch:
+                    prefetch_related.add('__'.join(path))
+                else:
+                    select_related.add('__'.join(path))
+        if select_related:
+            qs = qs.select_related(*sorted(select_related))
+        if prefetch_related:
+            qs = qs.prefetch_related(*sorted(prefetch_related))
+        return qs
 
-                if callable(data[name_key]):
-                    data[name_key] = to_ascii(data[name_key]())
+    def get_export_rows(self, request, qs, raw_headers=None, limit=None, chunk_size=None, typed=False, after=None, checkpoint=None):
+        """
+        Resolves the headers and accessors against the first record to export.
+
+        Returns a tuple of the form (fieldnames, header_data, rows), where rows iterates over
+        the data dictionary of each record. If there are no records, fieldnames is None.
+        """
+        accessors = None
+        key = None
+        if self.csv_use_values:
+            lookups = self.get_csv_values_lookups(request, raw_headers, qs)
+            if lookups:
+                # The primary key is appended so records can be paged by it.
+                qs = qs.values_list(*(lookups + ['pk']))
+                accessors = [(name, operator.itemgetter(i), True) for i, name in enumerate(lookups)]
+                key = operator.itemgetter(len(lookups))
+            else:
+                qs = self.get_csv_related_queryset(request, raw_headers, qs)
+        records = self.iter_csv_records(request, qs, limit=limit, chunk_size=chunk_size, key=key, after=after, checkpoint=checkpoint)
+        for first in records:
+            break
+        else:
+            return None, None, iter(())
+        raw_headers, fieldnames, header_data = self.get_csv_headers(request, raw_headers, first, qs=qs)
+        if accessors is None:
+            accessors = self.get_csv_accessors(request, raw_headers, first)
+        records = itertools.chain([first], records)
+
+        def iter_rows():
+            # Let formatters bulk load their data for each chunk. The batches match the chunks,
+            # so a chunk is only checkpointed after all of its records are rendered.
+            for batch in utils.iter_batches(records, chunk_size or self.csv_chunk_size):
+                prepare_formatters(raw_headers, batch)
+                for r in batch:
+                    yield self.get_csv_record_data(request, accessors, r, typed=typed)
+
+        return fieldnames, header_data, iter_rows()
+
+    def iter_csv_lines(self, request, qs, raw_headers=None, limit=None, chunk_size=None, after=None, checkpoint=None):
+        """
+        Generates each formatted line of the CSV file, starting with the header.
+        """
+        fieldnames, header_data, rows = self.get_export_rows(
+            request, qs, raw_headers, limit=limit, chunk_size=chunk_size, after=after, checkpoint=checkpoint
+        )
+        if fieldnames is None:
+            return
+        writer = csv.DictWriter(Echo(), fieldnames=fieldnames, quoting=self.csv_quoting)
+        yield writer.writerow(header_data)
+        for data in rows:
+            yield writer.writerow(data)
+
+    def csv_export(self, request, qs=None, raw_headers=None):
+        filename = '%s.csv' % slugify(self.model.__name__)
 
-                if self.csv_remove_html:
-                    data[name_key] = utils.remove_html(data[name_key])
+        if raw_headers is None:
+            raw_headers = self.get_csv_raw_headers(request)
 
-            #print('data:',data
-            #writer.writerow(data)
-            writer.writerow(utils.encode_csv_data(data))
+        qs = self.get_csv_queryset(request, qs)
+        streaming = self.get_csv_streaming(request)
+        lines = self.iter_csv_lines(
+            request,
+            qs,
+            raw_headers,
+            limit=self.get_csv_record_limit(request),
+            chunk_size=self.csv_chunk_size if streaming else None,
+        )
+
+        if streaming:
+            response = StreamingHttpResponse(lines, content_type='text/csv')
+        else:
+            try:
+                response = HttpResponse(mimetype='text/csv')
+            except TypeError:
+                response = HttpResponse(content_type='text/csv')
+            for line in lines:
+                response.write(line)
+        response['Content-Disposition'] = 'attachment; filename=%s' % filename
         return response
     csv_export.short_description = \
         'Export selected %(verbose_name_plural)s as a CSV file'
 
+    def export_as(self, request, qs, fmt, raw_headers=None):
+        """
+        Exports the queryset in the given format from admin_steroids.serializers,
+        using the same headers as csv_export.
+        """
+        serializer_class = get_serializer(fmt)
+        filename = '%s.%s' % (slugify(self.model.__name__), serializer_class.extension)
+
+        if raw_headers is None:
+            raw_headers = self.get_csv_raw_headers(request)
+
+        qs = self.get_csv_queryset(request, qs)
+        fieldnames, header_data, rows = self.get_export_rows(
+            request,
+            qs,
+            raw_headers,
+            limit=self.get_csv_record_limit(request),
+            chunk_size=self.csv_chunk_size,
+            typed=serializer_class.typed,
+        )
+        serializer = serializer_class(
+            fieldnames or [],
+            header_data or {},
+            batch_size=self.csv_chunk_size,
+            fields=self.get_export_fields(request, raw_headers),
+        )
+        if serializer.streaming:
+            response = StreamingHttpResponse(serializer.iter_chunks(rows), content_type=serializer.content_type)
+            response['Content-Disposition'] = 'attachment; filename=%s' % filename
+            return response
+        fout = tempfile.TemporaryFile()
+        serializer.write(rows, fout)
+        fout.seek(0)
+        return FileResponse(fout, as_attachment=True, filename=filename, content_type=serializer.content_type)
+
+    def jsonl_export(self, request, qs=None):
+        return self.export_as(request, qs, 'jsonl')
+    jsonl_export.short_description = \
+        'Export selected %(verbose_name_plural)s as a JSON Lines file'
+
+    def xlsx_export(self, request, qs=None):
+        return self.export_as(request, qs, 'xlsx')
+    xlsx_export.short_description = \
+        'Export selected %(verbose_name_plural)s as an Excel file'
+
+    def parquet_export(self, request, qs=None):
+        return self.export_as(request, qs, 'parquet')
+    parquet_export.short_description = \
+        'Export selected %(verbose_name_plural)s as a Parquet file'
+
+    def csv_export_async(self, request, qs=None, raw_headers=None):
+        """
+        Records the export as an ExportJob, to be written to the spool directory
+        in the background, without any record limit.
+        """
+        from .exports import submit_export_job # pylint: disable=import-outside-toplevel
+        from .models import ExportJob # pylint: disable=import-outside-toplevel
+
+        if raw_headers is None:
+            raw_headers = self.get_csv_raw_headers(request)
+        job = ExportJob.create_for_queryset(qs, raw_headers=raw_headers, user=request.user, admin_site=self.admin_site.name)
+        submit_export_job(job)
+        self.message_user(
+            request,
+            mark_safe(
+                'The export has been queued. <a href="%s">Download</a> the file once it completes.' % job.get_download_url()
+            ),
+        )
+    csv_export_async.short_description = \
+        'Export selected %(verbose_name_plural)s as a CSV file in the background'
+
 
 class CSVModelAdmin(BaseModelAdmin, CSVModelAdminMixin):
 
@@ -449,4 +864,41 @@ class LogEntryAdmin(ReadonlyModelAdmin):
             admin_site.register(admin.models.LogEntry, LogEntryAdmin)
 
 
+class ExportJobAdmin(ReadonlyModelAdmin):
+
+    list_display = (
+        'id',
+        'content_type',
+        'user',
+        'status',
+        'written',
+        'created',
+        'finished',
+        'download_link',
+    )
+
+    list_filter = ('status',)
+
+    exclude = ('query', 'headers')
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if not request.user.is_superuser:
+            qs = qs.filter(user=request.user)
+        return qs
+
+    def download_link(self, obj=None):
+        if not obj or not obj.id:
+            return ''
+        return mark_safe('<a href="%s">Download</a>' % obj.get_download_url())
+
+    download_link.short_description = 'Download'
+
+    @classmethod
+    def register(cls, admin_site=None):
+        from .models import ExportJob # pylint: disable=import-outside-toplevel
+        admin_site = admin_site or admin.site
+        admin_site.register(ExportJob, cls)
+
+
 #admin.site.register(models.LogEntry, LogEntryAdmin)
@@ -1,14 +1,42 @@
 import hashlib
+import json
 import re
 import sys
+import time
 import traceback
 
 from django.core.cache import cache
 from django.core.exceptions import EmptyResultSet
-from django.db import connections, transaction
+from django.core.paginator import EmptyPage, Page, Paginator
+from django.core.signals import setting_changed
+from django.db import connections, transaction, DatabaseError
+from django.db.models import lookups
+from django.db.models.expressions import Col
 from django.db.models.query import QuerySet
 from django.db.models.query import RawQuerySet
 from django.db.transaction import atomic
+from django.dispatch import receiver
+from django.utils.functional import cached_property
+
+# {alias: vendor}
+_vendors = {}
+
+
+def get_vendor(using=None):
+    """
+    Returns the vendor of the database with the given alias, like "postgresql", "mysql" or "sqlite".
+    """
+    using = using or 'default'
+    vendor = _vendors.get(using)
+    if vendor is None:
+        vendor = _vendors[using] = connections[using].vendor
+    return vendor
+
+
+@receiver(setting_changed)
+def _clear_vendors_on_databases_change(setting, **kwargs):
+    if setting == 'DATABASES':
+        _vendors.clear()
 
 
 def execute_sql_from_file(fn, using=None):
@@ -59,7 +87,7 @@ class ApproxCountQuerySet(QuerySet):
     is called with no additional constraints. In all other cases it should
     behave exactly as QuerySet.
 
-    Only works with MySQL. Behaves normally for all other engines.
+    Works with PostgreSQL, MySQL and SQLite, once ANALYZE has been run. Behaves normally for all other engines.
 
     You'd use it by cloning your queryset, substituting this class
 
@@ -70,40 +98,187 @@ class ApproxCountQuerySet(QuerySet):
             qs = qs._clone(klass=ApproxCountQuerySet)
             return qs
 
+    Filtered querysets are counted exactly, unless estimates are enabled with estimated().
+
+    Models registered with register_row_counter() are counted from their counter instead,
+    when unfiltered or filtered on one of the counter's fields.
+
+    After count(), count_is_estimate tells whether the count returned was an approximation.
+
     Based on code from answer http://stackoverflow.com/a/10446271/247542.
     """
 
+    # If true, filtered querysets are counted with the query planner's estimate.
+    estimate_filtered = False
+
+    # Estimates below this are replaced by an exact count, since small counts are cheap and easy to check by eye.
+    exact_count_threshold = 10000
+
+    count_is_estimate = False
+
+    def _clone(self):
+        clone = super()._clone()
+        clone.estimate_filtered = self.estimate_filtered
+        clone.exact_count_threshold = self.exact_count_threshold
+        return clone
+
+    def estimated(self, exact_count_threshold=None):
+        """
+        Returns a copy of the queryset whose count() uses the query planner's estimate
+        of the number of matching rows, unless it's below exact_count_threshold.
+        """
+        clone = self._chain()
+        clone.estimate_filtered = True
+        if exact_count_threshold is not None:
+            clone.exact_count_threshold = exact_count_threshold
+        return clone
+
+    def estimate_count(self):
+        """
+        Returns the query planner's estimate of the number of rows the queryset matches,
+        or None if the database can't estimate it.
+
+        Uses EXPLAIN on PostgreSQL and MySQL.
+        """
+        vendor = get_vendor(self.db)
+        if vendor not in ('postgresql', 'mysql'):
+            return None
+        try:
+            sql, params = self.query.get_compiler(using=self.db).as_sql()
+        except EmptyResultSet:
+            return 0
+        with connections[self.db].cursor() as cursor:
+            if vendor == 'postgresql':
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                return int(plan[0]['Plan']['Plan Rows'])
+            cursor.execute('EXPLAIN ' + sql, params)
+            columns = [column[0].lower() for column in cursor.description]
+            row = dict(zip(columns, cursor.fetchone()))
+            # The first table read drives the query, so its estimate, less the rows its conditions filter out, is the result's.
+            return int((row.get('rows') or 0) * float(row.get('filtered') or 100) / 100)
+
+    def _get_postgresql_table_count(self, cursor):
+        # Read table count approximation from PostgreSQL's pg_class.
+        # A partitioned table has no rows of its own, so the counts of its partitions are summed,
+        # recursing into sub-partitions. Tables never analyzed have a negative count, so can't be estimated.
+        cursor.execute(
+            """
+            WITH RECURSIVE tables(oid) AS (
+                SELECT %s::regclass::oid
+                UNION ALL
+                SELECT pg_inherits.inhrelid FROM pg_inherits JOIN tables ON pg_inherits.inhparent = tables.oid
+            )
+            SELECT SUM(pg_class.reltuples)::bigint, BOOL_OR(pg_class.reltuples < 0)
+            FROM tables JOIN pg_class ON pg_class.oid = tables.oid
+            WHERE pg_class.relkind <> 'p'
+            """, [connections[self.db].ops.quote_name(self.model._meta.db_table)]
+        )
+        count, unanalyzed = cursor.fetchone()
+        if count is None or unanalyzed:
+            return None
+        return count
+
+    def _get_mysql_table_count(self, cursor):
+        # Read table count approximation from MySQL's "SHOW TABLE".
+        cursor.execute("SHOW TABLE STATUS LIKE %s", (self.model._meta.db_table,))
+        return cursor.fetchall()[0][4]
+
+    def _get_sqlite_table_count(self, cursor):
+        # Read the table count recorded by the last ANALYZE, which starts each row of sqlite_stat1,
+        # except those of partial indexes, which start with the number of rows they cover.
+        table = self.model._meta.db_table
+        try:
+            cursor.execute(
+                "SELECT stat FROM sqlite_stat1 WHERE tbl = %s "
+                "AND (idx IS NULL OR idx NOT IN (SELECT name FROM pragma_index_list(%s) WHERE partial)) "
+                "ORDER BY idx IS NOT NULL LIMIT 1",
+                (table, table)
+            )
+        except DatabaseError:
+            # The database has never been analyzed.
+            return None
+        row = cursor.fetchone()
+        if not row:
+            return None
+        return int(row[0].split()[0])
+
+    def get_table_count(self):
+        """
+        Returns the approximate number of rows in the model's table, read from the database's statistics,
+        or None if the database has no statistics for it.
+        """
+        method = getattr(self, '_get_%s_table_count' % get_vendor(self.db), None)
+        if method is None:
+            return None
+        with connections[self.db].cursor() as cursor:
+            return method(cursor)
+
+    def get_counter_count(self):
+        """
+        Returns the exact count kept by a counter registered with register_row_counter(),
+        or None if the queryset isn't unfiltered or filtered on the values of a single counted field.
+        """
+        from .models import FieldValueCount, has_row_counter # pylint: disable=import-outside-toplevel
+        query = self.query
+        if not has_row_counter(self.model) or query.high_mark is not None or query.low_mark or query.distinct or query.group_by \
+            or query.combinator:
+            return None
+        if not query.where:
+            return FieldValueCount.objects.get_count(self.model)
+        lookup = query.where.children[0] if not query.where.negated and len(query.where.children) == 1 else None
+        values = self.get_lookup_values(lookup)
+        if values is None:
+            return None
+        return FieldValueCount.objects.get_count(self.model, lookup.lhs.target.name, values)
+
+    def get_lookup_values(self, lookup):
+        """
+        Returns the list of values the lookup matches a column of the model's table against,
+        or None if it's any other condition.
+        """
+        if not isinstance(lookup, lookups.Lookup) or not isinstance(lookup.lhs, Col) or lookup.lhs.alias != self.query.base_table \
+            or lookup.lhs.target.model is not self.model._meta.concrete_model:
+            return None
+        if isinstance(lookup, lookups.Exact):
+            values = [lookup.rhs]
+        elif isinstance(lookup, lookups.In):
+            values = list(lookup.rhs)
+        elif isinstance(lookup, lookups.IsNull) and lookup.rhs is True:
+            values = [None]
+        else:
+            return None
+        if any(hasattr(value, 'resolve_expression') for value in values):
+            return None
+        return values
+
     def count(self):
         # Code from django/db/models/query.py
 
         if self._result_cache is not None:
             return len(self._result_cache)
 
-        db_backend_name = connections[self.db].client.executable_name.lower()
-        is_postgres = 'psql' in db_backend_name \
-            or 'postgres' in db_backend_name \
-            or 'postgis' in db_backend_name
-        is_mysql = 'mysql' in db_backend_name
+        self.count_is_estimate = False
+
+        count = self.get_counter_count()
+        if count is not None:
+            return count
 
         query = self.query
-        if (is_postgres or is_mysql
-            ) and (not query.where and query.high_mark is None and query.low_mark == 0 and not query.select and not query.group_by and not query.distinct):
-            if is_postgres:
-                # Read table count approximation from PostgreSQL's pg_class.
-                cursor = connections[self.db].cursor()
-                # Note, there's a bug in the default execute() that
-                # misquotes arguments by using double-quotes when PG only
-                # uses single-quotes.
-                sql = "SELECT reltuples::int FROM pg_class WHERE oid = '%s'::regclass;" % (self.model._meta.db_table,)
-                cursor.execute(sql)
-                results = cursor.fetchall()
-                return results[0][0]
-            if is_mysql:
-                # Read table count approximation from MySQL's "SHOW TABLE".
-                cursor = connections[self.db].cursor()
-                cursor.execute("SHOW TABLE STATUS LIKE %s", (self.model._meta.db_table,))
-                return cursor.fetchall()[0][4]
-            raise NotImplementedError
+        if not query.where and query.high_mark is None and query.low_mark == 0 and not query.select and not query.group_by and not query.distinct:
+            count = self.get_table_count()
+            if count is not None:
+                self.count_is_estimate = True
+                return count
+
+        if self.estimate_filtered:
+            estimate = self.estimate_count()
+            if estimate is not None and estimate >= self.exact_count_threshold:
+                self.count_is_estimate = True
+                return estimate
+
         return self.query.get_count(using=self.db)
 
 
@@ -111,22 +286,214 @@ class CachedCountQuerySet(ApproxCountQuerySet):
     """
     Wraps a caching layer over ApproxCountQuerySet, since it only gives global
     table counts and reverts to a direct query if any filters are applied.
+
+    Once a count is older than cache_seconds, the first caller to notice recounts it,
+    while everyone else keeps getting the old count for up to stale_seconds more.
     """
 
     cache_seconds = 3600 # 1-hour
 
+    # How long an expired count may still be returned while it's being recounted.
+    stale_seconds = 86400 # 1-day
+
+    # How long a recount may take before another caller is allowed to start one.
+    lock_seconds = 60
+
+    # How long a caller waits for another's recount when there's no old count to return.
+    lock_wait_seconds = 5
+
+    def get_count_cache_key(self):
+        """
+        Returns the cache key for the count, which is unique to the database, the SQL and its parameters.
+
+        Raises EmptyResultSet if the queryset can't match anything.
+        """
+        sql, params = self.query.get_compiler(using=self.db).as_sql()
+        state = repr((self.db, sql, tuple(params), self.estimate_filtered, self.exact_count_threshold))
+        return 'das_count_%s' % hashlib.sha512(state.encode('utf-8')).hexdigest()
+
+    def _recount(self, cache_key):
+        count = super().count()
+        entry = {'count': count, 'is_estimate': self.count_is_estimate, 'time': time.time()}
+        cache.set(cache_key, entry, self.cache_seconds + self.stale_seconds)
+        return count
+
     def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+
         try:
-            sql = str(self.query)
-            cache_key = hashlib.sha512(sql).hexdigest()
-            count = cache.get(cache_key)
-            if count is None:
-                count = super().count()
-                cache.set(cache_key, count, self.cache_seconds)
+            cache_key = self.get_count_cache_key()
         except EmptyResultSet:
-            count = super().count()
+            return super().count()
+
+        lock_key = cache_key + '_lock'
+        deadline = time.time() + self.lock_wait_seconds
+        while True:
+            entry = cache.get(cache_key)
+            if entry is not None and time.time() - entry['time'] < self.cache_seconds:
+                break
+            # Only the caller holding the lock recounts, so an expiring count doesn't start a recount by every caller at once.
+            if cache.add(lock_key, 1, self.lock_seconds):
+                try:
+                    return self._recount(cache_key)
+                finally:
+                    cache.delete(lock_key)
+            if entry is not None:
+                # Another caller is recounting, so return the old count meanwhile.
+                break
+            if time.time() >= deadline:
+                return self._recount(cache_key)
+            time.sleep(0.05)
+
+        self.count_is_estimate = entry['is_estimate']
+        return entry['count']
+
+
+class CountlessPage(Page):
+    """
+    A page of CountlessPaginator, which knows whether there's a next page without knowing the count.
+    """
+
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def start_index(self):
+        if not self.object_list:
+            return 0
+        return (self.number - 1) * self.paginator.per_page + 1
+
+    def end_index(self):
+        return self.start_index() + len(self.object_list) - 1 if self.object_list else 0
+
+
+class CountlessPaginator(Paginator):
+    """
+    A paginator for admin changelists of very large tables, which never needs an exact count.
+
+    Each page is read with one query for per_page + 1 rows, the extra row telling whether there's a next page.
+    The count is only used to show the number of results and page links, so it's read from the queryset's
+    count(), which for ApproxCountQuerySet is an estimate or a counter.
+
+    When the queryset is only ordered by primary key, as changelists are when their ModelAdmin
+    has no other ordering, the last primary key of each page is cached. The next page is then read
+    with a range query on the primary key, instead of an OFFSET that reads every row before it.
+
+    Use it by setting paginator = CountlessPaginator on a ModelAdmin, ideally with show_full_result_count = False
+    so the unfiltered table isn't counted either. Orphans aren't supported.
+    """
+
+    # How long the last primary key of each page is remembered, to read the next page with a range query.
+    boundary_cache_seconds = 3600
+
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True):
+        super().__init__(object_list, per_page, orphans=0, allow_empty_first_page=allow_empty_first_page)
+        # The (number, queryset, has_next) of the last page read.
+        self._rows = None
+        # The (number, has_next) of the last page returned.
+        self._last_page = None
+
+    @cached_property
+    def count(self):
+        count = super().count
+        if count <= self.per_page:
+            # The changelist doesn't paginate a count this small, so make sure an estimate isn't hiding more rows.
+            rows, has_next = self._get_rows(1)
+            if has_next:
+                count = max(count, self.per_page + 1)
         return count
 
+    @cached_property
+    def num_pages(self):
+        num_pages = super().num_pages
+        if self._last_page:
+            # The count may be an underestimate, so always link to the pages known to exist.
+            number, has_next = self._last_page
+            num_pages = max(num_pages, number + 1 if has_next else number)
+        return num_pages
+
+    def validate_number(self, number):
+        # Pages past the estimated count may still have rows, so only page() checks if a page is empty.
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            number = int(number)
+            if number < 1:
+                raise
+            return number
+
+    def get_pk_ordering(self):
+        """
+        Returns the primary key's field name, prefixed with "-" if descending,
+        if the queryset is only ordered by it, or None otherwise.
+        """
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.extra_order_by or len(query.order_by) != 1 or not isinstance(query.order_by[0], str):
+            return None
+        ordering = query.order_by[0]
+        name = ordering.lstrip('-')
+        pk = self.object_list.model._meta.pk
+        if name not in ('pk', pk.name, pk.attname):
+            return None
+        return ordering
+
+    def get_boundary_cache_key(self, number):
+        """
+        Returns the cache key for the last primary key of the given page.
+
+        Raises EmptyResultSet if the queryset can't match anything.
+        """
+        qs = self.object_list
+        sql, params = qs.query.get_compiler(using=qs.db).as_sql()
+        state = repr((qs.db, sql, tuple(params), self.per_page, number))
+        return 'das_page_%s' % hashlib.sha512(state.encode('utf-8')).hexdigest()
+
+    def _get_rows(self, number):
+        """
+        Returns a tuple of the queryset of the page's rows, evaluated, and whether there's a next page.
+        """
+        if self._rows and self._rows[0] == number:
+            return self._rows[1:]
+        qs = self.object_list
+        ordering = self.get_pk_ordering()
+        boundary = None
+        if ordering and number > 1:
+            try:
+                boundary = cache.get(self.get_boundary_cache_key(number - 1))
+            except EmptyResultSet:
+                pass
+        if boundary is None:
+            bottom = (number - 1) * self.per_page
+        else:
+            qs = qs.filter(**{'pk__lt' if ordering.startswith('-') else 'pk__gt': boundary})
+            bottom = 0
+        rows = list(qs[bottom:bottom + self.per_page + 1])
+        has_next = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if ordering and rows:
+            try:
+                cache.set(self.get_boundary_cache_key(number), rows[-1].pk, self.boundary_cache_seconds)
+            except EmptyResultSet:
+                pass
+        # Return a queryset, as the changelist's formset expects, already holding the page's rows.
+        page_qs = qs[bottom:bottom + self.per_page]
+        page_qs._result_cache = rows
+        self._rows = (number, page_qs, has_next)
+        return page_qs, has_next
+
+    def page(self, number):
+        number = self.validate_number(number)
+        rows, has_next = self._get_rows(number)
+        if not rows and number > 1:
+            raise EmptyPage('That page contains no results')
+        self._last_page = (number, has_next)
+        self.__dict__.pop('num_pages', None)
+        return CountlessPage(rows, number, self, has_next)
+
 
 class SmartRawQuerySet(RawQuerySet):
     """
@@ -0,0 +1,329 @@
+"""
+Backends that find field values for the Ajax search, without scanning the model's table.
+
+Register one for a field with register_search_backend().
+"""
+import threading
+import time
+
+from django.db import connections, router
+
+from .models import FieldValueCount, has_distinct_value_index
+
+# {(app_label, model_name, field_name): SearchBackend}
+_search_backends = {}
+
+
+def register_search_backend(model, field_name, backend_class=None, **kwargs):
+    """
+    Answers the Ajax search of the model's field with a backend, instead of an icontains query
+    scanning the whole table.
+
+    Defaults to TrigramIndexSearchBackend, which keeps an index of the field's distinct values in memory.
+    Returns the backend instance.
+    """
+    backend = (backend_class or TrigramIndexSearchBackend)(model, field_name, **kwargs)
+    _search_backends[(model._meta.app_label.lower(), model._meta.model_name.lower(), field_name.lower())] = backend
+    return backend
+
+
+def get_search_backend(app_label, model_name, field_name):
+    return _search_backends.get((app_label.lower(), model_name.lower(), field_name.lower()))
+
+
+def get_search_backends():
+    return [_search_backends[key] for key in sorted(_search_backends)]
+
+
+class SearchBackend(object):
+    """
+    Finds the distinct values of a model's field containing a search term, ignoring case.
+    """
+
+    # Terms shorter than this aren't searched, since the backend's index can't narrow them down.
+    min_length = 1
+
+    # If true, the results for a term are exactly the values whose lowercased text contains the lowercased term,
+    # so the complete results for a term can be filtered in memory to answer a longer one.
+    # Database searches match with the database's collation, which may not agree with Python's, so they aren't.
+    substring_closed = False
+
+    def __init__(self, model, field_name):
+        self.model = model
+        self.field_name = field_name
+        self.field = model._meta.get_field(field_name)
+
+    @property
+    def using(self):
+        return router.db_for_read(self.model)
+
+    def get_queryset(self, q):
+        return self.model._default_manager.using(self.using)\
+            .filter(**{self.field_name + '__icontains': q})\
+            .values_list(self.field_name, flat=True)\
+            .order_by(self.field_name)\
+            .distinct()
+
+    def search(self, q, limit):
+        """
+        Returns a list of up to limit distinct values of the field containing q, ordered by value.
+        """
+        return list(self.get_queryset(q)[:limit])
+
+
+class TrigramIndexSearchBackend(SearchBackend):
+    """
+    Searches an in-process index of every distinct value of the field.
+
+    Each value is indexed by its trigrams, so a search only checks the values sharing the rarest
+    trigram of the term, while shorter terms are checked against every value. The index is built
+    in a background thread on the first search, which is answered by the database until it's ready,
+    and rebuilt the same way once it's older than refresh_seconds, while the old one keeps answering searches.
+
+    If the field has more than max_values distinct values, no index is kept, and terms are searched
+    in the database instead, until a rebuild finds few enough values.
+
+    The distinct values are read from the FieldValueCount table when the field is registered with
+    register_distinct_value_index(), so rebuilding the index doesn't scan the model's table either.
+    """
+
+    gram_size = 3
+
+    refresh_seconds = 300
+
+    max_values = 100000
+
+    def __init__(self, model, field_name, refresh_seconds=None, max_values=None):
+        super().__init__(model, field_name)
+        if refresh_seconds is not None:
+            self.refresh_seconds = refresh_seconds
+        if max_values is not None:
+            self.max_values = max_values
+        self._index = None
+        self._built = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    @property
+    def substring_closed(self):
+        # Only the index is searched with Python's case folding. Without it, the database is searched instead.
+        return self._index is not None
+
+    def get_values(self):
+        """
+        Returns an iterable of the field's distinct values.
+        """
+        if has_distinct_value_index(self.model, self.field_name):
+            return (value for value, count in FieldValueCount.objects.get_values(self.model, self.field_name))
+        return self.model._default_manager.using(self.using)\
+            .values_list(self.field.attname, flat=True)\
+            .order_by()\
+            .distinct()\
+            .iterator()
+
+    def build_index(self):
+        """
+        Returns a tuple of the sorted values, their lowercased forms, and a dictionary mapping
+        each substring of gram_size characters to the ascending positions of the values containing it.
+
+        Returns None if there are more than max_values distinct values.
+        """
+        values = set()
+        for value in self.get_values():
+            if value not in (None, ''):
+                values.add(str(value))
+                if len(values) > self.max_values:
+                    return None
+        values = sorted(values)
+        lowered = [value.lower() for value in values]
+        grams = {}
+        for i, value in enumerate(lowered):
+            for gram in set(value[start:start + self.gram_size] for start in range(len(value) - self.gram_size + 1)):
+                grams.setdefault(gram, []).append(i)
+        return values, lowered, grams
+
+    def refresh(self):
+        """
+        Rebuilds the index from the field's current values.
+        """
+        index = self.build_index()
+        with self._lock:
+            self._index = index
+            self._built = time.time()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            self._refreshing = False
+            connections.close_all()
+
+    def get_index(self):
+        """
+        Returns the index, or None until it's first built.
+
+        A missing or stale index is built in a background thread, so it's never built during a search.
+        """
+        if not self._built or time.time() - self._built > self.refresh_seconds:
+            with self._lock:
+                start = not self._refreshing
+                self._refreshing = True
+            if start:
+                threading.Thread(target=self._refresh_in_background, daemon=True).start()
+        return self._index
+
+    def search(self, q, limit):
+        index = self.get_index()
+        if index is None:
+            # The index isn't built yet, or there are too many values to keep in memory.
+            return super().search(q, limit)
+        values, lowered, grams = index
+        q = q.lower()
+        if len(q) < self.gram_size:
+            # A term this short can't be looked up, so every value is checked, stopping at the limit.
+            candidates = range(len(values))
+        elif len(q) == self.gram_size:
+            # Every value containing the term is listed under it, so no check is needed.
+            return [values[i] for i in grams.get(q, [])[:limit]]
+        else:
+            candidates = min((grams.get(q[start:start + self.gram_size], []) for start in range(len(q) - self.gram_size + 1)), key=len)
+        results = []
+        for i in candidates:
+            if q in lowered[i]:
+                results.append(values[i])
+                if len(results) >= limit:
+                    break
+        return results
+
+
+class DatabaseSearchBackend(SearchBackend):
+    """
+    Searches with the database's own text index, created by create_index().
+
+    On other databases, the field is searched with a plain icontains query.
+    """
+
+    vendor = None
+
+    min_length = 3
+
+    def get_connection(self):
+        return connections[self.using]
+
+    def is_supported(self):
+        return self.get_connection().vendor == self.vendor
+
+    @property
+    def table(self):
+        return self.model._meta.db_table
+
+    @property
+    def column(self):
+        return self.field.column
+
+    @property
+    def index_name(self):
+        return '%s_%s_search' % (self.table, self.column)
+
+    def get_create_index_sql(self):
+        """
+        Returns a list of SQL statements creating the index.
+        """
+        raise NotImplementedError
+
+    def get_drop_index_sql(self):
+        """
+        Returns a list of SQL statements removing the index.
+        """
+        raise NotImplementedError
+
+    def _execute(self, statements):
+        with self.get_connection().cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+    def create_index(self):
+        if self.is_supported():
+            self._execute(self.get_create_index_sql())
+
+    def drop_index(self):
+        if self.is_supported():
+            self._execute(self.get_drop_index_sql())
+
+
+class PostgresTrigramSearchBackend(DatabaseSearchBackend):
+    """
+    Searches PostgreSQL with a pg_trgm GIN index on the field.
+
+    The index is on the same UPPER(column::text) expression Django uses for icontains,
+    so the normal query uses it instead of scanning the table.
+    """
+
+    vendor = 'postgresql'
+
+    def get_create_index_sql(self):
+        qn = self.get_connection().ops.quote_name
+        return [
+            'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+            'CREATE INDEX IF NOT EXISTS %s ON %s USING gin ((UPPER(%s::text)) gin_trgm_ops)' % (
+                qn(self.index_name), qn(self.table), qn(self.column)
+            ),
+        ]
+
+    def get_drop_index_sql(self):
+        return ['DROP INDEX IF EXISTS %s' % self.get_connection().ops.quote_name(self.index_name)]
+
+
+class SQLiteFTSSearchBackend(DatabaseSearchBackend):
+    """
+    Searches SQLite with an FTS5 table using the trigram tokenizer, which requires SQLite 3.34 or newer.
+
+    The FTS5 table indexes the model's table as external content, and is kept in sync by triggers.
+    The model's primary key must be an integer.
+    """
+
+    vendor = 'sqlite'
+
+    def get_create_index_sql(self):
+        qn = self.get_connection().ops.quote_name
+        params = dict(
+            index=qn(self.index_name),
+            table=qn(self.table),
+            column=qn(self.column),
+            pk=qn(self.model._meta.pk.column),
+            insert_name=qn('%s_ai' % self.index_name),
+            delete_name=qn('%s_ad' % self.index_name),
+            update_name=qn('%s_au' % self.index_name),
+        )
+        return [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %(index)s USING fts5("
+            "%(column)s, content=%(table)s, content_rowid=%(pk)s, tokenize='trigram')" % params,
+            "CREATE TRIGGER IF NOT EXISTS %(insert_name)s AFTER INSERT ON %(table)s BEGIN "
+            "INSERT INTO %(index)s(rowid, %(column)s) VALUES (new.%(pk)s, new.%(column)s); END" % params,
+            "CREATE TRIGGER IF NOT EXISTS %(delete_name)s AFTER DELETE ON %(table)s BEGIN "
+            "INSERT INTO %(index)s(%(index)s, rowid, %(column)s) VALUES ('delete', old.%(pk)s, old.%(column)s); END" % params,
+            "CREATE TRIGGER IF NOT EXISTS %(update_name)s AFTER UPDATE OF %(column)s ON %(table)s BEGIN "
+            "INSERT INTO %(index)s(%(index)s, rowid, %(column)s) VALUES ('delete', old.%(pk)s, old.%(column)s); "
+            "INSERT INTO %(index)s(rowid, %(column)s) VALUES (new.%(pk)s, new.%(column)s); END" % params,
+            "INSERT INTO %(index)s(%(index)s) VALUES ('rebuild')" % params,
+        ]
+
+    def get_drop_index_sql(self):
+        qn = self.get_connection().ops.quote_name
+        return ['DROP TRIGGER IF EXISTS %s' % qn('%s_%s' % (self.index_name, suffix)) for suffix in ('ai', 'ad', 'au')] \
+            + ['DROP TABLE IF EXISTS %s' % qn(self.index_name)]
+
+    def search(self, q, limit):
+        # FTS5 doesn't use the index for a LIKE with an ESCAPE clause, so terms with wildcards can't be escaped,
+        # and are searched in the model's table instead.
+        if not self.is_supported() or '%' in q or '_' in q:
+            return super().search(q, limit)
+        connection = self.get_connection()
+        qn = connection.ops.quote_name
+        sql = "SELECT DISTINCT %(column)s FROM %(index)s WHERE %(column)s LIKE %%s ORDER BY %(column)s LIMIT %%s" % dict(
+            index=qn(self.index_name),
+            column=qn(self.column),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, ['%' + q + '%', limit])
+            return [self.field.to_python(row[0]) for row in cursor.fetchall()]
@@ -0,0 +1,280 @@
+"""
+Export formats that share CSVModelAdminMixin's header resolution.
+
+Each serializer receives the resolved field names and header labels, and writes rows
+one batch at a time, so memory usage is constant regardless of the number of records.
+"""
+import csv
+import datetime
+import decimal
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .utils import iter_batches
+
+
+class BaseExportSerializer(object):
+    """
+    Writes export rows, given as dictionaries keyed by field name, to a binary file.
+    """
+
+    extension = None
+
+    content_type = 'application/octet-stream'
+
+    # If true, values other than strings keep their Python type instead of being converted to text.
+    typed = False
+
+    # If true, iter_chunks() generates the output incrementally, so it can be streamed.
+    # Otherwise, the output must be written to a seekable file.
+    streaming = False
+
+    batch_size = 2000
+
+    def __init__(self, fieldnames, header_data, batch_size=None, fields=None):
+        self.fieldnames = list(fieldnames)
+        self.header_data = header_data
+        self.batch_size = batch_size or self.batch_size
+        # {field name: model field}, for the columns read directly from a model field.
+        self.fields = fields or {}
+
+    def write(self, rows, fout):
+        """
+        Writes all rows to the given binary file.
+
+        Returns the number of rows written.
+        """
+        raise NotImplementedError
+
+
+class StreamingExportSerializer(BaseExportSerializer):
+    """
+    Generates the output one batch at a time, so it can be streamed in the response.
+    """
+
+    streaming = True
+
+    def iter_chunks(self, rows):
+        raise NotImplementedError
+
+    def write(self, rows, fout):
+        written = 0
+
+        def counted(rows):
+            nonlocal written
+            for row in rows:
+                written += 1
+                yield row
+
+        for chunk in self.iter_chunks(counted(rows)):
+            fout.write(chunk)
+        return written
+
+
+class CSVSerializer(StreamingExportSerializer):
+
+    extension = 'csv'
+
+    content_type = 'text/csv'
+
+    quoting = csv.QUOTE_MINIMAL
+
+    def iter_chunks(self, rows):
+        lines = []
+
+        class Buffer(object):
+
+            def write(self, value):
+                lines.append(value)
+
+        writer = csv.DictWriter(Buffer(), fieldnames=self.fieldnames, quoting=self.quoting)
+        writer.writerow(self.header_data)
+        for batch in iter_batches(rows, self.batch_size):
+            writer.writerows(batch)
+            yield ''.join(lines).encode('utf-8')
+            del lines[:]
+
+
+class JSONLinesSerializer(StreamingExportSerializer):
+    """
+    Writes one JSON object per line, keyed by header label.
+    """
+
+    extension = 'jsonl'
+
+    content_type = 'application/x-ndjson'
+
+    typed = True
+
+    def iter_chunks(self, rows):
+        encoder = DjangoJSONEncoder()
+        keys = [(name, str(self.header_data.get(name, name))) for name in self.fieldnames]
+        for batch in iter_batches(rows, self.batch_size):
+            yield ''.join(encoder.encode({label: row.get(name) for name, label in keys}) + '\n' for row in batch).encode('utf-8')
+
+
+class XLSXSerializer(BaseExportSerializer):
+    """
+    Writes an Excel workbook using openpyxl's write-only mode, which streams rows
+    to a temporary file instead of holding the workbook in memory.
+    """
+
+    extension = 'xlsx'
+
+    content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    typed = True
+
+    def convert(self, value):
+        # Excel can't store timezones or arbitrary objects.
+        if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+            return value.replace(tzinfo=None)
+        if value is None or isinstance(value, (str, int, float, decimal.Decimal, datetime.date, datetime.time)):
+            return value
+        return str(value)
+
+    def write(self, rows, fout):
+        try:
+            from openpyxl import Workbook # pylint: disable=import-outside-toplevel
+        except ImportError as exc:
+            raise ImportError('The XLSX export format requires openpyxl to be installed.') from exc
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append([str(self.header_data.get(name, name)) for name in self.fieldnames])
+        written = 0
+        for row in rows:
+            ws.append([self.convert(row.get(name)) for name in self.fieldnames])
+            written += 1
+        wb.save(fout)
+        return written
+
+
+class ParquetSerializer(BaseExportSerializer):
+    """
+    Writes a columnar Parquet file using pyarrow, with one row group per batch,
+    for loading into dataframes.
+    """
+
+    extension = 'parquet'
+
+    content_type = 'application/vnd.apache.parquet'
+
+    typed = True
+
+    # {Django internal field type: name of the pyarrow type function}
+    field_types = {
+        'AutoField': 'int64',
+        'BigAutoField': 'int64',
+        'SmallAutoField': 'int64',
+        'IntegerField': 'int64',
+        'BigIntegerField': 'int64',
+        'SmallIntegerField': 'int64',
+        'PositiveIntegerField': 'int64',
+        'PositiveSmallIntegerField': 'int64',
+        'PositiveBigIntegerField': 'int64',
+        'FloatField': 'float64',
+        'BooleanField': 'bool_',
+        'NullBooleanField': 'bool_',
+        'DateField': 'date32',
+    }
+
+    def convert(self, value):
+        if value is None or isinstance(value, (str, bool, int, float, decimal.Decimal, datetime.date, datetime.time)):
+            return value
+        return str(value)
+
+    def get_field_type(self, pa, field):
+        """
+        Returns the column type for values read from the given model field.
+        """
+        internal_type = field.get_internal_type()
+        if internal_type in self.field_types:
+            return getattr(pa, self.field_types[internal_type])()
+        if internal_type == 'DecimalField' and field.max_digits and field.max_digits <= 38:
+            return pa.decimal128(field.max_digits, field.decimal_places)
+        if internal_type == 'DateTimeField':
+            return pa.timestamp('us', tz='UTC' if settings.USE_TZ else None)
+        if internal_type == 'TimeField':
+            return pa.time64('us')
+        return pa.string()
+
+    def get_value_type(self, pa, values):
+        """
+        Returns the column type for values that aren't read from a model field, based on those in the first batch.
+
+        Numbers are stored as floats, so fractional values in later batches still fit,
+        and decimals, whose precision can't be known in advance, and mixed types are stored as strings.
+        """
+        types = set(type(value) for value in values if value is not None)
+        if types == {bool}:
+            return pa.bool_()
+        if types and types <= {int, float}:
+            return pa.float64()
+        if len(types) == 1 and types <= {datetime.date, datetime.datetime, datetime.time}:
+            return pa.array(values).type
+        return pa.string()
+
+    def get_schema(self, pa, batch):
+        """
+        Returns the schema of the file, using the type of each column's model field if it has one,
+        and otherwise the types of its values in the first batch.
+        """
+        columns = []
+        for name in self.fieldnames:
+            if name in self.fields:
+                typ = self.get_field_type(pa, self.fields[name])
+            else:
+                typ = self.get_value_type(pa, [self.convert(row.get(name)) for row in batch])
+            columns.append((str(self.header_data.get(name, name)), typ))
+        return pa.schema(columns)
+
+    def get_array(self, pa, name, typ, batch):
+        column = [self.convert(row.get(name)) for row in batch]
+        if pa.types.is_string(typ):
+            column = [None if value is None else str(value) for value in column]
+        try:
+            return pa.array(column, type=typ)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError) as exc:
+            raise ValueError('The values of column %s no longer fit its type %s: %s' % (name, typ, exc)) from exc
+
+    def write(self, rows, fout):
+        try:
+            import pyarrow as pa # pylint: disable=import-outside-toplevel
+            import pyarrow.parquet as pq # pylint: disable=import-outside-toplevel
+        except ImportError as exc:
+            raise ImportError('The Parquet export format requires pyarrow to be installed.') from exc
+        writer = None
+        schema = None
+        written = 0
+        try:
+            for batch in iter_batches(rows, self.batch_size):
+                if schema is None:
+                    schema = self.get_schema(pa, batch)
+                    writer = pq.ParquetWriter(fout, schema)
+                arrays = [self.get_array(pa, name, field.type, batch) for name, field in zip(self.fieldnames, schema)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                written += len(batch)
+            if writer is None:
+                schema = pa.schema([(str(self.header_data.get(name, name)), pa.string()) for name in self.fieldnames])
+                pq.write_table(schema.empty_table(), fout)
+        finally:
+            if writer is not None:
+                writer.close()
+        return written
+
+
+# {format: serializer class}
+EXPORT_SERIALIZERS = {
+    'csv': CSVSerializer,
+    'jsonl': JSONLinesSerializer,
+    'xlsx': XLSXSerializer,
+    'parquet': ParquetSerializer,
+}
+
+
+def get_serializer(fmt):
+    try:
+        return EXPORT_SERIALIZERS[fmt]
+    except KeyError as exc:
+        raise ValueError('Unknown export format: %s' % fmt) from exc
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 from django.conf import settings
 
 # Paths that will allow field values to be searched for Ajax list filters.
@@ -12,3 +15,18 @@ settings.DAS_MAX_AJAX_SEARCH_RESULTS = getattr(settings, 'DAS_MAX_AJAX_SEARCH_RE
 settings.DAS_AJAX_SEARCH_DEFAULT_CACHE_SECONDS = getattr(settings, 'DAS_AJAX_SEARCH_DEFAULT_CACHE_SECONDS', 3600)
 
 settings.DAS_AJAX_SEARCH_PATH_FIELDS = getattr(settings, 'DAS_AJAX_SEARCH_PATH_FIELDS', {})
+
+# The directory where background export jobs write their files.
+settings.DAS_EXPORT_SPOOL_DIR = getattr(settings, 'DAS_EXPORT_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'admin_steroids_exports'))
+
+# How background export jobs are run once submitted from admin.
+# By default (None), jobs are left pending for the run_export_jobs management command, run from a separate worker.
+# Can be "thread" or "process" to run them in a pool inside the web process instead, competing with
+# the web workers for CPU and memory.
+settings.DAS_EXPORT_EXECUTOR = getattr(settings, 'DAS_EXPORT_EXECUTOR', None)
+
+settings.DAS_EXPORT_MAX_WORKERS = getattr(settings, 'DAS_EXPORT_MAX_WORKERS', 2)
+
+# A running export job that hasn't recorded a checkpoint for this many seconds is assumed dead,
+# so run_export_jobs --resume can take it over.
+settings.DAS_EXPORT_JOB_TIMEOUT_SECONDS = getattr(settings, 'DAS_EXPORT_JOB_TIMEOUT_SECONDS', 600)
@@ -1,6 +1,7 @@
 import re
 
 from django import template
+from django.contrib.admin.templatetags.admin_list import pagination
 from django.template import (
     Variable,
 )
@@ -41,3 +42,11 @@ def setvar(parser, token):
         new_val = new_val[1:-1]
         is_literal = True
     return SetVarNode(new_val, var_name, is_literal)
+
+
+@register.inclusion_tag('admin_steroids/pagination.html')
+def estimated_pagination(cl):
+    """
+    Renders the changelist's pagination like the admin's pagination tag, showing estimated counts as "about N".
+    """
+    return pagination(cl)
@@ -1,7 +1,7 @@
 from django.contrib import admin
 
-from admin_steroids.options import BetterRawIdFieldsModelAdmin
-from admin_steroids.tests.models import Person
+from admin_steroids.options import BaseModelAdmin, BetterRawIdFieldsModelAdmin, CSVModelAdminMixin
+from admin_steroids.tests.models import Person, Contact
 
 
 class PersonAdmin(BetterRawIdFieldsModelAdmin):
@@ -13,4 +13,24 @@ class PersonAdmin(BetterRawIdFieldsModelAdmin):
     raw_id_fields = ('associates',)
 
 
+class PersonCSVAdmin(CSVModelAdminMixin, BaseModelAdmin):
+    """
+    Not registered, since Person already has an admin, but used to test CSV exports.
+    """
+
+    list_display = ('id', 'name')
+
+
 admin.site.register(Person, PersonAdmin)
+
+
+class ContactAdmin(CSVModelAdminMixin, BaseModelAdmin):
+
+    list_display = ('id', 'email', 'person')
+
+    extra_csv_fields = ('person__name',)
+
+    csv_async = True
+
+
+admin.site.register(Contact, ContactAdmin)
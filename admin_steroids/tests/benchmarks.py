@@ -0,0 +1,288 @@
+"""
+Microbenchmarks for performance sensitive code paths.
+
+Run all benchmarks with:
+
+    python -m admin_steroids.tests.benchmarks
+
+or a specific benchmark with:
+
+    python -m admin_steroids.tests.benchmarks csv_accessors
+
+"""
+import html
+import os
+import re
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'admin_steroids.tests.settings')
+
+import django # pylint: disable=wrong-import-position
+
+django.setup()
+
+# pylint: disable=wrong-import-position
+from django.contrib import admin
+from django.db import connection
+from django.template import Template
+from django.test import RequestFactory, override_settings
+from django.urls import path
+
+from admin_steroids import formatters
+from admin_steroids import serializers
+from admin_steroids import utils
+from admin_steroids import widgets
+from admin_steroids.options import to_ascii
+from admin_steroids.tests.admin import PersonCSVAdmin
+from admin_steroids.tests.models import Person
+
+_benchmarks = {}
+
+
+def benchmark(func):
+    _benchmarks[func.__name__] = func
+    return func
+
+
+def rate(func, n, repeat=3):
+    """
+    Returns the best observed rate, in calls per second, of func, which is assumed to process n items.
+    """
+    best = 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        td = time.perf_counter() - t0
+        best = max(best, n / td)
+    return best
+
+
+def report(name, results):
+    print('%s:' % name)
+    base = None
+    for label, value, unit in results:
+        if base is None:
+            base = value
+        print('    %-30s %12.0f %s/sec (%.2fx)' % (label, value, unit, value / base))
+
+
+class BenchmarkPersonCSVAdmin(PersonCSVAdmin):
+
+    def name_upper(self, obj):
+        return obj.name.upper()
+
+    name_upper.short_description = 'Name upper'
+
+
+def get_csv_record_data_baseline(model_admin, raw_headers, r):
+    """
+    The per-record loop of csv_export() prior to get_csv_accessors(), which inspected every header on every record.
+    """
+
+    def get_attr(obj, name):
+        cursor = obj
+        for part in name.split('__'):
+            cursor = getattr(cursor, part, None)
+            if callable(cursor):
+                cursor = cursor()
+        if cursor == obj:
+            return None
+        return cursor
+
+    data = {}
+    for name in raw_headers:
+        if isinstance(r, dict) and name in r:
+            data[name] = r[name]
+            continue
+        if callable(name):
+            name_key = name.name
+            if hasattr(name, 'plaintext'):
+                data[name_key] = to_ascii(name(r, plaintext=True))
+            else:
+                data[name_key] = to_ascii(name(r))
+        elif isinstance(name, (tuple, list)) and len(name) == 2:
+            name_key, name_key_verbose = name
+            if hasattr(model_admin, name_key):
+                data[name_key] = to_ascii(getattr(model_admin, name_key))
+            else:
+                data[name_key] = to_ascii(getattr(r, name_key))
+        elif isinstance(name, str) and hasattr(model_admin, name):
+            name_key = name
+            data[name_key] = to_ascii(getattr(model_admin, name)(r))
+        elif isinstance(name, str) and hasattr(r, name):
+            name_key = name
+            data[name_key] = to_ascii(getattr(r, name))
+        else:
+            name_key = name
+            data[name_key] = to_ascii(get_attr(r, name))
+        if callable(data[name_key]):
+            data[name_key] = to_ascii(data[name_key]())
+        if model_admin.csv_remove_html:
+            data[name_key] = utils.remove_html(data[name_key])
+    return data
+
+
+@benchmark
+def csv_accessors(rows=5000, columns=40):
+    """
+    Compares rendering CSV rows with the loop csv_export used to run for every record,
+    against resolving the headers once into accessors.
+    """
+    model_admin = BenchmarkPersonCSVAdmin(Person, admin.site)
+    # Isolate the cost of resolving values from the cost of stripping HTML.
+    model_admin.csv_remove_html = False
+    request = RequestFactory().get('/')
+    header_types = [
+        'id',
+        'name',
+        'name_upper',
+        'pk',
+        'name__upper',
+        formatters.CenterFormat('name'),
+        formatters.NbspFormat('name'),
+    ]
+    raw_headers = [header_types[i % len(header_types)] for i in range(columns)]
+    records = [Person(id=i, name='Person <b>%i</b>' % i) for i in range(rows)]
+
+    def baseline():
+        for r in records:
+            get_csv_record_data_baseline(model_admin, raw_headers, r)
+
+    def compiled():
+        accessors = model_admin.get_csv_accessors(request, raw_headers, records[0])
+        for r in records:
+            model_admin.get_csv_record_data(request, accessors, r)
+
+    report(
+        'csv_accessors (%i columns)' % columns, [
+            ('per record loop', rate(baseline, rows), 'rows'),
+            ('resolved once', rate(compiled, rows), 'rows'),
+        ]
+    )
+
+
+def remove_html_bs4(s):
+    """
+    The implementation of utils.remove_html() prior to the single-pass HTMLStripper.
+    """
+    s = str(s)
+    s = s.replace('&nbsp;', ' ')
+    s = html.unescape(s)
+    try:
+        from bs4 import BeautifulSoup # pylint: disable=import-outside-toplevel
+        soup = BeautifulSoup(s, 'html.parser')
+        s = ''.join(soup.find_all(string=True))
+    except ImportError:
+        s = re.sub("<.*?>", '', s)
+    return s
+
+
+@benchmark
+def remove_html(rows=20000):
+    """
+    Compares stripping HTML from typical formatter output with BeautifulSoup against utils.remove_html().
+    """
+    dollars = formatters.DollarFormat('amount')
+    values = []
+    for i in range(rows):
+        values.append(dollars.format(i * 1.5))
+        values.append('<a href="/admin/tests/person/%i/change/" target="_blank">Person %i</a>' % (i, i))
+        values.append('Person %i' % i)
+        values.append(i)
+
+    for value in values[:4]:
+        assert utils.remove_html(value) == remove_html_bs4(value), value
+
+    def old():
+        for value in values:
+            remove_html_bs4(value)
+
+    def new():
+        for value in values:
+            utils.remove_html(value)
+
+    try:
+        import bs4 # pylint: disable=import-outside-toplevel,unused-import
+        old_label = 'BeautifulSoup'
+    except ImportError:
+        old_label = 'regex (bs4 not installed)'
+    report('remove_html', [
+        (old_label, rate(old, len(values), repeat=1), 'values'),
+        ('HTMLStripper', rate(new, len(values), repeat=1), 'values'),
+    ])
+
+
+@benchmark
+def export_formats(rows=20000):
+    """
+    Measures the throughput of each export format, writing to a temporary file.
+    """
+    model_admin = BenchmarkPersonCSVAdmin(Person, admin.site)
+    request = RequestFactory().get('/')
+    raw_headers = ['id', 'name', 'name_upper', formatters.DollarFormat('id')]
+    records = [Person(id=i, name='Person <b>%i</b>' % i) for i in range(rows)]
+    results = []
+    for fmt in sorted(serializers.EXPORT_SERIALIZERS):
+        serializer_class = serializers.EXPORT_SERIALIZERS[fmt]
+
+        def export(serializer_class=serializer_class):
+            fieldnames, header_data, data = model_admin.get_export_rows(request, records, raw_headers, typed=serializer_class.typed)
+            with tempfile.TemporaryFile() as fout:
+                serializer_class(fieldnames, header_data).write(data, fout)
+
+        try:
+            results.append((fmt, rate(export, rows, repeat=1), 'rows'))
+        except ImportError as exc:
+            print('Skipping %s: %s' % (fmt, exc))
+    report('export_formats', results)
+
+
+class BenchmarkURLConf(object):
+    """
+    Serves the admin, so widgets can link to change pages.
+    """
+
+    urlpatterns = [path('admin/', admin.site.urls)]
+
+
+class UncompiledForeignKeyTextInput(widgets.ForeignKeyTextInput):
+    """
+    Parses the template on every render, as ForeignKeyTextInput used to.
+    """
+
+    @classmethod
+    def get_template(cls):
+        return Template(cls.template_source)
+
+
+@benchmark
+def foreign_key_text_input(forms=500):
+    """
+    Compares rendering a formset's worth of ForeignKeyTextInput widgets by parsing the template on every render
+    against using the template compiled once.
+    """
+    connection.creation.create_test_db(verbosity=0)
+    Person.objects.bulk_create([Person(id=i + 1, name='Person %i' % i) for i in range(forms)])
+    with override_settings(ROOT_URLCONF=BenchmarkURLConf, STATIC_URL='/static/'), utils.object_cache():
+        results = []
+        for label, widget_class in (('parsed per render', UncompiledForeignKeyTextInput), ('compiled once', widgets.ForeignKeyTextInput)):
+            form_widgets = [widget_class(Person, i + 1) for i in range(forms)]
+
+            def render(form_widgets=form_widgets):
+                for i, widget in enumerate(form_widgets):
+                    widget.render('form-%i-person' % i, i + 1, attrs={'id': 'id_form-%i-person' % i})
+
+            results.append((label, rate(render, forms), 'renders'))
+    report('foreign_key_text_input', results)
+
+
+def main(names=None):
+    names = names or sorted(_benchmarks)
+    for name in names:
+        _benchmarks[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
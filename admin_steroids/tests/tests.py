@@ -8,17 +8,53 @@ import time
 import socket
 import warnings
 import csv
+import io
+import unicodedata
+import copy
+import decimal
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
 from django.core import mail
+from django.core.cache import cache
 from django.test import TestCase
 from django.test import Client
 from django.core.management import call_command
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
 from django.test import override_settings
+from django.test import RequestFactory
+from django.contrib import admin
+from django.contrib.admin.models import LogEntry
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.urls import reverse, NoReverseMatch
+from django.forms import modelformset_factory
+from django.db import connection
+from django.db.models import AutoField, DecimalField, ForeignKey, CASCADE
+from django.core.paginator import EmptyPage
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
 
 # pylint: disable=C0412
 from admin_steroids import utils
+from admin_steroids import formatters
+from admin_steroids import widgets
+from admin_steroids import filters
+from admin_steroids import models
+from admin_steroids import exports
+from admin_steroids import options
+from admin_steroids import serializers
+from admin_steroids import search
+from admin_steroids.search import TrigramIndexSearchBackend, SQLiteFTSSearchBackend
 from admin_steroids.tests.models import Person, Contact
+from admin_steroids.tests.admin import PersonCSVAdmin, ContactAdmin
+from admin_steroids.models import ExportJob
+from admin_steroids.views import ExportJobDownloadView, ModelFieldSearchView
+from admin_steroids.queryset import ApproxCountQuerySet, CachedCountQuerySet, CountlessPaginator, get_vendor
 
 warnings.simplefilter('error', RuntimeWarning)
 
@@ -216,3 +252,974 @@ class Tests(TestCase):
         response = c.get('/admin/tests/person/%i/change/' % bob.id, follow=True)
         # print(response.content)
         self.assertTrue('/admin/tests/person/?id__in=' in str(response.content).lower())
+
+    def test_csv_export_streaming(self):
+        Person.objects.bulk_create([Person(name='Person %04i' % i) for i in range(1100)])
+        request = RequestFactory().get('/admin/tests/person/')
+
+        # By default, the export is buffered and capped at the record limit.
+        model_admin = PersonCSVAdmin(Person, admin.site)
+        response = model_admin.csv_export(request, Person.objects.all())
+        lines = response.content.decode('utf-8').strip().split('\r\n')
+        self.assertEqual(lines[0], 'Id,Name')
+        self.assertEqual(len(lines), 1 + model_admin.csv_record_limit)
+        self.assertTrue(lines[1].endswith(',Person 0000'))
+
+        # When streaming with no limit, all records are exported.
+        model_admin.csv_streaming = True
+        model_admin.csv_record_limit = None
+        model_admin.csv_chunk_size = 100
+        response = model_admin.csv_export(request, Person.objects.all())
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode('utf-8').strip().split('\r\n')
+        self.assertEqual(lines[0], 'Id,Name')
+        self.assertEqual(len(lines), 1 + 1100)
+        self.assertTrue(lines[-1].endswith(',Person 1099'))
+
+        # The changelist's ordering is kept across chunks, in every format.
+        qs = Person.objects.order_by('-name')
+        self.assertFalse(options.is_pk_ordered(qs))
+        self.assertTrue(options.is_pk_ordered(Person.objects.order_by('id')))
+        response = model_admin.csv_export(request, qs)
+        lines = b''.join(response.streaming_content).decode('utf-8').strip().split('\r\n')
+        self.assertEqual([line.split(',')[1] for line in lines[1:]], ['Person %04i' % i for i in reversed(range(1100))])
+        response = model_admin.jsonl_export(request, qs)
+        lines = b''.join(response.streaming_content).decode('utf-8').strip().split('\n')
+        self.assertEqual([json.loads(line)['Name'] for line in lines], ['Person %04i' % i for i in reversed(range(1100))])
+
+    def test_csv_accessors(self):
+        bob = Person.objects.create(name='Bob Smith')
+        request = RequestFactory().get('/admin/tests/person/')
+        model_admin = PersonCSVAdmin(Person, admin.site)
+        raw_headers = ['id', 'name__upper', ('pk', 'Key'), formatters.NbspFormat('name')]
+        accessors = model_admin.get_csv_accessors(request, raw_headers, bob)
+        data = model_admin.get_csv_record_data(request, accessors, bob)
+        self.assertEqual(data, {'id': str(bob.id), 'name__upper': 'BOB SMITH', 'pk': str(bob.pk), 'name': 'Bob Smith'})
+
+        # Dictionary records are read directly.
+        record = {'id': 123, 'name': '<b>Bob</b>'}
+        accessors = model_admin.get_csv_accessors(request, ['id', 'name'], record)
+        data = model_admin.get_csv_record_data(request, accessors, record)
+        self.assertEqual(data, record)
+
+    def test_csv_export_values(self):
+        for i in range(5):
+            person = Person.objects.create(name='Person %i' % i)
+            Contact.objects.create(person=person, email='person%i@example.com' % i)
+        request = RequestFactory().get('/admin/tests/contact/')
+        model_admin = PersonCSVAdmin(Contact, admin.site)
+        raw_headers = ['id', 'email', 'person__name']
+        qs = Contact.objects.all().order_by('id')
+        expected = model_admin.csv_export(request, qs, raw_headers=raw_headers).content
+
+        # Plain fields are exported from values_list() in a single query.
+        model_admin.csv_use_values = True
+        self.assertEqual(model_admin.get_csv_values_lookups(request, raw_headers, qs), raw_headers)
+        with self.assertNumQueries(1):
+            response = model_admin.csv_export(request, qs, raw_headers=raw_headers)
+        self.assertEqual(response.content, expected)
+
+        # Mixed headers fall back to model instances, but still join the related records.
+        raw_headers = raw_headers + [formatters.NbspFormat('person__name', 'Name')]
+        self.assertEqual(model_admin.get_csv_values_lookups(request, raw_headers, qs), None)
+        with self.assertNumQueries(1):
+            response = model_admin.csv_export(request, qs, raw_headers=raw_headers)
+        self.assertTrue(b'Person 4,Person 4' in response.content)
+
+    def test_csv_export_async(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(DAS_EXPORT_EXECUTOR=None, DAS_EXPORT_SPOOL_DIR=spool_dir):
+                user = get_user_model().objects.create(username='admin', is_staff=True, is_superuser=True)
+                for i in range(5):
+                    person = Person.objects.create(name='Person %i' % i)
+                    Contact.objects.create(person=person, email='person%i@example.com' % i)
+                request = RequestFactory().get('/admin/tests/contact/')
+                request.user = user
+                request._messages = CookieStorage(request)
+
+                # The action only records the job, since no executor is configured.
+                model_admin = ContactAdmin(Contact, admin.site)
+                model_admin.csv_export_async(request, Contact.objects.filter(email__startswith='person').order_by('id'))
+                job = ExportJob.objects.get()
+                self.assertEqual(job.status, ExportJob.PENDING)
+                response = ExportJobDownloadView.as_view()(request, job_id=job.id)
+                self.assertEqual(response.status_code, 202)
+
+                # The worker writes the file to the spool directory.
+                call_command('run_export_jobs')
+                job = ExportJob.objects.get()
+                self.assertEqual(job.status, ExportJob.DONE, job.error)
+                self.assertEqual(job.written, 5)
+                self.assertEqual(os.path.dirname(job.path), spool_dir)
+                with open(job.path) as fin:
+                    lines = fin.read().strip().split('\n')
+                self.assertEqual(lines[0].strip(), 'Id,Email,Person,Person__Name')
+                self.assertEqual(len(lines), 6)
+
+                response = ExportJobDownloadView.as_view()(request, job_id=job.id)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(b'person4@example.com' in b''.join(response.streaming_content))
+
+            # An unknown executor fails the request, instead of the job after it's committed.
+            with override_settings(DAS_EXPORT_EXECUTOR='celery'):
+                self.assertIsNone(exports._executor)
+                with self.assertRaises(ImproperlyConfigured):
+                    model_admin.csv_export_async(request, Contact.objects.all())
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_export_job_request(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(DAS_EXPORT_EXECUTOR=None, DAS_EXPORT_SPOOL_DIR=spool_dir):
+                user = get_user_model().objects.create(username='admin', is_staff=True, is_superuser=True)
+                for i in range(3):
+                    person = Person.objects.create(name='Person %i' % i)
+                    Contact.objects.create(person=person, email='person%i@example.com' % i)
+
+                # The ModelAdmin registered for Person doesn't export CSV, so a default one is used.
+                job = ExportJob.create_for_queryset(Person.objects.all(), user=user)
+                call_command('run_export_jobs')
+                job.refresh_from_db()
+                self.assertEqual(job.status, ExportJob.DONE, job.error)
+                self.assertEqual(job.written, 3)
+
+                # The ModelAdmin sees the user who requested the export.
+                users = []
+
+                def get_csv_queryset(model_admin, request, qs):
+                    users.append(request.user)
+                    return qs.filter(person__name='Person 1')
+
+                with mock.patch.object(ContactAdmin, 'get_csv_queryset', get_csv_queryset):
+                    job = ExportJob.create_for_queryset(Contact.objects.all(), user=user)
+                    call_command('run_export_jobs')
+                    job.refresh_from_db()
+                    self.assertEqual(job.status, ExportJob.DONE, job.error)
+                    self.assertEqual(job.written, 1)
+                    self.assertEqual(users, [user])
+
+                    # The parallel export renders as the given user too.
+                    path = os.path.join(spool_dir, 'contacts.csv')
+                    self.assertEqual(exports.export_csv_parallel(Contact.objects.all(), path, workers=1, shards=2, user=user), 1)
+                    self.assertEqual(users, [user, user, user])
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_command_export_model_csv(self):
+        for i in range(10):
+            person = Person.objects.create(name='Person %i' % i)
+            Contact.objects.create(person=person, email='person%i@example.com' % i)
+        Contact.objects.filter(person__name='Person 3').delete()
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        try:
+            call_command('export_model_csv', 'tests.Contact', output=path, workers=1, shards=4)
+            with open(path) as fin:
+                lines = fin.read().strip().split('\n')
+            self.assertEqual(lines[0].strip(), 'Id,Email,Person,Person__Name')
+            self.assertEqual(len(lines), 10)
+            # Shards are concatenated in primary key order.
+            ids = [int(line.split(',')[0]) for line in lines[1:]]
+            self.assertEqual(ids, sorted(Contact.objects.values_list('id', flat=True)))
+        finally:
+            os.remove(path)
+
+    def test_remove_html(self):
+        # The expected values match the text BeautifulSoup extracts with its html.parser tree.
+        corpus = [
+            (123, '123'),
+            ('Plain text', 'Plain text'),
+            ('<span style="display:inline-block; width:100%; text-align:right;">$1,234.00</span>', '$1,234.00'),
+            ('<a href="/admin/tests/person/1/change/" target="_blank">Bob &lt;bob&gt;</a>', 'Bob '),
+            ('a&nbsp;b &amp; c', 'a b & c'),
+            ('a<!-- c -->b', 'a c b'),
+            ('<!DOCTYPE html><p>x</p>', 'htmlx'),
+            ('<script>var a=1<2;</script>t', 'var a=1<2;t'),
+            ('a < b', 'a < b'),
+            ('<b>1</b>\n<i>2</i>', '1\n2'),
+            ('<![CDATA[zz]]>q', 'zzq'),
+            ('a<b', 'a<b'),
+            ('<p>unclosed <b>bold', 'unclosed bold'),
+        ]
+        for value, expected in corpus:
+            self.assertEqual(utils.remove_html(value), expected)
+
+    def test_export_formats(self):
+        for i in range(5):
+            Person.objects.create(name='Person <b>%i</b>' % i)
+        request = RequestFactory().get('/admin/tests/person/')
+        model_admin = PersonCSVAdmin(Person, admin.site)
+        qs = Person.objects.all().order_by('id')
+
+        response = model_admin.jsonl_export(request, qs)
+        lines = b''.join(response.streaming_content).decode('utf-8').strip().split('\n')
+        self.assertEqual(len(lines), 5)
+        # Values keep their types, but HTML is still stripped.
+        self.assertEqual(json.loads(lines[0]), {'Id': qs[0].id, 'Name': 'Person 0'})
+
+        try:
+            import openpyxl # pylint: disable=import-outside-toplevel
+            response = model_admin.xlsx_export(request, qs)
+            wb = openpyxl.load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+            rows = list(wb.active.values)
+            self.assertEqual(rows[0], ('Id', 'Name'))
+            self.assertEqual(rows[-1], (qs[4].id, 'Person 4'))
+        except ImportError:
+            pass
+
+        try:
+            import pyarrow.parquet as pq # pylint: disable=import-outside-toplevel
+            response = model_admin.parquet_export(request, qs)
+            table = pq.read_table(io.BytesIO(b''.join(response.streaming_content)))
+            self.assertEqual(table.column_names, ['Id', 'Name'])
+            self.assertEqual(table.column('Name').to_pylist(), ['Person %i' % i for i in range(5)])
+        except ImportError:
+            pass
+
+    def test_parquet_schema(self):
+        try:
+            import pyarrow.parquet as pq # pylint: disable=import-outside-toplevel
+        except ImportError:
+            return
+        # Each batch has values the first one doesn't predict.
+        rows = [
+            {'id': 1, 'price': decimal.Decimal('1.50'), 'score': 1, 'note': 'a'},
+            {'id': 2, 'price': decimal.Decimal('2.5'), 'score': 2, 'note': None},
+            {'id': 3, 'price': decimal.Decimal('1234.50'), 'score': 1.5, 'note': 3},
+            {'id': 4, 'price': None, 'score': None, 'note': 'd'},
+            {'id': 5, 'price': decimal.Decimal('99999999.99'), 'score': 2 ** 40, 'note': 'e'},
+        ]
+        fieldnames = ['id', 'price', 'score', 'note']
+        header_data = {'id': 'Id', 'price': 'Price', 'score': 'Score', 'note': 'Note'}
+        fields = {'id': AutoField(primary_key=True), 'price': DecimalField(max_digits=10, decimal_places=2)}
+        fout = io.BytesIO()
+        written = serializers.ParquetSerializer(fieldnames, header_data, batch_size=2, fields=fields).write(iter(rows), fout)
+        self.assertEqual(written, 5)
+        table = pq.read_table(io.BytesIO(fout.getvalue()))
+        self.assertEqual(str(table.schema.field('Id').type), 'int64')
+        self.assertEqual(str(table.schema.field('Price').type), 'decimal128(10, 2)')
+        self.assertEqual(str(table.schema.field('Score').type), 'double')
+        self.assertEqual(str(table.schema.field('Note').type), 'string')
+        self.assertEqual(table.column('Id').to_pylist(), [1, 2, 3, 4, 5])
+        self.assertEqual(
+            table.column('Price').to_pylist(),
+            [decimal.Decimal('1.50'), decimal.Decimal('2.50'), decimal.Decimal('1234.50'), None, decimal.Decimal('99999999.99')]
+        )
+        self.assertEqual(table.column('Score').to_pylist(), [1, 2, 1.5, None, 2 ** 40])
+        self.assertEqual(table.column('Note').to_pylist(), ['a', None, '3', 'd', 'e'])
+
+        # Through the admin, model fields keep their type, even if a batch has no values.
+        for i in range(3):
+            Person.objects.create(name='Person %i' % i)
+        model_admin = PersonCSVAdmin(Person, admin.site)
+        model_admin.csv_chunk_size = 2
+        response = model_admin.parquet_export(RequestFactory().get('/admin/tests/person/'), Person.objects.order_by('id'))
+        table = pq.read_table(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(str(table.schema.field('Id').type), 'int64')
+        self.assertEqual(table.column('Name').to_pylist(), ['Person 0', 'Person 1', 'Person 2'])
+
+    def test_csv_export_resume(self):
+        people = Person.objects.bulk_create([Person(name='Person %02i' % i) for i in range(25)])
+        request = RequestFactory().get('/admin/tests/person/')
+        model_admin = PersonCSVAdmin(Person, admin.site)
+
+        # Records are paged by primary key, with a checkpoint after each chunk.
+        checkpoints = []
+        records = list(model_admin.iter_csv_records(request, Person.objects.all(), chunk_size=10, checkpoint=lambda pk, count: checkpoints.append(count)))
+        self.assertEqual(len(records), 25)
+        self.assertEqual(checkpoints, [10, 20, 25])
+        records = list(model_admin.iter_csv_records(request, Person.objects.all(), limit=12, chunk_size=10, after=records[4].pk))
+        self.assertEqual([_.name for _ in records], ['Person %02i' % i for i in range(5, 17)])
+
+        spool_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(DAS_EXPORT_EXECUTOR=None, DAS_EXPORT_SPOOL_DIR=spool_dir):
+                for i in range(5):
+                    person = Person.objects.create(name='Contact Person %i' % i)
+                    Contact.objects.create(person=person, email='person%i@example.com' % i)
+                job = ExportJob.create_for_queryset(Contact.objects.all())
+                call_command('run_export_jobs')
+                job.refresh_from_db()
+                with open(job.path, 'rb') as fin:
+                    expected = fin.read()
+
+                # Simulate a job interrupted after writing the header and the first two records.
+                lines = expected.split(b'\r\n')
+                partial = b'\r\n'.join(lines[:3]) + b'\r\n'
+                os.remove(job.path)
+                with open(job.path + '.part', 'wb') as fout:
+                    fout.write(partial + b'1,incomplete')
+                last_pk = int(lines[2].split(b',')[0])
+                ExportJob.objects.filter(id=job.id).update(status=ExportJob.FAILED, last_pk=str(last_pk), file_offset=len(partial), written=2)
+
+                # A job still recording checkpoints isn't taken over.
+                ExportJob.objects.filter(id=job.id).update(status=ExportJob.RUNNING, heartbeat=timezone.now())
+                call_command('run_export_jobs', resume=True)
+                job.refresh_from_db()
+                self.assertEqual(job.status, ExportJob.RUNNING)
+                self.assertEqual(job.written, 2)
+
+                # Once its checkpoints stop, it's resumed.
+                ExportJob.objects.filter(id=job.id).update(heartbeat=timezone.now() - timedelta(hours=1))
+                call_command('run_export_jobs', resume=True)
+                job.refresh_from_db()
+                self.assertEqual(job.status, ExportJob.DONE, job.error)
+                self.assertEqual(job.written, 5)
+                with open(job.path, 'rb') as fin:
+                    self.assertEqual(fin.read(), expected)
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_formatter_format_many(self):
+        for i in range(10):
+            person = Person.objects.create(name='Person %i' % i)
+            Contact.objects.create(person=person, email='person%i@example.com' % i)
+        ContentType.objects.get_for_model(Person)
+        formatter = formatters.ForeignKeyLink('person')
+        contacts = list(Contact.objects.all().order_by('id'))
+
+        # The related people are loaded with a single query for the whole batch.
+        with self.assertNumQueries(1):
+            values = formatter.format_many(contacts)
+        self.assertEqual(len(values), 10)
+        self.assertTrue('/admin/tests/person/%i/change/' % contacts[0].person_id in values[0])
+        with self.assertNumQueries(0):
+            self.assertEqual(formatter.format_many(contacts, plaintext=True), [_.person_id for _ in contacts])
+
+    def test_prefetch_related_counts(self):
+        people = [Person.objects.create(name='Person %i' % i) for i in range(3)]
+        Contact.objects.create(person=people[1], email='one@example.com')
+        Contact.objects.create(person=people[2], email='two@example.com')
+        Contact.objects.create(person=people[2], email='three@example.com')
+        ContentType.objects.get_for_model(Contact)
+        people = list(Person.objects.all().order_by('id'))
+
+        # The related records are counted with a single grouped query for the whole batch.
+        formatter = formatters.OneToManyLink('contact_set', id_param='person')
+        with self.assertNumQueries(1):
+            values = formatter.format_many(people)
+        self.assertEqual(values[0], 0)
+        self.assertTrue('/admin/tests/contact/%i/change/' % people[1].contact_set.get().id in values[1])
+        self.assertTrue('View 2' in values[2] and '/admin/tests/contact/?person=%i' % people[2].id in values[2])
+        with self.assertNumQueries(0):
+            self.assertTrue('View&nbsp;2' in utils.view_related_link(people[2], 'contact_set'))
+
+        # Names that aren't related managers, like plain attributes, are still formatted one by one.
+        formatter = formatters.OneToManyLink('id')
+        self.assertEqual(formatter.format_many(people), [formatter.format(person) for person in people])
+
+        # ManyToMany accessors are counted through their intermediate table.
+        people[0].associates.add(people[1], people[2])
+        utils.prefetch_related_counts(people, 'associates')
+        self.assertEqual(utils.get_related_count(people[0], 'associates'), (2, None))
+        self.assertEqual(utils.get_related_count(people[1], 'associates'), (1, people[0].id))
+
+    def test_admin_url_cache(self):
+        bob = Person.objects.create(name='Bob')
+        john = Person.objects.create(name='John')
+        utils.clear_admin_url_cache()
+        self.assertEqual(utils.get_admin_change_url(bob), '/admin/tests/person/%i/change/' % bob.id)
+
+        # Later URLs are built from the cached URL without looking up the content type or reversing.
+        with self.assertNumQueries(0):
+            self.assertEqual(utils.get_admin_change_url(john), '/admin/tests/person/%i/change/' % john.id)
+            self.assertEqual(utils.get_admin_changelist_url(Person), '/admin/tests/person/')
+            self.assertEqual(utils.get_admin_add_url(bob), '/admin/tests/person/add/')
+        self.assertEqual(utils.get_admin_change_url(Person(pk='a b')), reverse('admin:tests_person_change', args=('a b',)))
+
+        # Models without an admin aren't cached, so they resolve once one is registered.
+        with self.assertRaises(NoReverseMatch):
+            utils.get_admin_changelist_url(ContentType)
+        self.assertFalse([key for key in utils._admin_url_cache if key[0] is ContentType])
+
+    def test_StringWithTitle(self):
+        name = utils.StringWithTitle('tests', 'Test Records')
+        self.assertEqual(copy.copy(name).title(), 'Test Records')
+        self.assertEqual(copy.deepcopy(name).title(), 'Test Records')
+        self.assertEqual(copy.deepcopy(name), 'tests')
+
+    def test_VerboseManyToManyRawIdWidget_labels(self):
+        people = [Person.objects.create(name='Person %i' % i) for i in range(5)]
+        ContentType.objects.get_for_model(Person)
+        remote_field = Person._meta.get_field('associates').remote_field
+        widget = widgets.VerboseManyToManyRawIdWidget(remote_field, admin.site)
+        values = [str(people[3].id), '9999', str(people[1].id)]
+
+        # All the labels are loaded with one query, in the order given, with missing records marked.
+        with self.assertNumQueries(1):
+            label, url = widget.label_and_url_for_value(values)
+        self.assertEqual(label, '%s, ???, %s' % (people[3], people[1]))
+        self.assertEqual(url, '/admin/tests/person/?id__in=%s' % ','.join(values))
+        with self.assertNumQueries(1):
+            label = widget.label_for_value(','.join(values))
+        self.assertEqual(label.count('<strong>'), 2)
+        self.assertTrue(label.index(str(people[3])) < label.index('???') < label.index(str(people[1])))
+
+        # Labels past the limit are summarized.
+        widget = widgets.VerboseManyToManyRawIdWidget(remote_field, admin.site, max_labels=2)
+        label, url = widget.label_and_url_for_value([str(_.id) for _ in people])
+        self.assertEqual(label, '%s, %s, +3 more' % (people[0], people[1]))
+        self.assertEqual(url.count(','), 4)
+
+    def test_object_cache(self):
+        people = [Person.objects.create(name='Person %i' % i) for i in range(2)]
+        for i in range(6):
+            Contact.objects.create(person=people[i % 2], email='contact%i@example.com' % i)
+        ContentType.objects.get_for_model(Person)
+        remote_field = Contact._meta.get_field('person').remote_field
+        ContactFormSet = modelformset_factory(
+            Contact, fields=('person', 'email'), widgets={'person': widgets.VerboseForeignKeyRawIdWidget(remote_field, admin.site)}
+        )
+
+        # Each person is loaded once, in a single query for the whole formset.
+        with utils.object_cache():
+            formset = ContactFormSet(queryset=Contact.objects.all().order_by('id'))
+            forms = list(formset.forms)
+            widgets.defer_form_objects(forms)
+            with self.assertNumQueries(1):
+                html = ''.join(str(form['person']) for form in forms)
+        self.assertEqual(html.count('/admin/tests/person/%i/change/' % people[0].id), 3)
+        self.assertEqual(html.count('/admin/tests/person/%i/change/' % people[1].id), 3)
+
+        # Missing and invalid keys are cached as missing.
+        object_cache = utils.ObjectCache()
+        with self.assertNumQueries(1):
+            self.assertEqual(object_cache.get(Person, people[0].id), people[0])
+            self.assertEqual(object_cache.get(Person, str(people[0].id)), people[0])
+            self.assertEqual(object_cache.get(Person, 'abc'), None)
+        with self.assertNumQueries(1):
+            self.assertEqual(object_cache.get(Person, 9999), None)
+            self.assertEqual(object_cache.get(Person, 9999), None)
+
+    @override_settings(STATIC_URL='/static/')
+    def test_ForeignKeyTextInput(self):
+        bob = Person.objects.create(name='Bob')
+        ContentType.objects.get_for_model(Person)
+        template = widgets.ForeignKeyTextInput.get_template()
+
+        # The template is compiled once and shared by every widget.
+        with utils.object_cache():
+            html = []
+            for i in range(3):
+                widget = widgets.ForeignKeyTextInput(Person, bob.id if i else 'abc')
+                self.assertTrue(widget.get_template() is template)
+                html.append(widget.render('person', bob.id, attrs={'id': 'id_person_%i' % i}))
+        self.assertTrue('/admin/tests/person/%i/change/' % bob.id not in html[0])
+        self.assertTrue('/admin/tests/person/%i/change/' % bob.id in html[1])
+        self.assertTrue('/static/admin/img/selector-search.gif' in html[2])
+        self.assertTrue('value="%i"' % bob.id in html[2])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_distinct_value_index(self):
+        cache.clear()
+        bob = Person.objects.create(name='Bob')
+        john = Person.objects.create(name='John')
+        Contact.objects.create(person=bob, email='bob1@example.com')
+
+        # Values that don't fit in FieldValueCount.value can't be counted.
+        with self.assertRaises(ValueError):
+            models.register_distinct_value_index(LogEntry, 'change_message')
+        with self.assertRaises(ValueError):
+            models.register_distinct_value_index(LogEntry, 'object_id')
+        self.assertFalse(models.has_distinct_value_index(LogEntry, 'change_message'))
+
+        models.register_distinct_value_index(Contact, 'person')
+        try:
+            call_command('refresh_distinct_values', 'tests.Contact.person')
+            self.assertEqual(models.FieldValueCount.objects.get_values(Contact, 'person'), [(bob.id, 1)])
+
+            # Saves and deletes update the counts.
+            Contact.objects.create(person=bob, email='bob2@example.com')
+            contact = Contact.objects.create(person=john, email='john@example.com')
+            self.assertEqual(models.FieldValueCount.objects.get_values(Contact, 'person'), [(bob.id, 2), (john.id, 1)])
+            contact = Contact.objects.get(id=contact.id)
+            contact.person = bob
+            contact.save()
+            Contact.objects.get(email='bob1@example.com').delete()
+            self.assertEqual(models.FieldValueCount.objects.get_values(Contact, 'person'), [(bob.id, 2)])
+
+            # The filter reads the index once, then the evaluated values from the cache.
+            request = RequestFactory().get('/admin/tests/contact/')
+            field = Contact._meta.get_field('person')
+            list_filter = filters.CachedFieldFilter(field, request, {}, Contact, ContactAdmin(Contact, admin.site), 'person')
+            with self.assertNumQueries(1):
+                self.assertEqual(list_filter.get_value_counts(), [(bob.id, 2)])
+            with self.assertNumQueries(0):
+                self.assertEqual(list_filter.get_value_counts(), [(bob.id, 2)])
+        finally:
+            models._distinct_value_indexes.discard((Contact, 'person'))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_filter_counts(self):
+        cache.clear()
+        bob = Person.objects.create(name='Bob')
+        john = Person.objects.create(name='John')
+        Contact.objects.create(person=bob, email='bob1@example.com')
+        Contact.objects.create(person=bob, email='bob2@example.com')
+        Contact.objects.create(person=john, email='')
+
+        class NullBlankListFilter(filters.NullBlankListFilter):
+            pass
+
+        class CountedContactAdmin(ContactAdmin):
+            list_filter = (('email', NullBlankListFilter), ('person', filters.CachedFieldFilter), ('person', filters.NotInListFilter))
+            list_filter_counts = True
+
+        def get_choices(query_string=''):
+            request = RequestFactory().get('/admin/tests/contact/' + query_string)
+            request.user = get_user_model()(is_superuser=True, is_staff=True, is_active=True)
+            cl = CountedContactAdmin(Contact, admin.site).get_changelist_instance(request)
+            return [[choice['display'] for choice in spec.choices(cl)] for spec in cl.filter_specs]
+
+        nullblank, cached, notin = get_choices()
+        self.assertEqual(nullblank, ['All (3)', 'Has value (2)', 'Omitted (1)'])
+        self.assertEqual(cached, ['All (3)', '%i (2)' % bob.id, '%i (1)' % john.id])
+        self.assertEqual(notin, ['None (3)', '%s (1)' % bob, '%s (2)' % john])
+
+        # Each filter's counts are limited by the other filters, but not by its own.
+        nullblank, cached, notin = get_choices('?email_isnullblank=False')
+        self.assertEqual(nullblank, ['All (3)', 'Has value (2)', 'Omitted (1)'])
+        self.assertEqual(cached, ['All (2)', '%i (2)' % bob.id, '%i (0)' % john.id])
+
+        # When counting takes too long, the last counts are shown as approximate.
+        Contact.objects.bulk_create([Contact(person=john, email='john%i@example.com' % i) for i in range(500)])
+        NullBlankListFilter.count_timeout = 0
+        NullBlankListFilter.count_cache_seconds = 0
+        self.assertEqual(get_choices()[0], ['All (~3)', 'Has value (~2)', 'Omitted (~1)'])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_NotInListFilter_max_choices(self):
+        cache.clear()
+        people = [Person.objects.create(name='Person %i' % i) for i in range(4)]
+        for i, person in enumerate(people):
+            for j in range(i + 1):
+                Contact.objects.create(person=person, email='contact%i@example.com' % j)
+
+        class TopNotInListFilter(filters.NotInListFilter):
+            max_choices = 2
+
+        field = Contact._meta.get_field('person')
+        model_admin = ContactAdmin(Contact, admin.site)
+
+        def get_filter(query_string=''):
+            request = RequestFactory().get('/admin/tests/contact/' + query_string)
+            return TopNotInListFilter(field, request, {}, Contact, model_admin, 'person')
+
+        # Only the most used values are loaded, with one grouped query and one for their labels, then cached.
+        with self.assertNumQueries(2):
+            list_filter = get_filter()
+        self.assertEqual(list_filter.lookup_choices, [(people[3].id, str(people[3])), (people[2].id, str(people[2]))])
+        self.assertEqual(list_filter.template, 'admin_steroids/ajax_filter.html')
+
+        # Counts group only the values shown, with the total counted separately.
+        with self.assertNumQueries(2) as queries:
+            counts = list_filter.compute_facet_counts(Contact.objects.all())
+        self.assertEqual(counts, {None: 10, people[3].id: 6, people[2].id: 7})
+        self.assertIn(' IN (', queries.captured_queries[0]['sql'])
+
+        # Selected values outside the most used are still listed.
+        with self.assertNumQueries(1):
+            list_filter = get_filter('?person__notin=%i' % people[0].id)
+        self.assertEqual([value for value, label in list_filter.lookup_choices], [people[3].id, people[2].id, people[0].id])
+
+        # Relations to a field other than the primary key are labelled by that field.
+        list_filter.field = ForeignKey(Person, to_field='name', on_delete=CASCADE)
+        list_filter.field.set_attributes_from_name('person')
+        self.assertEqual(list_filter.get_choice_labels([people[1].name]), {people[1].name: str(people[1])})
+
+        # Fields across relations search the field at the end of the path.
+        request = RequestFactory().get('/admin/tests/contact/')
+        list_filter = TopNotInListFilter(Person._meta.get_field('name'), request, {}, Contact, model_admin, 'person__name')
+        self.assertTrue(list_filter.ajax_url.endswith('/tests/contact/field/person__name/search'), list_filter.ajax_url)
+        with override_settings(DAS_ALLOWED_AJAX_SEARCH_PATHS={('tests', 'contact', 'person__name')}):
+            request = RequestFactory().get(list_filter.ajax_url, {'q': 'son 2'})
+            request.user = get_user_model()(is_superuser=True, is_staff=True, is_active=True)
+            response = ModelFieldSearchView.as_view()(request, app_name='tests', model_name='contact', field_name='person__name')
+        self.assertEqual([result['value'] for result in json.loads(response.content.decode('utf-8'))], ['Person 2'])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_AjaxFieldFilter_labels(self):
+        cache.clear()
+        bob = Person.objects.create(name='Bob')
+        john = Person.objects.create(name='John')
+        field = Contact._meta.get_field('person')
+        request = RequestFactory().get('/admin/tests/contact/')
+        request.user = get_user_model()(is_superuser=True, is_staff=True, is_active=True)
+        cl = ContactAdmin(Contact, admin.site).get_changelist_instance(request)
+        request = RequestFactory().get('/admin/tests/contact/?person__in=%i,abc,9999,%i' % (bob.id, john.id))
+        list_filter = filters.AjaxFieldFilter(field, request, {}, Contact, ContactAdmin(Contact, admin.site), 'person')
+
+        # All the labels are loaded with one query, then cached, and unknown keys are shown as given.
+        for queries in (1, 0):
+            with self.assertNumQueries(queries):
+                displays = [choice['display'] for choice in list_filter.choices(cl)]
+            self.assertEqual(displays[1:], [str(bob), 'abc', '9999', str(john)])
+
+        # Different values referring to the same record are each labelled, whether or not it's cached.
+        cache.clear()
+        for queries in (1, 0):
+            with self.assertNumQueries(queries):
+                self.assertEqual(list_filter.get_value_labels([str(bob.id), bob.id]), {str(bob.id): str(bob), bob.id: str(bob)})
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        DAS_ALLOWED_AJAX_SEARCH_PATHS={('tests', 'person', 'name')},
+        DAS_MAX_AJAX_SEARCH_RESULTS=3,
+    )
+    def test_ModelFieldSearchView_cache(self):
+        cache.clear()
+        for name in ('Abby', 'Abe', 'Bob', 'Cabe'):
+            Person.objects.create(name=name)
+        ContentType.objects.get_for_model(Person)
+        view = ModelFieldSearchView.as_view()
+
+        def search_view(q):
+            request = RequestFactory().get('/tests/person/field/name/search/', {'q': q})
+            response = view(request, app_name='tests', model_name='person', field_name='name')
+            return [result['value'] for result in json.loads(response.content.decode('utf-8'))]
+
+        # Repeated searches are answered from the cache.
+        with self.assertNumQueries(1):
+            self.assertEqual(search_view('ab'), ['Abby', 'Abe', 'Cabe'])
+        with self.assertNumQueries(0):
+            self.assertEqual(search_view('ab'), ['Abby', 'Abe', 'Cabe'])
+
+        # Truncated results can't answer longer searches, but complete ones can.
+        with self.assertNumQueries(1):
+            self.assertEqual(search_view('abe'), ['Abe', 'Cabe'])
+        with self.assertNumQueries(0):
+            self.assertEqual(search_view('abex'), [])
+
+    def test_search_backends(self):
+        for name in ('Abby', 'Abe', 'Bob', 'Cabe', 'Caber'):
+            Person.objects.create(name=name)
+
+        backend = TrigramIndexSearchBackend(Person, 'name', refresh_seconds=3600)
+        # Searches are answered by the database while the index is built in the background, once.
+        with mock.patch.object(search.threading, 'Thread') as thread:
+            for _ in range(2):
+                with self.assertNumQueries(1):
+                    self.assertEqual(backend.search('ab', 10), ['Abby', 'Abe', 'Cabe', 'Caber'])
+        thread.assert_called_once_with(target=backend._refresh_in_background, daemon=True)
+        self.assertFalse(backend.substring_closed)
+        backend.refresh()
+        with self.assertNumQueries(0):
+            self.assertEqual(backend.search('ab', 10), ['Abby', 'Abe', 'Cabe', 'Caber'])
+            self.assertEqual(backend.search('B', 2), ['Abby', 'Abe'])
+            self.assertEqual(backend.search('aber', 10), ['Caber'])
+            self.assertEqual(backend.search('abex', 10), [])
+        Person.objects.create(name='Saber')
+        self.assertEqual(backend.search('aber', 10), ['Caber'])
+        backend.refresh()
+        self.assertEqual(backend.search('aber', 10), ['Caber', 'Saber'])
+
+        # Fields with too many values aren't indexed, and are searched in the database instead.
+        backend = TrigramIndexSearchBackend(Person, 'name', refresh_seconds=3600, max_values=3)
+        backend.refresh()
+        with self.assertNumQueries(1):
+            self.assertEqual(backend.search('ab', 10), ['Abby', 'Abe', 'Cabe', 'Caber', 'Saber'])
+        with self.assertNumQueries(1):
+            self.assertEqual(backend.search('aber', 10), ['Caber', 'Saber'])
+        self.assertFalse(backend.substring_closed)
+
+        backend = SQLiteFTSSearchBackend(Person, 'name')
+        backend.create_index()
+        self.assertEqual(backend.search('ABE', 10), ['Abe', 'Cabe', 'Caber', 'Saber'])
+        person = Person.objects.create(name='Tabel')
+        self.assertEqual(backend.search('abe', 10), ['Abe', 'Cabe', 'Caber', 'Saber', 'Tabel'])
+        person.name = 'Table'
+        person.save()
+        self.assertEqual(backend.search('abe', 10), ['Abe', 'Cabe', 'Caber', 'Saber'])
+        self.assertEqual(backend.search('%b', 10), [])
+
+        # The term is looked up in the trigram index, instead of scanning the FTS table.
+        with self.assertNumQueries(1) as queries:
+            backend.search('abe', 10)
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + queries.captured_queries[0]['sql'])
+            plan = [row[-1] for row in cursor.fetchall()]
+        self.assertTrue(any(step.endswith('INDEX 0:L0') for step in plan), plan)
+        backend.drop_index()
+
+    @override_settings(DAS_ALLOWED_AJAX_SEARCH_PATHS={('tests', 'person', 'name')})
+    def test_ModelFieldSearchView_search_backend(self):
+        for name in ('Abby', 'Abe', 'Bob', 'Cabe'):
+            Person.objects.create(name=name)
+        ContentType.objects.get_for_model(Person)
+        backend = search.register_search_backend(Person, 'name')
+        self.addCleanup(search._search_backends.pop, ('tests', 'person', 'name'))
+        backend.refresh()
+        request = RequestFactory().get('/tests/person/field/name/search/', {'q': 'be'})
+        with self.assertNumQueries(0):
+            response = ModelFieldSearchView.as_view()(request, app_name='tests', model_name='person', field_name='name')
+        self.assertEqual([result['value'] for result in json.loads(response.content.decode('utf-8'))], ['Abe', 'Cabe'])
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        DAS_ALLOWED_AJAX_SEARCH_PATHS={('tests', 'person', 'name')},
+    )
+    def test_ModelFieldSearchView_search_backend_prefix(self):
+        cache.clear()
+        for name in ('Zoë', 'Zoey', 'Bob'):
+            Person.objects.create(name=name)
+        ContentType.objects.get_for_model(Person)
+        searches = []
+
+        class AccentSearchBackend(search.SearchBackend):
+            """
+            Ignores accents, like some database collations, so "zoe" also finds "Zoë".
+            """
+
+            def search(self, q, limit):
+                searches.append(q)
+
+                def fold(value):
+                    return unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii').lower()
+
+                return [name for name in Person.objects.values_list('name', flat=True).order_by('name') if fold(q) in fold(name)][:limit]
+
+        search.register_search_backend(Person, 'name', AccentSearchBackend)
+        self.addCleanup(search._search_backends.pop, ('tests', 'person', 'name'))
+
+        def search_view(q):
+            request = RequestFactory().get('/tests/person/field/name/search/', {'q': q})
+            response = ModelFieldSearchView.as_view()(request, app_name='tests', model_name='person', field_name='name')
+            return [result['value'] for result in json.loads(response.content.decode('utf-8'))]
+
+        # The results for "zo" can't be filtered to answer "zoe", since the backend doesn't match substrings.
+        self.assertEqual(search_view('zo'), ['Zoey', 'Zoë'])
+        self.assertEqual(search_view('zoe'), ['Zoey', 'Zoë'])
+        self.assertEqual(search_view('zoe'), ['Zoey', 'Zoë'])
+        self.assertEqual(searches, ['zo', 'zoe'])
+
+    def test_ApproxCountQuerySet_estimate(self):
+        class PlannedQuerySet(ApproxCountQuerySet):
+
+            estimate = 20000
+
+            def estimate_count(self):
+                return self.estimate
+
+        for name in ('Abby', 'Abe', 'Bob'):
+            Person.objects.create(name=name)
+        qs = PlannedQuerySet(model=Person).filter(name__startswith='A')
+
+        # Filtered querysets are counted exactly unless estimates are enabled.
+        self.assertEqual(qs.count(), 2)
+        self.assertFalse(qs.count_is_estimate)
+
+        estimated_qs = qs.estimated(exact_count_threshold=1000).order_by('name')
+        self.assertEqual(estimated_qs.count(), 20000)
+        self.assertTrue(estimated_qs.count_is_estimate)
+
+        # Small estimates are replaced by an exact count.
+        PlannedQuerySet.estimate = 999
+        estimated_qs = qs.estimated(exact_count_threshold=1000)
+        self.assertEqual(estimated_qs.count(), 2)
+        self.assertFalse(estimated_qs.count_is_estimate)
+
+        # SQLite has no planner estimate.
+        self.assertIsNone(ApproxCountQuerySet(model=Person).filter(name='Bob').estimate_count())
+
+        # The changelist shows estimated counts as approximate.
+        PlannedQuerySet.estimate = 20000
+
+        class EstimatedPersonAdmin(options.EstimatedPaginationMixin, PersonCSVAdmin):
+
+            def get_queryset(self, request):
+                return PlannedQuerySet(model=Person).estimated(exact_count_threshold=1000).filter(name__startswith='A')
+
+        request = RequestFactory().get('/admin/tests/person/')
+        request.user = get_user_model()(is_superuser=True, is_staff=True, is_active=True)
+        cl = EstimatedPersonAdmin(Person, admin.site).get_changelist_instance(request)
+        self.assertEqual(cl.result_count, 20000)
+        self.assertTrue(cl.result_count_is_estimate)
+        response = EstimatedPersonAdmin(Person, admin.site).changelist_view(request)
+        self.assertEqual(response.template_name, 'admin_steroids/change_list.html')
+        html = response.rendered_content
+        self.assertIn('about 20000 persons', ' '.join(html.split()))
+
+        # Without the mixin, Django's own changelist template lookup is kept.
+        self.assertIsNone(PersonCSVAdmin.change_list_template)
+
+    def test_ApproxCountQuerySet_table_count(self):
+        self.assertEqual(get_vendor(), 'sqlite')
+        for name in ('Abby', 'Abe', 'Bob'):
+            Person.objects.create(name=name)
+        qs = ApproxCountQuerySet(model=Person)
+
+        # Without statistics, the table is counted exactly.
+        self.assertIsNone(qs.get_table_count())
+        self.assertEqual(qs.count(), 3)
+        self.assertFalse(qs.count_is_estimate)
+
+        # After ANALYZE, the count is read from sqlite_stat1 until the next ANALYZE.
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        Person.objects.create(name='Cabe')
+        with self.assertNumQueries(1):
+            self.assertEqual(qs.count(), 3)
+        self.assertTrue(qs.count_is_estimate)
+        self.assertEqual(qs.filter(name__startswith='A').count(), 2)
+        self.assertEqual(qs.all().count(), 3)
+        self.assertEqual(list(qs.all()[:2].values_list('name', flat=True)), ['Abby', 'Abe'])
+
+        # The statistics of a partial index, which only count the rows it covers, aren't used.
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE INDEX tests_person_a_names ON tests_person (name) WHERE name LIKE 'A%'")
+            cursor.execute('ANALYZE')
+            cursor.execute("SELECT stat FROM sqlite_stat1 WHERE idx = 'tests_person_a_names'")
+            self.assertEqual(cursor.fetchone()[0].split()[0], '2')
+        self.assertEqual(qs.get_table_count(), 4)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_CachedCountQuerySet(self):
+        cache.clear()
+        for name in ('Abby', 'Abe', 'Bob'):
+            Person.objects.create(name=name)
+        qs = CachedCountQuerySet(model=Person)
+
+        # Counts are cached per SQL and parameters.
+        with self.assertNumQueries(1):
+            self.assertEqual(qs.filter(name__startswith='A').count(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(qs.filter(name__startswith='A').count(), 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(qs.filter(name__startswith='B').count(), 1)
+        self.assertNotEqual(qs.filter(name='Abe').get_count_cache_key(), qs.filter(name='Bob').get_count_cache_key())
+        self.assertEqual(qs.filter(name__in=[]).count(), 0)
+
+        # Expired counts are returned while another caller recounts them.
+        Person.objects.create(name='Abel')
+        expired_qs = qs.filter(name__startswith='A')
+        expired_qs.cache_seconds = 0
+        lock_key = expired_qs.get_count_cache_key() + '_lock'
+        cache.add(lock_key, 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(expired_qs.count(), 2)
+        cache.delete(lock_key)
+        with self.assertNumQueries(1):
+            self.assertEqual(expired_qs.count(), 3)
+        self.assertFalse(cache.get(lock_key))
+
+        # Without an old count, a caller waits for the recount, then recounts itself.
+        uncounted_qs = qs.filter(name__startswith='Ab')
+        uncounted_qs.lock_wait_seconds = 0
+        cache.add(uncounted_qs.get_count_cache_key() + '_lock', 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(uncounted_qs.count(), 3)
+
+    def test_row_counter(self):
+        bob = Person.objects.create(name='Bob')
+        john = Person.objects.create(name='John')
+        Contact.objects.create(person=bob, email='bob1@example.com')
+        ContentType.objects.get_for_model(Contact)
+        ContentType.objects.get_for_model(Person)
+        models.register_row_counter(Contact, ['person'])
+        with self.assertRaises(ValueError):
+            models.register_row_counter(Person, ['name'], triggers=True)
+        models.register_row_counter(Person, triggers=True)
+        try:
+            # Counters aren't used until the rows are counted.
+            qs = ApproxCountQuerySet(model=Contact)
+            self.assertIsNone(qs.get_counter_count())
+            call_command('refresh_distinct_values')
+
+            # Saves and deletes update the counts, which are then read without COUNT(*).
+            Contact.objects.create(person=bob, email='bob2@example.com')
+            contact = Contact.objects.create(person=john, email='john@example.com')
+            with self.assertNumQueries(1):
+                self.assertEqual(qs.count(), 3)
+            with self.assertNumQueries(2):
+                self.assertEqual(qs.filter(person=bob).count(), 2)
+            contact.delete()
+            self.assertEqual(qs.count(), 2)
+            self.assertEqual(qs.filter(person=john).count(), 0)
+            self.assertEqual(qs.filter(person__in=[bob, john]).count(), 2)
+            self.assertFalse(qs.count_is_estimate)
+
+            # Other filters are counted normally.
+            self.assertIsNone(qs.filter(person=bob, email='bob2@example.com').get_counter_count())
+            self.assertIsNone(qs.filter(person__name='Bob').get_counter_count())
+            self.assertEqual(qs.filter(email__startswith='bob').count(), 2)
+
+            # Triggers also count rows created and deleted without signals.
+            Person.objects.bulk_create([Person(name='Abe'), Person(name='Abby')])
+            self.assertEqual(models.FieldValueCount.objects.get_count(Person), 4)
+            Person.objects.filter(name__startswith='Ab')._raw_delete(Person.objects.db)
+            self.assertEqual(ApproxCountQuerySet(model=Person).count(), 2)
+        finally:
+            models._row_counters.pop(Contact)
+            models._row_counters.pop(Person)
+            models._distinct_value_indexes.discard((Contact, 'person'))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_CountlessPaginator(self):
+        cache.clear()
+        Person.objects.bulk_create([Person(name='Person %02i' % i) for i in range(25)])
+
+        class PlannedQuerySet(ApproxCountQuerySet):
+
+            def estimate_count(self):
+                return 12
+
+        # Pages are read with one query each, knowing if there's a next page without a count.
+        qs = PlannedQuerySet(model=Person).estimated(exact_count_threshold=10).order_by('-pk')
+        paginator = CountlessPaginator(qs, 10)
+        self.assertEqual(paginator.count, 12)
+        self.assertTrue(qs.count_is_estimate)
+        with self.assertNumQueries(1):
+            page = paginator.page(1)
+            self.assertEqual([person.name for person in page], ['Person %02i' % i for i in range(24, 14, -1)])
+        self.assertTrue(page.has_next())
+
+        # The next page is read after the last primary key of the previous one, rather than with an offset.
+        paginator = CountlessPaginator(qs, 10)
+        self.assertEqual(paginator.count, 12)
+        with self.assertNumQueries(1) as queries:
+            page = paginator.page(2)
+            self.assertEqual([person.name for person in page], ['Person %02i' % i for i in range(14, 4, -1)])
+        self.assertNotIn('OFFSET', queries.captured_queries[0]['sql'])
+        self.assertTrue(page.has_next())
+
+        # Pages past the estimated count are still found, and linked to.
+        page = paginator.page(3)
+        self.assertEqual(len(page), 5)
+        self.assertFalse(page.has_next())
+        self.assertEqual((page.start_index(), page.end_index()), (21, 25))
+        self.assertEqual(paginator.num_pages, 3)
+        with self.assertRaises(EmptyPage):
+            paginator.page(4)
+
+        # A small estimate doesn't hide the other pages from the changelist.
+        class UnderestimatedQuerySet(ApproxCountQuerySet):
+
+            def get_table_count(self):
+                return 5
+
+        paginator = CountlessPaginator(UnderestimatedQuerySet(model=Person).order_by('name'), 10)
+        self.assertEqual(paginator.count, 11)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(paginator.page(1)), 10)
+        with self.assertNumQueries(1) as queries:
+            self.assertEqual(paginator.page(2)[0].name, 'Person 10')
+        self.assertIn('OFFSET', queries.captured_queries[0]['sql'])
+
+        # The changelist pages through the queryset with the paginator.
+        class CountlessPersonAdmin(PersonCSVAdmin):
+            paginator = CountlessPaginator
+            show_full_result_count = False
+            list_per_page = 10
+
+            def get_queryset(self, request):
+                return PlannedQuerySet(model=Person).estimated(exact_count_threshold=10)
+
+        request = RequestFactory().get('/admin/tests/person/', {'p': '3'})
+        request.user = get_user_model()(is_superuser=True, is_staff=True, is_active=True)
+        cl = CountlessPersonAdmin(Person, admin.site).get_changelist_instance(request)
+        self.assertEqual(cl.result_count, 12)
+        self.assertTrue(cl.result_count_is_estimate)
+        self.assertEqual(len(cl.result_list), 5)
+        self.assertEqual(cl.paginator.num_pages, 3)
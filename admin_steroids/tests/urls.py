@@ -5,5 +5,6 @@ from django.urls import re_path, include
 admin.autodiscover()
 
 urlpatterns = [
-    re_path(r'^admin/', include(admin.site.urls)),
+    re_path(r'^admin_steroids/', include('admin_steroids.urls')),
+    re_path(r'^admin/', admin.site.urls),
 ]
@@ -9,4 +9,9 @@ urlpatterns = [
         # If you override this, be sure to use the same name, so reverse() still works.
         name='model_field_search'
     ),
+    re_path(
+        r'^exports/(?P<job_id>[0-9]+)/download/?$',
+        views.ExportJobDownloadView.as_view(),
+        name='export_job_download',
+    ),
 ]
@@ -1,16 +1,30 @@
 import re
 import sys
+import html
 import hashlib
 import decimal
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from inspect import isclass
+from urllib.parse import quote
 
 from six.moves.urllib.parse import urlparse # pylint: disable=import-error
 from six.moves import cPickle as pickle
 import six
 
 from django.conf import settings
-from django.db import models, connections
+from django.db import models, connections, transaction
+from django.db.models.fields.related_descriptors import ManyToManyDescriptor, ReverseManyToOneDescriptor
 from django.contrib.contenttypes.models import ContentType
-from django.urls import reverse, NoReverseMatch
+from django.core.exceptions import ValidationError
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.urls import reverse, NoReverseMatch, get_script_prefix, get_urlconf
+from django.utils.http import RFC3986_SUBDELIMS
+from django.utils.translation import get_language
 
 
 def obj_to_hash(o):
@@ -21,55 +35,100 @@ def obj_to_hash(o):
     return hashlib.sha512(pickle.dumps(o)).hexdigest()
 
 
-def get_admin_change_url(obj):
+# Admin URLs reversed once per model, view and URLconf, stored as the text around a placeholder primary key.
+_admin_url_cache = {}
+
+# A primary key that any admin change URL pattern should accept, so it can be swapped for real ones.
+ADMIN_URL_PK_PLACEHOLDER = '9876543210123'
+
+
+def clear_admin_url_cache():
+    """
+    Discards all cached admin URLs, such as after the URLconf changes.
+    """
+    _admin_url_cache.clear()
+
+
+@receiver(setting_changed)
+def _clear_admin_url_cache_on_urlconf_change(setting, **kwargs):
+    if setting == 'ROOT_URLCONF':
+        clear_admin_url_cache()
+
+
+def _get_admin_url(model, view, for_concrete_model=False, namespace='admin', pk=None):
+    """
+    Returns the admin URL for the given model and view, only reversing it
+    the first time it's requested for the current URLconf, script prefix and language.
+    URLs that can't be reversed aren't cached, since their admin may be registered later.
+
+    For the change view, the URL is reversed with a placeholder primary key,
+    which is then swapped for the given pk with plain string formatting.
+    """
+    if not isclass(model):
+        model = type(model)
+    key = (model, view, for_concrete_model, namespace, get_urlconf(), get_script_prefix(), get_language())
+    entry = _admin_url_cache.get(key)
+    if entry is None:
+        ct = ContentType.objects.get_for_model(model, for_concrete_model=for_concrete_model)
+        app_label = ct.app_label
+        if view == 'change' and hasattr(model, 'app_label_name'):
+            app_label = model.app_label_name
+        url_name = '%s:%s_%s_%s' % (namespace, app_label, ct.model, view)
+        if view == 'change':
+            parts = reverse(url_name, args=(ADMIN_URL_PK_PLACEHOLDER,)).split(ADMIN_URL_PK_PLACEHOLDER)
+            if len(parts) != 2:
+                # The placeholder can't be told apart from the rest of the URL, so reverse on every call.
+                parts = None
+            entry = (url_name, parts)
+        else:
+            entry = (url_name, reverse(url_name))
+        _admin_url_cache[key] = entry
+    url_name, url = entry
+    if view != 'change':
+        return url
+    if url is None:
+        return reverse(url_name, args=(pk,))
+    return quote(str(pk), safe=RFC3986_SUBDELIMS + '/~:@').join(url)
+
+
+def get_admin_change_url(obj, namespace='admin'):
     """
     Returns the admin change url associated with the given instance.
     """
     if obj is None:
         return
-    ct = ContentType.objects.get_for_model(obj, for_concrete_model=False)
-    obj_cls = type(obj)
-    if hasattr(obj_cls, 'app_label_name'):
-        app_label = obj_cls.app_label_name
-    else:
-        app_label = ct.app_label
-    change_url_name = 'admin:%s_%s_change' % (app_label, ct.model)
-    return reverse(change_url_name, args=(obj.id,))
+    return _get_admin_url(obj, 'change', namespace=namespace, pk=obj.pk)
 
 
-def get_admin_add_url(obj, for_concrete_model=False):
+def get_admin_add_url(obj, for_concrete_model=False, namespace='admin'):
     """
     Returns the admin add url associated with the given instance.
     """
     if obj is None:
         return
-    ct = ContentType.objects.get_for_model(obj, for_concrete_model=for_concrete_model)
-    list_url_name = 'admin:%s_%s_add' % (ct.app_label, ct.model)
     try:
-        return reverse(list_url_name)
+        return _get_admin_url(obj, 'add', for_concrete_model=for_concrete_model, namespace=namespace)
     except NoReverseMatch:
         # If this is a proxy model and proxy support is on, try to return
         # the parent changelist.
         if not for_concrete_model:
-            return get_admin_add_url(obj, for_concrete_model=True)
+            return get_admin_add_url(obj, for_concrete_model=True, namespace=namespace)
         raise
 
 
-def get_admin_changelist_url(obj, for_concrete_model=False):
+def get_admin_changelist_url(obj, for_concrete_model=False, namespace='admin'):
     """
     Returns the admin changelist url associated with the given instance.
     """
     if obj is None:
         return
-    ct = ContentType.objects.get_for_model(obj, for_concrete_model=for_concrete_model)
-    list_url_name = 'admin:%s_%s_changelist' % (ct.app_label, ct.model)
     try:
-        return reverse(list_url_name)
+        return _get_admin_url(obj, 'changelist', for_concrete_model=for_concrete_model, namespace=namespace)
     except NoReverseMatch:
         # If this is a proxy model and proxy support is on, try to return
         # the parent changelist.
         if not for_concrete_model:
-            return get_admin_changelist_url(obj, for_concrete_model=True)
+            return get_admin_changelist_url(obj, for_concrete_model=True, namespace=namespace)
         raise
 
 
@@ -92,9 +151,11 @@ class StringWithTitle(str):
     def __eq__(self, other):
         return str(self) == str(other)
 
-    __copy__ = lambda self: StringWithTitle(str(self), self.title) # pylint: disable=undefined-variable
+    def __copy__(self):
+        return StringWithTitle(str(self), self._title)
 
-    __deepcopy__ = lambda self, memodict: StringWithTitle(str(self), self.title)
+    def __deepcopy__(self, memodict):
+        return StringWithTitle(str(self), self._title)
 
 
 re_digits_nondigits = re.compile(r'\d+|\D+')
@@ -270,7 +331,199 @@ def view_related_link(obj, field_name, reverse_field=None, extra='', template=''
             extra = '&' + extra
         url = url + extra
 
-    return view_link(url, q.count(), template=template, **kwargs)
+    cached = get_related_count(obj, field_name)
+    count = cached[0] if cached else q.count()
+
+    return view_link(url, count, template=template, **kwargs)
+
+
+def prefetch_related_counts(objects, field_name):
+    """
+    Counts the records related to each object through the named reverse ForeignKey
+    or ManyToMany accessor with a single grouped query, and stores the results on each
+    object, where they're read by get_related_count().
+
+    When exactly one record is related, its primary key is stored as well,
+    so it can be linked to without another query.
+    """
+    objects = [obj for obj in objects if obj is not None and obj.pk is not None]
+    if not objects:
+        return
+    descriptor = getattr(type(objects[0]), field_name, None)
+    if isinstance(descriptor, ManyToManyDescriptor):
+        through = descriptor.through
+        if descriptor.reverse:
+            source = through._meta.get_field(descriptor.field.m2m_reverse_field_name())
+            target = through._meta.get_field(descriptor.field.m2m_field_name())
+        else:
+            source = through._meta.get_field(descriptor.field.m2m_field_name())
+            target = through._meta.get_field(descriptor.field.m2m_reverse_field_name())
+        qs = through._default_manager.all()
+        target_attname = target.attname
+    elif isinstance(descriptor, ReverseManyToOneDescriptor):
+        source = descriptor.field
+        qs = source.model._default_manager.all()
+        target_attname = source.model._meta.pk.attname
+    else:
+        raise ValueError('%s is not a reverse ForeignKey or ManyToMany accessor on %s.' % (field_name, type(objects[0]).__name__))
+
+    key_attname = source.target_field.attname
+    keys = set(getattr(obj, key_attname) for obj in objects)
+    counts = {}
+    rows = qs.filter(**{source.attname + '__in': keys})\
+        .values(source.attname)\
+        .annotate(count=models.Count(target_attname), min_pk=models.Min(target_attname))\
+        .order_by()
+    for row in rows:
+        counts[row[source.attname]] = (row['count'], row['min_pk'] if row['count'] == 1 else None)
+    for obj in objects:
+        obj.__dict__.setdefault('_related_counts', {})[field_name] = counts.get(getattr(obj, key_attname), (0, None))
+
+
+def get_related_count(obj, field_name):
+    """
+    Returns the tuple (count, pk) stored by prefetch_related_counts() for the object's named accessor,
+    where pk is the primary key of the related record if there's exactly one, or None if no count was prefetched.
+    """
+    return getattr(obj, '_related_counts', {}).get(field_name)
+
+
+class ObjectCache(object):
+    """
+    An identity map of records, keyed by model, field and value, so each record is loaded at most once.
+
+    Values passed to defer() are loaded together with the next get() for the same model and field,
+    so records needed by many widgets can be loaded in one query.
+    """
+
+    def __init__(self):
+        self._objects = {}
+        self._pending = {}
+
+    def _get_key(self, model, value, field_name, using):
+        field = model._meta.pk if field_name == 'pk' else model._meta.get_field(field_name)
+        try:
+            value = field.to_python(value)
+        except (TypeError, ValueError, ValidationError):
+            return None
+        if value is None:
+            return None
+        return (model, field, using or 'default'), value
+
+    def defer(self, model, value, field_name='pk', using=None):
+        """
+        Marks the record for loading with the next get() for the same model and field.
+        """
+        key = self._get_key(model, value, field_name, using)
+        if key is not None and key not in self._objects:
+            self._pending.setdefault(key[0], set()).add(key[1])
+
+    def get(self, model, value, field_name='pk', using=None):
+        """
+        Returns the record whose field equals the value, or None if there isn't one.
+        """
+        key = self._get_key(model, value, field_name, using)
+        if key is None:
+            return None
+        if key not in self._objects:
+            group, key_value = key
+            values = self._pending.pop(group, set())
+            values.add(key_value)
+            group_model, field, group_using = group
+            for obj in group_model._default_manager.using(group_using).filter(**{field.name + '__in': values}):
+                self._objects[group, getattr(obj, field.attname)] = obj
+            for pending_value in values:
+                self._objects.setdefault((group, pending_value), None)
+        return self._objects[key]
+
+    def discard(self, model):
+        """
+        Forgets all loaded records of the model, such as after one is changed.
+        """
+        for key in list(self._objects):
+            if key[0][0] is model:
+                del self._objects[key]
+
+
+_object_cache_state = threading.local()
+
+
+@contextmanager
+def object_cache():
+    """
+    Shares one ObjectCache with all the code run inside the block, such as the handling of a request.
+
+    Nested blocks reuse the outermost cache.
+    """
+    cache = getattr(_object_cache_state, 'cache', None)
+    if cache is not None:
+        yield cache
+        return
+    _object_cache_state.cache = cache = ObjectCache()
+    try:
+        yield cache
+    finally:
+        _object_cache_state.cache = None
+
+
+def get_object_cache():
+    """
+    Returns the ObjectCache shared by the current object_cache() block,
+    or a new one for the caller alone if there's no block.
+    """
+    return getattr(_object_cache_state, 'cache', None) or ObjectCache()
+
+
+@receiver(models.signals.post_save)
+@receiver(models.signals.post_delete)
+def _discard_changed_objects(sender, **kwargs):
+    cache = getattr(_object_cache_state, 'cache', None)
+    if cache is not None:
+        cache.discard(sender)
+
+
+@contextmanager
+def statement_timeout(seconds, using='default'):
+    """
+    Aborts queries run inside the block once they run for longer than the given number of seconds,
+    raising a DatabaseError.
+
+    Supported on PostgreSQL, MySQL and SQLite. On other databases, queries aren't limited.
+    """
+    connection = connections[using]
+    vendor = connection.vendor
+    if vendor == 'postgresql':
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                cursor.execute('SHOW statement_timeout')
+                old_timeout = cursor.fetchone()[0]
+                cursor.execute('SET LOCAL statement_timeout = %s', [int(seconds * 1000)])
+            yield
+            # Inside an outer transaction, releasing the savepoint keeps the timeout for the rest of it,
+            # so it's set back first. If the block fails, rolling back to the savepoint restores it instead.
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL statement_timeout = %s', [old_timeout])
+    elif vendor == 'mysql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT @@max_execution_time')
+            old_timeout = cursor.fetchone()[0]
+            cursor.execute('SET SESSION max_execution_time = %s', [int(seconds * 1000)])
+        try:
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('SET SESSION max_execution_time = %s', [old_timeout])
+    elif vendor == 'sqlite':
+        connection.ensure_connection()
+        deadline = time.monotonic() + seconds
+        # A non-zero return from the handler interrupts the running statement.
+        connection.connection.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        try:
+            yield
+        finally:
+            connection.connection.set_progress_handler(None, 0)
+    else:
+        yield
 
 
 def dereference_value(obj, name, as_name=False):
@@ -291,6 +544,29 @@ def dereference_value(obj, name, as_name=False):
     return cursor
 
 
+def get_dereferencer(name):
+    """
+    Returns a function that, given a Django model instance, looks up the value
+    associated with the underscore-separated name.
+
+    Equivalent to dereference_value(obj, name), but only splits the name once,
+    for use when the same name is looked up on many instances.
+    """
+    parts = name.split('__')
+
+    def dereferencer(obj):
+        cursor = obj
+        for part in parts:
+            cursor = getattr(cursor, part, None)
+            if callable(cursor):
+                cursor = cursor()
+        if cursor == obj:
+            return
+        return cursor
+
+    return dereferencer
+
+
 class DictCursor(object):
     """
     A database cursor that returns records as dictionaries,
@@ -344,11 +620,48 @@ def count_related_objects(obj):
     return cnt
 
 
-def remove_html(s):
-    import html # pylint: disable=import-outside-toplevel
+class HTMLStripper(HTMLParser):
+    """
+    Collects the text content of an HTML fragment in a single pass.
+
+    Produces the same text as joining all the strings found by
+    BeautifulSoup's html.parser tree, including comments and declarations.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+    def handle_comment(self, data):
+        self.parts.append(data)
+
+    def handle_decl(self, decl):
+        if decl.startswith('DOCTYPE '):
+            decl = decl[len('DOCTYPE '):]
+        self.parts.append(decl)
+
+    def unknown_decl(self, data):
+        if data.upper().startswith('CDATA['):
+            data = data[len('CDATA['):]
+        self.parts.append(data)
+
+    def handle_pi(self, data):
+        self.parts.append(data)
+
+    def get_text(self):
+        return ''.join(self.parts)
 
+
+def remove_html(s):
     s = six.text_type(s)
 
+    # Most values, like numbers and plain text, contain no markup or entities, so skip parsing them.
+    if '<' not in s and '&' not in s:
+        return s
+
     # We do this ourselves since HTMLParser does not convert this to the ASCII
     # blank space character.
     s = s.replace('&nbsp;', ' ')
@@ -356,17 +669,10 @@ def remove_html(s):
     # Strip out all other HTML entities.
     s = html.unescape(s)
 
-    try:
-        # Try using BeautifulSoup to strip out HTML, since its parser is more robust
-        # than a simple Regex.
-        from bs4 import BeautifulSoup # pylint: disable=import-outside-toplevel
-        soup = BeautifulSoup(s)
-        s = ''.join(soup.findAll(text=True))
-    except ImportError:
-        # However, if the user doesn't want another dependency, fallback to Regex.
-        s = re.sub("<.*?>", '', s)
-
-    return s
+    stripper = HTMLStripper()
+    stripper.feed(s)
+    stripper.close()
+    return stripper.get_text()
 
 
 def get_model_fields(mdl):
@@ -430,3 +736,15 @@ def encode_csv_data(d):
                 _v = six.binary_type(d[k])
                 d[k] = _v
     return d
+
+
+def iter_batches(rows, batch_size):
+    """
+    Groups an iterable into lists of at most batch_size items.
+    """
+    rows = iter(rows)
+    while 1:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        yield batch
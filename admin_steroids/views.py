@@ -1,18 +1,28 @@
+import hashlib
 import json
 import operator
 
-from django.views.generic.base import TemplateView
-from django.http import HttpResponse
+import os
+
+from django.views.generic.base import TemplateView, View
+from django.http import HttpResponse, FileResponse
 from django.core.exceptions import PermissionDenied
 from django.core.cache import cache
 from django.conf import settings
+from django.contrib.admin.utils import get_fields_from_path
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.db.models import Q
+from django.shortcuts import get_object_or_404
 
 import six
 
-from admin_steroids.models import get_modelsearcher
+from admin_steroids.models import get_modelsearcher, ExportJob
+from admin_steroids.search import get_search_backend
+
+
+# Included in search cache keys, so changing how results are stored invalidates old entries.
+SEARCH_CACHE_VERSION = 1
 
 
 class ModelFieldSearchView(TemplateView):
@@ -35,12 +45,117 @@ class ModelFieldSearchView(TemplateView):
 
     @property
     def model(self):
-        ct = ContentType.objects.get(app_label=self.kwargs['app_name'], model=self.kwargs['model_name'])
+        ct = ContentType.objects.get_by_natural_key(self.kwargs['app_name'], self.kwargs['model_name'])
         return ct.model_class()
 
+    def get_cache_key(self, q):
+        """
+        Returns the cache key for the results of searching this view's field for q.
+        """
+        state = json.dumps(list(self.search_path_tuple) + [q])
+        return 'das_mfs_%i_%s' % (SEARCH_CACHE_VERSION, hashlib.sha1(state.encode('utf-8')).hexdigest())
+
     @property
     def cache_key(self):
-        return self.search_path_tuple + (self.q,)
+        return self.get_cache_key(self.q)
+
+    def get_cached_results(self, q):
+        """
+        Returns the cached results of the search for q, or None if they aren't cached.
+
+        If the results for a shorter prefix of q are cached and weren't truncated,
+        they're filtered to answer q without querying.
+        """
+        prefixes = [q[:i] for i in range(len(q), 0, -1)]
+        keys = {self.get_cache_key(prefix): prefix for prefix in prefixes}
+        cached = cache.get_many(list(keys))
+        for prefix in prefixes:
+            payload = cached.get(self.get_cache_key(prefix))
+            if payload is None:
+                continue
+            if prefix == q:
+                return payload['results']
+            if payload['filterable'] and not payload['truncated']:
+                # Every value containing q also contains its prefix, so filter the complete results for the prefix.
+                q_lower = q.lower()
+                return [result for result in payload['results'] if q_lower in str(result['value']).lower()]
+        return None
+
+    def get_results(self, q):
+        """
+        Returns a tuple of the list of matching results, and whether they can be filtered
+        in memory by a longer search, because each result's value is the text searched.
+        """
+        model = self.model
+        path = self.search_path_tuple
+        field_name = self.kwargs['field_name']
+        n = settings.DAS_MAX_AJAX_SEARCH_RESULTS
+        results = []
+        filterable = False
+        # The field may be on a related model, reached by a "__" delimited path, as in list_filter.
+        field = get_fields_from_path(model, field_name)[-1]
+
+        cb = get_modelsearcher(
+            app_label=self.kwargs['app_name'],
+            model_name=self.kwargs['model_name'],
+            field_name=field_name,
+        )
+        backend = get_search_backend(
+            app_label=self.kwargs['app_name'],
+            model_name=self.kwargs['model_name'],
+            field_name=field_name,
+        )
+        if cb:
+            # Lookup field values using a custom callback if provided.
+            qs = cb(
+                app_label=self.kwargs['app_name'],
+                model_name=self.kwargs['model_name'],
+                field_name=field_name,
+                q=q,
+            ) or []
+            qs = qs[:n]
+            results = [dict(key=_.id if hasattr(_, 'id') else _, value=str(_), field_name=field_name) for _ in qs]
+        elif backend:
+            # Lookup field values using the index of a registered search backend.
+            if len(q) >= backend.min_length:
+                results = [dict(key=_, value=_, field_name=field_name) for _ in backend.search(q, n)]
+                filterable = backend.substring_closed
+        elif isinstance(field, (
+            models.CharField,
+            models.EmailField,
+            models.SlugField,
+            models.TextField,
+            models.URLField,
+        )):
+
+            # Build query for a simple string-based field.
+            qs = model.objects.filter(**{field_name+'__icontains': q})\
+                .values_list(field_name, flat=True)\
+                .order_by(field_name)\
+                .distinct()
+            qs = qs[:n]
+            results = [dict(key=_, value=_, field_name=field_name) for _ in qs]
+            filterable = True
+
+        elif isinstance(field, (
+            models.ForeignKey,
+            models.ManyToManyField,
+            models.OneToOneField,
+        )):
+            # Build query for a related model.
+            search_fields = settings.DAS_AJAX_SEARCH_PATH_FIELDS.get(path)
+            if search_fields:
+                qs_args = []
+                for search_field in search_fields:
+                    #qs_args.append(Q(**{field_name+'__'+search_field+'__icontains': q}))
+                    qs_args.append(Q(**{search_field + '__icontains': q}))
+                rel_model = field.remote_field.model
+                qs = rel_model.objects.filter(six.moves.reduce(operator.or_, qs_args))
+                qs = qs[:n]
+                pk_name = rel_model._meta.pk.name
+                results = [dict(key=getattr(_, pk_name), value=str(_), field_name=field_name) for _ in qs.iterator()]
+
+        return results, filterable
 
     def render_to_response(self, context, **response_kwargs):
 
@@ -58,67 +173,41 @@ class ModelFieldSearchView(TemplateView):
             if not self.request.user.is_staff:
                 raise PermissionDenied
 
-        cache_key = self.cache_key
-
-        model = self.model
         q = self.q
-        field_name = self.kwargs['field_name']
-        n = settings.DAS_MAX_AJAX_SEARCH_RESULTS
         results = []
         if q:
-            field = model._meta.get_field(field_name)
-            field_type = type(field)
+            cache_seconds = settings.DAS_AJAX_SEARCH_DEFAULT_CACHE_SECONDS
+            results = None
+            if cache_seconds:
+                results = self.get_cached_results(q)
+            if results is None:
+                results, filterable = self.get_results(q)
+                if cache_seconds:
+                    payload = {
+                        'results': results,
+                        'truncated': len(results) >= settings.DAS_MAX_AJAX_SEARCH_RESULTS,
+                        'filterable': filterable,
+                    }
+                    cache.set(self.cache_key, payload, cache_seconds)
+
+        return HttpResponse(json.dumps(results), content_type='application/json', **response_kwargs)
+
+
+class ExportJobDownloadView(View):
+    """
+    Serves the file written by an ExportJob to the user who requested it.
+    """
 
-            cb = get_modelsearcher(
-                app_label=self.kwargs['app_name'],
-                model_name=self.kwargs['model_name'],
-                field_name=field_name,
-            )
-            if cb:
-                # Lookup field values using a custom callback if provided.
-                qs = cb(
-                    app_label=self.kwargs['app_name'],
-                    model_name=self.kwargs['model_name'],
-                    field_name=field_name,
-                    q=q,
-                ) or []
-                qs = qs[:n]
-                results = [dict(key=_.id if hasattr(_, 'id') else _, value=str(_), field_name=field_name) for _ in qs]
-            elif isinstance(field, (
-                models.CharField,
-                models.EmailField,
-                models.SlugField,
-                models.TextField,
-                models.URLField,
-            )):
-
-                # Build query for a simple string-based field.
-                qs = model.objects.filter(**{field_name+'__icontains': q})\
-                    .values_list(field_name, flat=True)\
-                    .order_by(field_name)\
-                    .distinct()
-                qs = qs[:n]
-                results = [dict(key=_, value=_, field_name=field_name) for _ in qs]
-
-            elif isinstance(field, (
-                models.ForeignKey,
-                models.ManyToManyField,
-                models.OneToOneField,
-            )):
-                # Build query for a related model.
-                search_fields = settings.DAS_AJAX_SEARCH_PATH_FIELDS.get(path)
-                if search_fields:
-                    qs_args = []
-                    for search_field in search_fields:
-                        #qs_args.append(Q(**{field_name+'__'+search_field+'__icontains': q}))
-                        qs_args.append(Q(**{search_field + '__icontains': q}))
-                    rel_model = field.remote_field.model
-                    qs = rel_model.objects.filter(six.moves.reduce(operator.or_, qs_args))
-                    qs = qs[:n]
-                    pk_name = rel_model._meta.pk.name
-                    results = [dict(key=getattr(_, pk_name), value=str(_), field_name=field_name) for _ in qs.iterator()]
-
-        response = HttpResponse(json.dumps(results), content_type='application/json', **response_kwargs)
-        if settings.DAS_AJAX_SEARCH_DEFAULT_CACHE_SECONDS:
-            cache.set(cache_key, response, settings.DAS_AJAX_SEARCH_DEFAULT_CACHE_SECONDS)
-        return response
+    def get(self, request, job_id):
+        if not request.user.is_authenticated or not request.user.is_active or not request.user.is_staff:
+            raise PermissionDenied
+
+        job = get_object_or_404(ExportJob, id=job_id)
+        if job.user_id != request.user.id and not request.user.is_superuser:
+            raise PermissionDenied
+
+        if job.status != ExportJob.DONE or not os.path.isfile(job.path):
+            # Accepted, but not yet complete.
+            return HttpResponse('Export is %s. %i records written.' % (job.get_status_display().lower(), job.written), content_type='text/plain', status=202)
+
+        return FileResponse(open(job.path, 'rb'), as_attachment=True, filename=job.filename, content_type='text/csv')
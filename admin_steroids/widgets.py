@@ -1,12 +1,14 @@
 from django import forms
+from django.core.exceptions import ValidationError
 from django.contrib.admin.widgets import ManyToManyRawIdWidget, ForeignKeyRawIdWidget
-from django.urls import reverse, NoReverseMatch
+from django.urls import NoReverseMatch
 from django.forms.widgets import Select, TextInput
 from django.forms.utils import flatatt
 from django.template import Context, Template
 from django.utils.encoding import force_str, smart_str
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
+from django.utils.text import Truncator
 
 from . import utils
 
@@ -17,22 +19,45 @@ class LinkedSelect(Select):
         output = super().render(name, value, attrs=attrs, *args, **kwargs)
         model = self.choices.field.queryset.model
         to_field_name = self.choices.field.to_field_name or 'id'
-        try:
-            kwargs = {to_field_name: value}
-            obj = model.objects.get(**kwargs)
+        obj = utils.get_object_cache().get(model, value, to_field_name)
+        if obj is not None:
             view_url = utils.get_admin_change_url(obj)
             output += mark_safe('&nbsp;<a href="%s" target="_blank">view</a>&nbsp;' % (view_url,))
-        except model.DoesNotExist:
-            pass
         return output
 
 
+FOREIGN_KEY_TEXT_INPUT_TEMPLATE = u"""
+{% load static %}
+<input{{ attrs|safe }} />
+{% if instance %}
+    <a href="{{ changelist_url|safe }}?t=id" class="related-lookup" id="lookup_{{ id|safe }}" onclick="return showRelatedObjectLookupPopup(this);">
+        <img src="{% static 'admin/img/selector-search.gif' %}" width="16" height="16" alt="Lookup" />
+    </a>
+    <strong><a href="{{ url|safe }}" target="_blank">{{ instance|safe }}</a></strong>
+{% endif %}
+        """
+
+
 class ForeignKeyTextInput(TextInput):
     """
     Implements the same markup as VerboseForeignKeyRawIdWidget but does not
     require an explicit model relationship.
     """
 
+    template_source = FOREIGN_KEY_TEXT_INPUT_TEMPLATE
+
+    # The compiled template_source, shared by all instances of the class.
+    _template = None
+
+    @classmethod
+    def get_template(cls):
+        """
+        Returns the compiled template, parsing it the first time it's requested.
+        """
+        if cls.__dict__.get('_template') is None:
+            cls._template = Template(cls.template_source)
+        return cls._template
+
     def __init__(self, model_class, value, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._model_class = model_class
@@ -43,10 +68,13 @@ class ForeignKeyTextInput(TextInput):
         except TypeError:
             value = 0
         self._raw_value = value
-        q = model_class.objects.filter(id=value)
-        self._instance = None
-        if q.count():
-            self._instance = q[0]
+        # Loaded on render, so the widgets of a whole formset are loaded together.
+        self._object_cache = utils.get_object_cache()
+        self._object_cache.defer(model_class, value, 'id')
+
+    @property
+    def _instance(self):
+        return self._object_cache.get(self._model_class, self._raw_value, 'id')
 
     def render(self, name, value, attrs=None, renderer=None):
         if value is None:
@@ -54,30 +82,20 @@ class ForeignKeyTextInput(TextInput):
         final_attrs = self.build_attrs(attrs)
         if value != '':
             # Only add the 'value' attribute if a value is non-empty.
-            final_attrs['value'] = force_str(self._format_value(value))
+            final_attrs['value'] = force_str(self.format_value(value))
         final_attrs['size'] = 10
         final_attrs['type'] = 'text'
         final_attrs['name'] = name
-        t = Template(
-            u"""
-{% load staticfiles %}
-<input{{ attrs|safe }} />
-{% if instance %}
-    <a href="{{ changelist_url|safe }}?t=id" class="related-lookup" id="lookup_{{ id|safe }}" onclick="return showRelatedObjectLookupPopup(this);">
-        <img src="{% static 'admin/img/selector-search.gif' %}" width="16" height="16" alt="Lookup" />
-    </a>
-    <strong><a href="{{ url|safe }}" target="_blank">{{ instance|safe }}</a></strong>
-{% endif %}
-        """
-        )
+        instance = self._instance
+        t = self.get_template()
         c = Context(
             dict(
                 id=final_attrs['id'],
                 attrs=flatatt(final_attrs),
                 raw_value=self._raw_value,
-                url=utils.get_admin_change_url(self._instance),
+                url=utils.get_admin_change_url(instance),
                 changelist_url=utils.get_admin_changelist_url(self._model_class),
-                instance=self._instance,
+                instance=instance,
             )
         )
         return mark_safe(t.render(c))
@@ -102,25 +120,78 @@ class VerboseForeignKeyRawIdWidget(ForeignKeyRawIdWidget):
             return '_blank'
         return '_self'
 
+    def get_object(self, value):
+        """
+        Returns the selected record from the request's shared object cache, or None if there isn't one.
+        """
+        return utils.get_object_cache().get(self.rel.model, value, self.rel.get_related_field().name, using=self.db)
+
+    def label_and_url_for_value(self, value):
+        obj = self.get_object(value)
+        if obj is None:
+            return '', ''
+        try:
+            url = utils.get_admin_change_url(obj, namespace=self.admin_site.name)
+        except NoReverseMatch:
+            url = ''
+        return Truncator(obj).words(14), url
+
     def label_for_value(self, value):
-        key = self.remote_field.get_related_field().name
+        obj = self.get_object(value)
+        if obj is None:
+            return ''
         try:
-            obj = self.remote_field.model._default_manager.using(self.db).get(**{key: value})
-            change_url = reverse("admin:%s_%s_change" % (obj._meta.app_label, obj._meta.object_name.lower()), args=(obj.pk,))
+            change_url = utils.get_admin_change_url(obj, namespace=self.admin_site.name)
             return '&nbsp;<strong><a href="%s" target="%s">%s</a></strong>' % (change_url, self.target, escape(obj))
         except NoReverseMatch:
             return '&nbsp;<strong>%s</strong>' % (escape(obj),)
-        except (ValueError, self.remote_field.model.DoesNotExist):
-            return ''
+
+
+def defer_form_objects(forms):
+    """
+    Marks the records selected in the forms' foreign key raw id fields for loading
+    with the request's shared object cache, so rendering the forms loads each model's records in one query.
+    """
+    cache = utils.get_object_cache()
+    for form in forms:
+        for bound_field in form:
+            widget = bound_field.field.widget
+            if isinstance(widget, VerboseForeignKeyRawIdWidget):
+                cache.defer(widget.rel.model, bound_field.value(), widget.rel.get_related_field().name, using=widget.db)
+
+
+def load_in_order(manager, field, values):
+    """
+    Loads the records whose field matches each of the given values with a single query.
+
+    Returns a list of (value, record) pairs in the order of the values,
+    with None for any value that doesn't match a record.
+    """
+    keys = []
+    for value in values:
+        try:
+            keys.append(field.to_python(value))
+        except ValidationError:
+            keys.append(None)
+    lookup = [key for key in keys if key is not None]
+    objects = {}
+    if lookup:
+        objects = {getattr(obj, field.attname): obj for obj in manager.filter(**{field.name + '__in': lookup})}
+    return [(value, objects.get(key)) for value, key in zip(values, keys)]
 
 
 class VerboseManyToManyRawIdWidget(ManyToManyRawIdWidget):
 
+    # The most selected records to label, with the rest summarized as "+N more". None labels them all.
+    max_labels = None
+
     def __init__(self, *args, **kwargs):
         raw_id_fields_new_tab = True
         if 'raw_id_fields_new_tab' in kwargs:
             raw_id_fields_new_tab = kwargs['raw_id_fields_new_tab']
             del kwargs['raw_id_fields_new_tab']
+        if 'max_labels' in kwargs:
+            self.max_labels = kwargs.pop('max_labels')
         super().__init__(*args, **kwargs)
         self.raw_id_fields_new_tab = raw_id_fields_new_tab
 
@@ -130,6 +201,14 @@ class VerboseManyToManyRawIdWidget(ManyToManyRawIdWidget):
             return '_blank'
         return '_self'
 
+    def split_labelled(self, values):
+        """
+        Returns the values to label and the number of values left over.
+        """
+        if self.max_labels is None or len(values) <= self.max_labels:
+            return values, 0
+        return values[:self.max_labels], len(values) - self.max_labels
+
     # Note, Django changed its internals for the base widget so that it forces all the ManyToMany fields to use a single label and URL,
     # so we have to link to a filtered view of the change list page instead of providing individual direct links to each object.
     def label_and_url_for_value(self, value):
@@ -137,39 +216,44 @@ class VerboseManyToManyRawIdWidget(ManyToManyRawIdWidget):
             values = list(value)
         else:
             values = [value]
-        str_values = []
         label_lst = []
-        id_lst = []
         try:
-            changelist_url = reverse("admin:%s_%s_changelist" % (self.rel.model._meta.app_label, self.rel.model._meta.object_name.lower()))
+            changelist_url = utils.get_admin_changelist_url(self.rel.model, namespace=self.admin_site.name)
         except NoReverseMatch:
             changelist_url = ''
-        pk_name = self.rel.model._meta.pk.name
-        for v in values:
-            obj = self.rel.model._default_manager.using(self.db).get(**{pk_name: v})
-            label_lst.append(escape(smart_str(obj)))
-            id_lst.append(obj.pk)
+        pk_field = self.rel.model._meta.pk
+        labelled, more = self.split_labelled(values)
+        for _, obj in load_in_order(self.rel.model._default_manager.using(self.db), pk_field, labelled):
+            if obj is None:
+                label_lst.append(u'???')
+            else:
+                label_lst.append(escape(smart_str(obj)))
+        if more:
+            label_lst.append(u'+%i more' % more)
         label = ', '.join(label_lst)
         url = ''
         if changelist_url:
-            url = '%s?%s__in=%s' % (changelist_url, pk_name, ','.join(map(str, id_lst)))
+            url = '%s?%s__in=%s' % (changelist_url, pk_field.name, ','.join(map(str, values)))
         return label, url
 
     #TODO:Remove? Deprecated as of Django 2.2?
     def label_for_value(self, value):
         values = value.split(',')
         str_values = []
-        key = self.remote_field.get_related_field().name
-        for v in values:
-            obj = self.remote_field.model._default_manager.using(self.db).get(**{key: v})
+        field = self.rel.get_related_field()
+        labelled, more = self.split_labelled(values)
+        for _, obj in load_in_order(self.rel.model._default_manager.using(self.db), field, labelled):
+            if obj is None:
+                str_values += [u'???']
+                continue
             x = smart_str(obj)
             try:
-                change_url = reverse("admin:%s_%s_change" % (obj._meta.app_label, obj._meta.object_name.lower()), args=(obj.pk,))
+                change_url = utils.get_admin_change_url(obj, namespace=self.admin_site.name)
                 str_values += ['<strong><a href="%s" target="%s">%s</a></strong>' % (change_url, self.target, escape(x))]
             except NoReverseMatch as exc:
                 str_values += ['<strong>%s</strong>' % (escape(x),)]
-            except self.remote_field.model.DoesNotExist:
-                str_values += [u'???']
+        if more:
+            str_values += [u'+%i more' % more]
         return u', '.join(str_values)
 
 